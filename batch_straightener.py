@@ -1,53 +1,516 @@
 import sys, os, pdb, shutil, pickle, time, argparse, multiprocessing
-import math, logging, traceback
+import math, logging, traceback, json, threading, Queue
+import tarfile, zipfile, StringIO, hashlib, glob, re
 from os.path import join as pathjoin
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 import straightener
 
 """
 A script to handle straightening multiple images.
 """
 
-def straighten_images_process(imgpaths, imgsdir, outdir, resize, 
-                              maxAngle, graph, debug, filter, queue, imgsize,
-                              imgsize_rescale, grayscale):
+DEBUG = False
+
+# Print the progress at most every PROGRESS_INTERVAL seconds.
+PROGRESS_INTERVAL = 10.0
+
+# Images are handed out to the workers in chunks of at most CHUNKSIZE
+# images, or of at most CHUNK_BYTES bytes of input when weighting by file
+# size, as the workers ask for them.
+CHUNKSIZE = 4
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# Name of the journal, in outdir, recording each input that was processed
+# (one JSON object per line, see straighten_images_process).
+JOURNAL_NAME = '_straighten_journal.jsonl'
+# Default name of the manifest, in outdir, written by --detect-only.
+MANIFEST_NAME = '_straighten_manifest.jsonl'
+
+# What the workers do with each image: detect its rotation and straighten
+# it, only detect (for a manifest), or only straighten it with the
+# rotation from a manifest.
+MODE_STRAIGHTEN = 'straighten'
+MODE_DETECT = 'detect'
+MODE_APPLY = 'apply'
+
+# Extensions of the output images for each --format. 'keep' keeps the
+# extension, and so the format, of each input image.
+OUTPUT_EXTENSIONS = {'png': '.png', 'tiff': '.tif', 'npy': '.npy', 'keep': None}
+
+# Failures are described in ERRORS_NAME, in the current directory (in
+# OUTDIR for a shard, see shard_name).
+ERRORS_NAME = '_straighten_errors.log'
+
+# When reading from or writing to an archive, at most ARCHIVE_CHUNKS_PER_PROC
+# chunks per worker are dispatched ahead of the results, to bound the
+# memory taken by the images read ahead and by the results held back to
+# keep the order of the output archive.
+ARCHIVE_CHUNKS_PER_PROC = 2
+
+# Each worker overlaps reading and decoding, detecting and warping, and
+# encoding and writing images in three threads. Up to PIPELINE_DEPTH
+# images are queued between two stages, which bounds the memory used.
+PIPELINE_DEPTH = 2
+
+# Set in each worker process by init_worker.
+_worker = {}
+
+def init_worker(imgsdir, outdir, options, mode=MODE_STRAIGHTEN, manifest=None,
+                cachedir=None, depth=PIPELINE_DEPTH, encoder=None, archive=False,
+                stats=False):
     """
-    A function (intended to be called from another process) that
-    straightens all images in imgpaths.
+    Pool initializer: store the arguments shared by every image in this
+    worker process, so that only the image paths are sent per task.
     Input:
-        list imgpaths
         str imgsdir: The root directory of the original image directory
         str outdir: The root directory of the output images
-        obj queue: A Queue instance used for IPC. If any images fail to
-                   be straightened, then a tuple will be put:
-                       (1, IMGPATH, OUTPATH, str MSG)
-        tuple imgsize: If given, the size of the output images. Should
-                       be (WIDTH, HEIGHT)
-        int imgsize_rescale: If given, then the final width of the output
-                               images, after sizing by IMGSIZE.
-        bool grayscale: If True, then save output images in grayscale.
-    """
-    imgsdir = os.path.abspath(imgsdir)
-    for imgpath in imgpaths:
-        # do straighten
-        imgpath = os.path.abspath(imgpath)
-        prefix = os.path.normpath(os.path.commonprefix((imgsdir, imgpath)))
-        if '/' != prefix[-1]:
-            # commonprefix won't include the trailing '/' for directories
-            prefix = prefix + '/'
-        rel = os.path.normpath(imgpath[len(prefix):])
-        outpath = pathjoin(outdir, rel)
-        create_dirs(os.path.split(outpath)[0])
-        outpath_png = os.path.splitext(outpath)[0] + '.png'
+        dict options: Keyword arguments for straightener.straighten_image
+                      (resize, maxAngle, imgsize, imgsize_rescale, debug,
+                      graph, filter, grayscale, adaptive, stripRows), and
+                      the Hough backend to use (backend, see
+                      straightener.setHoughBackend).
+        str mode: One of MODE_STRAIGHTEN, MODE_DETECT, MODE_APPLY.
+        str manifest: For MODE_APPLY, the path of the manifest to take
+                      the rotations from.
+        str cachedir: If given, the directory of the detection cache
+                      (see straightener.DetectionCache) to use.
+        int depth: Number of images queued between the stages of the
+                   pipeline, see straighten_images_process.
+        dict encoder: The output format ('format', see OUTPUT_EXTENSIONS)
+                      and PNG options ('pngLevel', 'pngStrategy', see
+                      straightener.encoderParams).
+        bool archive: If True, return the encoded output images to the
+                      parent process, to go into the output archive,
+                      instead of writing them to outdir.
+        bool stats: If True, record the time spent in each stage and the
+                    counters of every image, see straightener.startStats.
+    """
+    _worker['imgsdir'] = os.path.abspath(imgsdir)
+    _worker['outdir'] = outdir
+    _worker['options'] = options
+    _worker['output_options'] = output_options(options, encoder)
+    _worker['mode'] = mode
+    _worker['depth'] = max(depth, 1)
+    _worker['encoder'] = encoder or {}
+    _worker['archive'] = archive
+    _worker['stats'] = stats
+    straightener.setOptions(options['debug'], options['graph'], options['filter'],
+                            options.get('backend'))
+    if manifest is not None:
+        _worker['manifest'] = load_records(manifest)
+    _worker['cache'] = None
+    if cachedir is not None:
+        _worker['cache'] = straightener.openCache(cachedir)
+
+def output_options(options, encoder=None):
+    """
+    The options (of init_worker) that the output images depend on, as
+    recorded in the journal, see is_up_to_date: the detection
+    parameters, the output size, the color and the format.
+    """
+    imgsize = options['imgsize']
+    return {'resize': float(options['resize']), 'max_angle': float(options['maxAngle']),
+            'filter': bool(options['filter']), 'adaptive': bool(options['adaptive']),
+            'strip_rows': options.get('stripRows'),
+            'size': list(imgsize) if imgsize else None,
+            'size_rescale': options['imgsize_rescale'],
+            'grayscale': bool(options['grayscale']),
+            'format': (encoder or {}).get('format', 'png')}
+
+def applied_options(options, detected):
+    """
+    The output options (see output_options) of an image straightened in
+    MODE_APPLY with the manifest record detected: they also hold the
+    angle and box it was straightened with, so that an image whose
+    angle or box was corrected in the manifest is not up to date.
+    """
+    options = dict(options)
+    options['angle'] = detected['angle2']
+    options['box'] = detected.get('box')
+    return options
+
+def get_relpath(imgpath, imgsdir):
+    """
+    Return the path of imgpath relative to the (absolute) imgsdir.
+    """
+    imgpath = os.path.abspath(imgpath)
+    prefix = os.path.normpath(os.path.commonprefix((imgsdir, imgpath)))
+    if '/' != prefix[-1]:
+        # commonprefix won't include the trailing '/' for directories
+        prefix = prefix + '/'
+    return os.path.normpath(imgpath[len(prefix):])
+
+def get_outpath(imgpath, imgsdir, outdir, format='png'):
+    """
+    Return the path of the output image for imgpath: the same path
+    relative to outdir as imgpath is to imgsdir, with the extension of
+    the output format (see OUTPUT_EXTENSIONS).
+    """
+    return get_rel_outpath(get_relpath(imgpath, imgsdir), outdir, format)
+
+def get_rel_outpath(rel, outdir, format='png'):
+    """
+    As get_outpath, for the path rel of an image relative to imgsdir.
+    """
+    outpath = pathjoin(outdir, rel)
+    if OUTPUT_EXTENSIONS[format] is None:
+        return outpath
+    return os.path.splitext(outpath)[0] + OUTPUT_EXTENSIONS[format]
+
+def straighten_images_process(imgpaths):
+    """
+    A function (intended to be called in a worker process set up by
+    init_worker) that straightens all images in imgpaths, or only
+    detects or only applies their rotation, depending on the mode.
+    An image is given either by its path, or, for an image read from an
+    archive by the parent process, as (str rel, str data, float mtime):
+    its path relative to imgsdir, the file contents and its mtime.
+    The images go through a pipeline of three threads: read_images reads
+    and decodes the next images, this thread detects and warps them,
+    and write_images encodes and writes them, so that the computation
+    doesn't wait on the disk. The OpenCV and lineDetect calls release
+    the GIL.
+    Output:
+        list of dicts, one per image, with the keys:
+            str input: path of the image, relative to imgsdir
+            str output: path of the output image, relative to outdir
+                (not in MODE_DETECT)
+            dict options: the options the output image was made with,
+                see output_options and applied_options (not in
+                MODE_DETECT)
+            int size, float mtime: of the image, when it was read
+            str status: 'ok' or 'failed'
+            float angle1, angle2, confidence: as returned by
+                straightener.straighten_image, if status is 'ok'
+            list box: the border box (rOff, tOff, lOff, bOff), in
+                MODE_DETECT
+            bool grayscale: if the image was decoded, and its rotation
+                detected, as a single channel, in MODE_DETECT
+            str error, traceback: what went wrong, if status is 'failed'
+            float elapsed: seconds spent on the image, over all stages
+                (which overlap with those of the images before and after
+                it)
+            float busy: the wall clock time of the worker on imgpaths,
+                spread evenly over the images
+            dict stats: the times and counts of straightener.startStats,
+                if they are recorded
+            int pid: of the worker process
+            str data: the encoded output image, when writing to an
+                archive
+        in the order of imgpaths.
+    """
+    started = time.time()
+    options = _worker['options']
+    mode = _worker['mode']
+    cache = _worker['cache']
+    results = []
+    readQueue = Queue.Queue(_worker['depth'])
+    writeQueue = Queue.Queue(_worker['depth'])
+    grayscale = options['grayscale']
+    reader = threading.Thread(target=read_images, args=(imgpaths, grayscale, readQueue))
+    writer = threading.Thread(target=write_images, args=(writeQueue, results))
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    
+    for record, outpath, data, img in iter(readQueue.get, None):
+        if record['status'] == 'failed':
+            results.append(record)
+            continue
+        t = time.time()
+        out = None
+        if _worker['stats']:
+            straightener.startStats(record['stats'])
+        try:
+            if mode == MODE_APPLY:
+                detected = _worker['manifest'][record['input']]
+                angle1, angle2, confidence = (detected['angle1'], detected['angle2'],
+                                              detected['confidence'])
+                box = detected.get('box')
+                if box is None:
+                    with straightener.timed('border'):
+                        box = straightener.findBorderRotated(img, angle2)
+            else:
+                angle1, angle2, confidence, box = straightener.cachedDetect(
+                    data, img, options['resize'], options['maxAngle'], 1,
+                    options['adaptive'], cache, record['input'], options.get('stripRows'))
+            if mode == MODE_DETECT:
+                record['box'] = list(box)
+            else:
+                out = straightener.warpToOutput(img, angle2, box, options['imgsize'],
+                                                options['imgsize_rescale'])
+            record.update(status='ok', angle1=angle1, angle2=angle2,
+                          confidence=confidence)
+        except Exception as e:
+            record.update(status='failed', error=repr(e),
+                          traceback=traceback.format_exc())
+        straightener.stopStats()
+        record['elapsed'] += time.time() - t
+        # Drop the decoded image before waiting on the writer
+        data = img = None
+        if out is None:
+            results.append(record)
+        else:
+            writeQueue.put((record, outpath, out))
+    
+    writeQueue.put(None)
+    writer.join()
+    reader.join()
+    # Failures skip the writer, so restore the order of imgpaths
+    results.sort(key=lambda record: record.pop('seq'))
+    busy = (time.time() - started) / max(len(results), 1)
+    for record in results:
+        record['busy'] = busy
+    return results
+
+def read_images(imgpaths, grayscale, readQueue):
+    """
+    The first stage of the straighten_images_process pipeline: read and
+    decode each image in imgpaths, and put (record, outpath, data, img)
+    on readQueue, then None. If an image can't be read, its record is
+    marked as failed instead.
+    """
+    for seq, imgpath in enumerate(imgpaths):
+        t = time.time()
+        if isinstance(imgpath, tuple):
+            rel, data, mtime = imgpath
+        else:
+            rel, data = get_relpath(imgpath, _worker['imgsdir']), None
+        record = {'input': rel,
+                  'output': get_rel_outpath(rel, '', _worker['encoder'].get('format', 'png')),
+                  'pid': os.getpid(), 'seq': seq}
+        outpath = pathjoin(_worker['outdir'], record['output'])
+        if _worker['mode'] == MODE_DETECT:
+            del record['output']
+            record['grayscale'] = grayscale
+        elif _worker['mode'] == MODE_APPLY and rel in _worker['manifest']:
+            record['options'] = applied_options(_worker['output_options'],
+                                                _worker['manifest'][rel])
+        else:
+            record['options'] = _worker['output_options']
+        if _worker['stats']:
+            record['stats'] = straightener.startStats()
+        img = None
+        try:
+            if isinstance(imgpath, tuple) and data is None:
+                # Its outputs could land outside of outdir, see iter_archive
+                record.pop('output', None)
+                raise ValueError("Unsafe path in archive: {0}".format(rel))
+            if data is None:
+                st = os.stat(imgpath)
+                record['size'] = st.st_size
+                record['mtime'] = st.st_mtime
+                data, img = straightener.readImage(os.path.abspath(imgpath), grayscale)
+            else:
+                record['size'] = len(data)
+                record['mtime'] = mtime
+                flags = straightener.cv.CV_LOAD_IMAGE_GRAYSCALE if grayscale \
+                    else straightener.cv.CV_LOAD_IMAGE_COLOR
+                img = straightener.decodeImage(data, flags, rel)
+            record['status'] = 'ok'
+        except Exception as e:
+            record.update(status='failed', error=repr(e),
+                          traceback=traceback.format_exc())
+        straightener.stopStats()
+        record['elapsed'] = time.time() - t
+        readQueue.put((record, outpath, data, img))
+    readQueue.put(None)
+
+def write_images(writeQueue, results):
+    """
+    The last stage of the straighten_images_process pipeline: encode and
+    write each (record, outpath, img) taken from writeQueue, until None,
+    and add the records to results. When writing to an archive, the
+    encoded image is only added to the record, as its 'data'.
+    """
+    encoder = _worker['encoder']
+    for record, outpath, img in iter(writeQueue.get, None):
+        t = time.time()
+        if _worker['stats']:
+            straightener.startStats(record['stats'])
         try:
-            straightener.straighten_image(imgpath, outpath_png, 
-                                          resize, maxAngle, imgsize,
-                                          debug, graph, filter,
-                                          imgsize_rescale, grayscale=grayscale)
+            params = straightener.encoderParams(outpath, encoder.get('pngLevel'),
+                                                encoder.get('pngStrategy'))
+            if _worker['archive']:
+                record['data'] = straightener.encodeImage(outpath, img, params)
+            else:
+                create_dirs(os.path.split(outpath)[0])
+                straightener.writeImage(outpath, img, params)
         except Exception as e:
-            queue.put((1, imgpath, outpath, traceback.format_exc()))
-    queue.put(0)
-    return 0
+            record.update(status='failed', error=repr(e),
+                          traceback=traceback.format_exc())
+        straightener.stopStats()
+        record['elapsed'] += time.time() - t
+        results.append(record)
+
+def load_records(path):
+    """
+    Read the journal or manifest at path, if there is one. Returns a dict
+    mapping each input (relative to imgsdir) to its most recent record.
+    A truncated last line, from a run that was killed, is ignored.
+    """
+    records = {}
+    try:
+        f = open(path)
+    except IOError:
+        return records
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        records[record['input']] = record
+    f.close()
+    return records
+
+def load_journal(outdir, shard=None):
+    return load_records(pathjoin(outdir, shard_name(JOURNAL_NAME, shard)))
+
+def parse_shard(value):
+    """
+    Parse the argument of --shard, 'i/N', into (int i, int N).
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got {0!r}".format(value))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("expected 0 <= i < N, got {0!r}".format(value))
+    return index, count
+
+def shard_name(name, shard):
+    """
+    The name of the journal, manifest or errors log of shard (i, N):
+    e.g. _straighten_journal.1-of-4.jsonl. Each shard has its own, so
+    that shards running on several machines never write the same file.
+    """
+    if shard is None:
+        return name
+    base, ext = os.path.splitext(name)
+    return "{0}.{1}-of-{2}{3}".format(base, shard[0], shard[1], ext)
+
+def in_shard(rel, shard):
+    """
+    Return True if the image at path rel (relative to imgsdir) belongs
+    to shard (i, N). An image is assigned to a shard by a hash of its
+    path, which is the same on every machine and every run, so the N
+    shards split the images into disjoint sets of about equal size.
+    """
+    if shard is None:
+        return True
+    digest = hashlib.md5(rel.replace(os.sep, '/')).hexdigest()
+    return int(digest, 16) % shard[1] == shard[0]
+
+def is_up_to_date(imgpath, record, outdir, options):
+    """
+    Return True if the journal record says that imgpath (a path, or an
+    image read from an archive, see straighten_images_process) was
+    straightened with the output options options (see output_options),
+    the image has not changed since (same size and mtime), and the
+    output image is still there in outdir.
+    """
+    if record is None or record['status'] != 'ok' or record.get('options') != options:
+        return False
+    if isinstance(imgpath, tuple):
+        rel, data, mtime = imgpath
+        size = len(data)
+    else:
+        try:
+            st = os.stat(imgpath)
+        except OSError:
+            return False
+        size, mtime = st.st_size, st.st_mtime
+    return (size == record['size'] and mtime == record['mtime']
+            and os.path.exists(pathjoin(outdir, record['output'])))
+
+def is_archive(path):
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+def iter_archive(path):
+    """
+    Yield the images in the tar or zip archive at path, in the order they
+    are stored, as (str rel, str data, float mtime): their path within
+    the archive, their contents and their mtime. A tar archive (possibly
+    compressed) is read as a stream. The images whose path is absolute or
+    goes up with '..' (see archive_rel) are yielded with data None, and
+    are not read: read_images records them as failed.
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                if not info.filename.endswith('/') and is_image_ext(info.filename):
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    rel = archive_rel(info.filename)
+                    if rel is None:
+                        yield (info.filename, None, mtime)
+                    else:
+                        yield (rel, archive.read(info), mtime)
+        finally:
+            archive.close()
+        return
+    archive = tarfile.open(path, 'r|*')
+    try:
+        for member in archive:
+            if member.isfile() and is_image_ext(member.name):
+                rel = archive_rel(member.name)
+                if rel is None:
+                    yield (member.name, None, float(member.mtime))
+                else:
+                    data = archive.extractfile(member).read()
+                    yield (rel, data, float(member.mtime))
+    finally:
+        archive.close()
+
+def archive_rel(name):
+    """
+    Return the archive member name as a path relative to imgsdir, or None
+    if it is absolute or has a '..' component: the outputs named after
+    it would then be written outside of outdir.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if os.path.isabs(name) or name.startswith(('/', '\\')) or '..' in parts:
+        return None
+    return os.path.normpath(name)
+
+class ArchiveWriter(object):
+    """
+    Writes the output images into a new tar (.tar, .tar.gz, .tgz,
+    .tar.bz2) or zip (.zip) archive at path, as a stream.
+    """
+    def __init__(self, path):
+        if path.lower().endswith('.zip'):
+            # The images are already compressed
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            self.tar = None
+        else:
+            mode = 'w|'
+            if path.lower().endswith(('.gz', '.tgz')):
+                mode = 'w|gz'
+            elif path.lower().endswith('.bz2'):
+                mode = 'w|bz2'
+            self.tar = tarfile.open(path, mode)
+            self.zip = None
+    
+    def add(self, name, data):
+        if self.zip is not None:
+            self.zip.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data)
+            return
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, StringIO.StringIO(data))
+    
+    def close(self):
+        (self.zip or self.tar).close()
 
 def create_dirs(*dirs):
     for dir in dirs:
@@ -56,91 +519,413 @@ def create_dirs(*dirs):
         except:
             pass
     
-def get_images_gen(imgsdir):
-    for dirpath, dirnames, filenames in os.walk(imgsdir):
-        for imgname in [f for f in filenames if is_image_ext(f)]:
-            yield imgname
-    raise StopIteration
-
-def divy_images(imgsdir, num):
-    count = 0
-    result = []
-    for dirpath, dirnames, filenames in os.walk(imgsdir):
-        if count >= num:
-            yield result
-            result = []
-            count = 0
-        for imgname in [f for f in filenames if is_image_ext(f)]:
-            if count >= num:
-                yield result
-                result = []
-                count = 0
-            result.append(pathjoin(dirpath, imgname))
-            count +=1
-    if result:
-        yield result
-    raise StopIteration
-                
-def spawn_jobs(imgsdir, outdir, num_imgs, resize, maxAngle, 
-               graph, debug, filter, queue, imgsize=None,
-               imgsize_rescale=None, grayscale=False):
-    n_procs = float(multiprocessing.cpu_count())
-    print 'cpu count:', n_procs
-    imgs_per_proc = int(math.ceil(num_imgs / n_procs))
-    print 'cpu count: {0} total number of imgs: {1} imgs_per_proc: {2}'.format(n_procs, num_imgs, imgs_per_proc)
-    pool = multiprocessing.Pool()
-    num_subprocs = 0
-    for i, imgpaths in enumerate(divy_images(imgsdir, imgs_per_proc)):
-        if imgpaths:
-            print 'Process {0} got {1} imgs'.format(i, len(imgpaths))
-            foo = pool.apply_async(straighten_images_process, 
-                                   args=(imgpaths, imgsdir, outdir, resize, 
-                                         maxAngle, graph, debug, filter, queue, imgsize,
-                                         imgsize_rescale, grayscale))
-            num_subprocs += 1
-    pool.close()
-    pool.join()
-
-    # Handle any errors that might have happened.
+def iter_images(imgsdir):
+    """
+    Yield the paths of the images under imgsdir as they are found, in a
+    single pass over the tree. Uses scandir (os.scandir, or the scandir
+    module on Python 2) when available, which gets the file types from
+    the directory listing instead of stat'ing every file. Like os.walk,
+    it doesn't follow the links to directories, which could loop.
+    """
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(imgsdir):
+            for imgname in [f for f in filenames if is_image_ext(f)]:
+                yield pathjoin(dirpath, imgname)
+        return
+    
+    dirs = [imgsdir]
+    while dirs:
+        dirpath = dirs.pop()
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif is_image_ext(entry.name) and not entry.is_dir():
+                yield entry.path
+        # Visit the subdirectories in os.walk's order
+        dirs.extend(reversed(subdirs))
+
+class Discovery(object):
+    """
+    Wraps an iterator of image paths, counting how many have been handed
+    out so far (discovered), and whether it is exhausted (finished).
+    """
+    def __init__(self, imgpaths):
+        self.imgpaths = imgpaths
+        self.discovered = 0
+        self.finished = False
+    
+    def __iter__(self):
+        for imgpath in self.imgpaths:
+            self.discovered += 1
+            yield imgpath
+        self.finished = True
+
+def make_chunks(imgpaths, chunksize=CHUNKSIZE, chunkbytes=None):
+    """
+    Group imgpaths into lists of at most chunksize paths. If chunkbytes
+    is given, a list is also cut once its files add up to chunkbytes
+    bytes, so that a directory of large scans is spread over more,
+    smaller chunks.
+    """
+    chunk = []
+    size = 0
+    for imgpath in imgpaths:
+        chunk.append(imgpath)
+        if chunkbytes and isinstance(imgpath, tuple):
+            size += len(imgpath[1])
+        elif chunkbytes:
+            try:
+                size += os.path.getsize(imgpath)
+            except OSError:
+                pass
+        if len(chunk) >= chunksize or (chunkbytes and size >= chunkbytes):
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+def percentile(values, p):
+    """
+    Return the p-th percentile (0 <= p <= 100) of the sorted list values,
+    by the nearest rank.
+    """
+    if not values:
+        return 0.0
+    k = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(k, 0), len(values) - 1)]
+
+def print_stage_stats(stagetimes, counts, num_images):
+    """
+    Print the percentiles of the time spent on an image in each stage
+    (stagetimes maps each stage to a list of seconds), and the mean of
+    each counter (counts maps each to its total) over num_images.
+    """
+    stages = [stage for stage in straightener.STAGES if stage in stagetimes]
+    stages += sorted(set(stagetimes) - set(stages))
+    total = sum(sum(times) for times in stagetimes.itervalues()) or 1.0
+    print "    Per stage (ms):   {0:>8} {1:>8} {2:>8} {3:>8} {4:>7}".format(
+        "p50", "p95", "p99", "max", "share")
+    for stage in stages:
+        times = sorted(stagetimes[stage])
+        print "      {0:<15} {1:>8.1f} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>7.1%}".format(
+            stage, 1000 * percentile(times, 50), 1000 * percentile(times, 95),
+            1000 * percentile(times, 99), 1000 * percentile(times, 100), sum(times) / total)
+    if counts and num_images:
+        print "    Per image (mean): {0}".format(', '.join(
+            "{0} {1:.0f}".format(name, counts[name] / float(num_images))
+            for name in sorted(counts)))
+
+def spawn_jobs(imgsdir, outdir, options, procs=None,
+               chunksize=CHUNKSIZE, weighted=False, resume=False,
+               retry_failed=False, mode=MODE_STRAIGHTEN, manifest=None,
+               cachedir=None, depth=PIPELINE_DEPTH, encoder=None, outarchive=None,
+               shard=None, statspath=None):
+    """
+    Straighten all images in imgsdir with a pool of procs worker
+    processes (default: one per CPU). The images are fed to the workers
+    a chunk at a time (see make_chunks), as they finish their previous
+    chunk, so that no worker sits idle while others still have a
+    backlog. The tree is walked only once, while the workers run, and
+    the images are dispatched as soon as they are found. Errors are
+    written to _straighten_errors.log.
+    Every processed image is appended to the journal in outdir (see
+    JOURNAL_NAME). If resume is True, the images that the journal says
+    are up to date, and were straightened with the same options (in
+    MODE_APPLY, the same angle and box as in the manifest), are
+    skipped. If retry_failed is True, only the images
+    that failed according to the journal are processed, and the tree is
+    not walked.
+    In MODE_DETECT, the rotations and border boxes are written to the
+    manifest (by default MANIFEST_NAME in outdir) instead, and no images
+    are written. In MODE_APPLY, the images listed in the manifest are
+    straightened with the rotations it gives, without detecting them.
+    If cachedir is given, the detections are looked up in and added to
+    the detection cache there. depth is the number of images each worker
+    queues between the stages of its pipeline, see
+    straighten_images_process. encoder gives the output format and PNG
+    options, see init_worker.
+    imgsdir may also be a tar or zip archive: its images are then read
+    (as a stream) by this process and sent to the workers, instead of
+    being extracted. If outarchive is given, the output images are
+    written into a new archive there (see ArchiveWriter) instead of to
+    outdir. With either, the images are handled in the order they are
+    found, so the output archive is in the same order as the input.
+    If shard is given, as (i, N), only the images in shard i of N (see
+    in_shard) are processed, and the journal, manifest and errors log
+    are named after the shard (see shard_name), so that N runs can share
+    outdir. Combine them afterwards with merge_shards.
+    If statspath is given, the time spent on each image in each stage,
+    and its line and pixel counts (see straightener.startStats), are
+    written there as JSON lines, and their percentiles are printed at
+    the end.
+    Output:
+        int number of images that failed.
+    """
+    n_procs = procs or multiprocessing.cpu_count()
+    print 'cpu count: {0} chunksize: {1}{2} Hough backend: {3}'.format(
+        n_procs, chunksize, ' (weighted by file size)' if weighted else '',
+        options.get('backend') or straightener.houghBackend())
+    chunkbytes = CHUNK_BYTES if weighted else None
+    if mode == MODE_DETECT and manifest is None:
+        manifest = pathjoin(outdir, shard_name(MANIFEST_NAME, shard))
+    inarchive = is_archive(imgsdir)
+    archive = None
+    if outarchive is not None and mode != MODE_DETECT:
+        archive = ArchiveWriter(outarchive)
+    pool = multiprocessing.Pool(n_procs, init_worker,
+                                (imgsdir, outdir, options, mode,
+                                 manifest if mode == MODE_APPLY else None, cachedir,
+                                 depth, encoder, archive is not None, statspath is not None))
+
+    journal = load_journal(outdir, shard) if (resume or retry_failed) else {}
+    create_dirs(outdir)
+    if mode == MODE_DETECT:
+        journalfile = open(manifest, 'w')
+    else:
+        journalfile = open(pathjoin(outdir, shard_name(JOURNAL_NAME, shard)), 'a')
+
     num_done = 0
     num_errs = 0
-    errfile = open('_straighten_errors.log', 'w')
-    while num_done < num_subprocs:
-        thing = queue.get()
-        if thing == 0:
-            num_done += 1
-        else:
-            # Failed to straighten this image.
-            errcode, imgpath, outpath, msg = thing
-            print >>errfile, "{0}.) Failed to straighten: {1}.".format(num_errs, imgpath)
-            print >>errfile, "    {0}".format(msg)
-            print >>errfile, ""
-            num_errs += 1
-    errfile.close()
+    num_skipped = [0]
+    busy = {}
+    last = {}
+    elapsed = []
+    stagetimes = {}
+    counts = {}
+    statsfile = open(statspath, 'w') if statspath else None
+    if shard is None:
+        errfile = open(ERRORS_NAME, 'w')
+    else:
+        errfile = open(pathjoin(outdir, shard_name(ERRORS_NAME, shard)), 'w')
+    t_start = time.time()
+    t_progress = t_start
+    if inarchive:
+        imgpaths = iter_archive(imgsdir)
+        wanted = None
+        if mode == MODE_APPLY:
+            wanted = set(rel for rel, record in load_records(manifest).items()
+                         if record['status'] == 'ok')
+        if retry_failed:
+            failed = set(rel for rel, record in journal.items() if record['status'] == 'failed')
+            wanted = failed if wanted is None else wanted & failed
+        if wanted is not None:
+            imgpaths = (item for item in imgpaths if item[0] in wanted)
+    elif mode == MODE_APPLY:
+        imgpaths = [pathjoin(imgsdir, rel) for rel, record in sorted(load_records(manifest).items())
+                    if record['status'] == 'ok']
+        if retry_failed:
+            imgpaths = [imgpath for imgpath in imgpaths
+                        if journal.get(get_relpath(imgpath, os.path.abspath(imgsdir)),
+                                       {}).get('status') == 'failed']
+    elif retry_failed:
+        imgpaths = [pathjoin(imgsdir, rel) for rel, record in sorted(journal.items())
+                    if record['status'] == 'failed']
+    else:
+        imgpaths = iter_images(imgsdir)
+    absdir = os.path.abspath(imgsdir)
+    def relpath(imgpath):
+        if isinstance(imgpath, tuple):
+            return imgpath[0]
+        return get_relpath(imgpath, absdir)
+    if shard is not None:
+        imgpaths = (imgpath for imgpath in imgpaths if in_shard(relpath(imgpath), shard))
+    if resume:
+        current = output_options(options, encoder)
+        applied = load_records(manifest) if mode == MODE_APPLY else {}
+        def pending(imgpaths):
+            for imgpath in imgpaths:
+                rel = relpath(imgpath)
+                wanted = current
+                if rel in applied:
+                    wanted = applied_options(current, applied[rel])
+                if is_up_to_date(imgpath, journal.get(rel), outdir, wanted):
+                    num_skipped[0] += 1
+                else:
+                    yield imgpath
+        imgpaths = pending(imgpaths)
+    discovery = Discovery(imgpaths)
+    chunks = make_chunks(discovery, chunksize, chunkbytes)
+    ordered = inarchive or archive is not None
+    imap = pool.imap if ordered else pool.imap_unordered
+    if ordered:
+        # The pool reads the chunks as fast as it can, and imap holds the
+        # results that come back out of order: hold it back
+        inflight = threading.Semaphore(n_procs * ARCHIVE_CHUNKS_PER_PROC)
+        aborted = []
+        def throttled(chunks):
+            for chunk in chunks:
+                inflight.acquire()
+                if aborted:
+                    return
+                yield chunk
+        chunks = throttled(chunks)
+    try:
+        for results in imap(straighten_images_process, chunks):
+            if ordered:
+                inflight.release()
+            now = time.time()
+            for record in results:
+                num_done += 1
+                if 'data' in record:
+                    archive.add(record['output'], record.pop('data'))
+                pid = record.pop('pid')
+                if statsfile is not None:
+                    stats = record.pop('stats')
+                    for stage, seconds in stats['times'].iteritems():
+                        stagetimes.setdefault(stage, []).append(seconds)
+                    for name, value in stats['counts'].iteritems():
+                        counts[name] = counts.get(name, 0) + value
+                    stats.update(input=record['input'], status=record['status'],
+                                 elapsed=record['elapsed'], pid=pid)
+                    print >>statsfile, json.dumps(stats, sort_keys=True)
+                elapsed.append(record['elapsed'])
+                # Not elapsed, which counts the overlapping stages twice
+                busy[pid] = busy.get(pid, 0.0) + record.pop('busy')
+                last[pid] = now
+                if record['status'] != 'ok':
+                    # Failed to straighten this image.
+                    print >>errfile, "{0}.) Failed to straighten: {1}.".format(
+                        num_errs, pathjoin(imgsdir, record['input']))
+                    print >>errfile, "    {0}".format(record.pop('traceback'))
+                    print >>errfile, ""
+                    num_errs += 1
+                print >>journalfile, json.dumps(record, sort_keys=True)
+            journalfile.flush()
+            if DEBUG or now - t_progress >= PROGRESS_INTERVAL:
+                t_progress = now
+                print "...{0}/{1} images done{2}".format(
+                    num_done, discovery.discovered,
+                    '' if discovery.finished else ' (still discovering)')
+        pool.close()
+    except:
+        if ordered:
+            # Don't leave the pool's task handler waiting in throttled
+            aborted.append(True)
+            inflight.release()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        errfile.close()
+        journalfile.close()
+        if statsfile is not None:
+            statsfile.close()
+        if archive is not None:
+            archive.close()
+    wall = time.time() - t_start
+
+    if num_skipped[0]:
+        print "Skipped {0} images that were already up to date".format(num_skipped[0])
+    elapsed.sort()
+    print "Processed {0} images in {1:.1f} s ({2:.2f} images/s)".format(
+        num_done, wall, num_done / wall if wall else 0.0)
+    print "    Per image: p50 {0:.3f} s, p95 {1:.3f} s, p99 {2:.3f} s, max {3:.3f} s".format(
+        percentile(elapsed, 50), percentile(elapsed, 95),
+        percentile(elapsed, 99), percentile(elapsed, 100))
+    if wall and last:
+        # The tail is the time from the first worker running out of work
+        # to the end of the run.
+        print "    Core utilization: {0:.1%}, tail: {1:.1f} s".format(
+            sum(busy.values()) / (wall * n_procs), wall - (min(last.values()) - t_start))
+    if statsfile is not None:
+        print_stage_stats(stagetimes, counts, num_done)
     if num_errs:
         print "Number of fatal errors:", num_errs
-        print "    More information can be found in: _straighten_errors.log"
+        print "    More information can be found in:", errfile.name
+    return num_errs
 
-def start_straightening(imgsdir, outdir, num_imgs, 
+def start_straightening(imgsdir, outdir,
                         resize, maxAngle, graph, debug, filter, imgsize=None,
-                        imgsize_rescale=None, grayscale=False):
+                        imgsize_rescale=None, grayscale=False, adaptive=False,
+                        procs=None, chunksize=CHUNKSIZE, weighted=False,
+                        resume=False, retry_failed=False, mode=MODE_STRAIGHTEN,
+                        manifest=None, cachedir=None, depth=PIPELINE_DEPTH,
+                        encoder=None, outarchive=None, shard=None, statspath=None,
+                        backend=None, stripRows=None):
     """
-    Kicks off the straightening by spawning a 'master' process which
-    spawns child worker processes.
+    Kicks off the straightening on a pool of worker processes, see
+    spawn_jobs.
     """
-    manager = multiprocessing.Manager()
-    queue = manager.Queue()
+    global DEBUG
+    DEBUG = debug
+    options = dict(resize=resize, maxAngle=maxAngle, imgsize=imgsize,
+                   debug=debug, graph=graph, filter=filter,
+                   imgsize_rescale=imgsize_rescale, grayscale=grayscale,
+                   adaptive=adaptive, backend=backend, stripRows=stripRows)
 
-    print "Spawning master process to start straightening images in", imgsdir
-
-    p = multiprocessing.Process(target=spawn_jobs, 
-                                args=(imgsdir, outdir, num_imgs, resize, 
-                                      maxAngle, graph, debug, filter, queue, imgsize, imgsize_rescale, grayscale))
-    p.start()
-    p.join()
+    print "Starting to straighten images in", imgsdir
+    spawn_jobs(imgsdir, outdir, options, procs, chunksize, weighted,
+               resume, retry_failed, mode, manifest, cachedir, depth, encoder,
+               outarchive, shard, statspath)
 
     print "Finished straightening."
 
+def merge_shards(outdir):
+    """
+    Combine the journals, manifests and errors logs that the shards of a
+    run (see spawn_jobs) wrote to outdir into one of each, named as for
+    an unsharded run, and print a report of each shard. The records of
+    the shards are added to those already in the combined journal or
+    manifest, replacing any for the same images.
+    """
+    for name in (JOURNAL_NAME, MANIFEST_NAME):
+        paths = glob.glob(pathjoin(outdir, shard_name(name, ('*', '*'))))
+        if not paths:
+            continue
+        shards = sorted((shard_of(path), path) for path in paths)
+        merged = load_records(pathjoin(outdir, name))
+        owner = {}
+        print "Merging {0} shard(s) into {1}:".format(len(shards), pathjoin(outdir, name))
+        for shard, path in shards:
+            records = load_records(path)
+            num_failed = 0
+            for rel, record in records.iteritems():
+                if rel in owner:
+                    print "    {0} is in both shard {1}/{2} and shard {3}/{4}".format(
+                        rel, owner[rel][0], owner[rel][1], shard[0], shard[1])
+                owner[rel] = shard
+                if record['status'] != 'ok':
+                    num_failed += 1
+            merged.update(records)
+            print "    shard {0}/{1}: {2} images, {3} failed".format(
+                shard[0], shard[1], len(records), num_failed)
+        for count in sorted(set(shard[1] for shard, path in shards)):
+            missing = sorted(set(range(count)) - set(shard[0] for shard, path in shards
+                                                     if shard[1] == count))
+            if missing:
+                print "    missing shard(s) {0} of {1}".format(
+                    ', '.join(str(index) for index in missing), count)
+        f = open(pathjoin(outdir, name), 'w')
+        for rel in sorted(merged):
+            print >>f, json.dumps(merged[rel], sort_keys=True)
+        f.close()
+        print "    total: {0} images, {1} failed".format(
+            len(merged), sum(1 for record in merged.itervalues() if record['status'] != 'ok'))
+
+    paths = glob.glob(pathjoin(outdir, shard_name(ERRORS_NAME, ('*', '*'))))
+    if paths:
+        errfile = open(pathjoin(outdir, ERRORS_NAME), 'w')
+        for shard, path in sorted((shard_of(path), path) for path in paths):
+            print >>errfile, "==== shard {0}/{1} ====".format(shard[0], shard[1])
+            f = open(path)
+            shutil.copyfileobj(f, errfile)
+            f.close()
+        errfile.close()
+        print "Merged {0} errors log(s) into {1}".format(len(paths), pathjoin(outdir, ERRORS_NAME))
+
+def shard_of(path):
+    """
+    The shard (i, N) of a file named by shard_name.
+    """
+    match = re.search(r'\.(\d+)-of-(\d+)\.[^.]*$', path)
+    return int(match.group(1)), int(match.group(2))
+
 def is_there_image(dir):
     """
     Return True if there exists at least one image in this directory
@@ -151,19 +936,14 @@ def is_there_image(dir):
             return True
     return False
 
-def count_images(imgsdir):
-    ct = 0
-    for dirpath, dirnames, filenames in os.walk(imgsdir):
-        ct += len([f for f in filenames if is_image_ext(f)])
-    return ct
-
 def is_image_ext(path):
     return os.path.splitext(path)[1].lower() in ('.png', '.jpg', '.jpeg',
                                                  '.tiff', '.tif', '.bmp')
 
 def do_main():
     usage="python batch_straightener.py [-o OUTDIR] [-r RESIZE] [--size WIDTH HEIGHT] \
-[-m MAXANGLE] [-g] [-d] IMGDIR"
+[-m MAXANGLE] [-g] [-d] [--shard i/N] IMGDIR\n       \
+python batch_straightener.py --merge -o OUTDIR"
     parser = argparse.ArgumentParser(usage=usage,
                                      description='Straightens a set of images.')
 
@@ -185,36 +965,133 @@ Useful if you'd like to downsize a dataset.")
     parser.add_argument("-m", "--max-angle",
                         dest="maxAngle", default=4.0, type=float,
                         help="Maximum expected angle from the vertical/horizontal (in degrees)")
+    parser.add_argument("-a", "--adaptive", action="store_true", dest="adaptive",
+                        default=False, help="Try detecting the rotation on smaller thumbnails first")
     parser.add_argument("-f", "--filter", action="store_true", dest="filter",
                         default=False, help="Filter the image and remove large black rectangles")
+    parser.add_argument("--hough-backend", dest="backend", default=None,
+                        choices=list(straightener.HOUGH_BACKENDS),
+                        help="Hough transform backend (default: the first available of %(choices)s)")
+    parser.add_argument("--strip-rows", dest="strip_rows", default=None, type=int,
+                        metavar="ROWS", help="Detect the rotation a strip of ROWS thumbnail rows \
+at a time (e.g. {0}), to bound its memory use".format(straightener.STRIP_ROWS))
     parser.add_argument("-g", "--graph", action="store_true", dest="graph",
                       default=False, help="Graph the discovered lines")
     parser.add_argument("-d", "--debug", action="store_true", dest="debug",
                       default=False, help="Print debugging info")
+    parser.add_argument("-j", "--procs", dest="procs", default=None, type=int,
+                        help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--chunksize", dest="chunksize", default=CHUNKSIZE, type=int,
+                        help="Maximum number of images handed to a worker at a time")
+    parser.add_argument("--weighted", action="store_true", dest="weighted",
+                        default=False, help="Also cut the chunks handed to the workers by \
+total file size, so that large images are spread more evenly")
+    parser.add_argument("--resume", action="store_true", dest="resume",
+                        default=False, help="Skip the images that the journal in OUTDIR says \
+were already straightened with the same options (with --apply, the same angle and box \
+as in MANIFEST), and have not changed since")
+    parser.add_argument("--retry-failed", action="store_true", dest="retry_failed",
+                        default=False, help="Only reprocess the images that the journal in \
+OUTDIR says failed")
+    parser.add_argument("--detect-only", action="store_true", dest="detect_only",
+                        default=False, help="Only detect the rotations and border boxes, and \
+write them to the manifest (see --manifest) instead of straightening the images. The \
+images are decoded as straightening would (as grayscale only with --grayscale), so that \
+--apply gives the same output")
+    parser.add_argument("--manifest", dest="manifest", default=None,
+                        help="The manifest written by --detect-only (default: \
+{0} in OUTDIR)".format(MANIFEST_NAME))
+    parser.add_argument("--apply", dest="apply", default=None, metavar="MANIFEST",
+                        help="Only straighten the images listed in MANIFEST, as written by \
+--detect-only, with the rotations it gives. To correct an angle by hand, change its angle2 \
+and remove its box, which is then found again.")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=straightener.CACHE_DIR,
+                        help="Directory of the detection cache, which lets re-runs with other \
+output settings skip the detection (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        default=False, help="Neither use nor update the detection cache")
+    parser.add_argument("--prefetch", dest="depth", default=PIPELINE_DEPTH, type=int,
+                        help="Number of images each worker reads ahead, and queues for \
+writing (default: %(default)s)")
+    parser.add_argument("--format", dest="format", default="png",
+                        choices=sorted(OUTPUT_EXTENSIONS),
+                        help="Output format: png, uncompressed tiff, raw numpy arrays (npy), \
+or keep the format of each input image (default: %(default)s)")
+    parser.add_argument("--png-level", dest="png_level", default=None, type=int,
+                        choices=range(10), metavar="0-9",
+                        help="PNG compression level. By default OpenCV uses a mode tuned for \
+speed; giving a level switches to adaptive filtering, which is smaller but slower")
+    parser.add_argument("--png-strategy", dest="png_strategy", default=None,
+                        choices=sorted(straightener.PNG_STRATEGIES),
+                        help="PNG (zlib) compression strategy")
+    parser.add_argument("--output-archive", dest="outarchive", default=None,
+                        metavar="ARCHIVE", help="Write the output images into a new tar \
+(.tar, .tar.gz, .tgz, .tar.bz2) or zip (.zip) archive, instead of into OUTDIR")
+    parser.add_argument("--shard", dest="shard", default=None, type=parse_shard,
+                        metavar="i/N", help="Only process shard i (0 <= i < N) of the images, \
+picked by a hash of their paths, so that N runs, e.g. on different machines sharing \
+OUTDIR, process disjoint sets of images. Each shard keeps its own journal, manifest and \
+errors log in OUTDIR; combine them afterwards with --merge")
+    parser.add_argument("--merge", action="store_true", dest="merge", default=False,
+                        help="Combine the journals, manifests and errors logs of the shards \
+in OUTDIR (see --shard) into one of each, and report on each shard")
+    parser.add_argument("--stats", dest="statspath", default=None, metavar="FILE",
+                        help="Write the time spent on each image in each stage, and its \
+line and foreground pixel counts, to FILE as JSON lines, and print the percentiles of \
+each stage at the end")
     parser.add_argument("--grayscale", action="store_true", 
-                        help="Save output images as grayscale.")
-    parser.add_argument("imgsdir", help="Input directory")
+                        help="Save output images as grayscale. The images are then decoded, "
+                        "straightened and saved as a single channel, which is faster.")
+    parser.add_argument("imgsdir", nargs="?", help="Input directory, or tar or zip archive")
 
     args = parser.parse_args()
+    if args.merge:
+        merge_shards(args.outdir)
+        return
+    if args.imgsdir is None:
+        parser.error("too few arguments")
+    if args.detect_only and (args.apply or args.resume or args.retry_failed):
+        parser.error("--detect-only can't be combined with --apply, --resume or --retry-failed")
+    if args.outarchive and (args.resume or args.detect_only):
+        parser.error("--output-archive can't be combined with --resume or --detect-only")
+    if args.detect_only:
+        mode, manifest = MODE_DETECT, args.manifest
+    elif args.apply:
+        mode, manifest = MODE_APPLY, args.apply
+        # The angles detected on the decoder's grayscale image can differ
+        # from those detected on the color image, see --detect-only
+        if any(record.get('grayscale', args.grayscale) != args.grayscale
+               for record in load_records(manifest).itervalues()):
+            parser.error("the manifest was detected {0} --grayscale, apply it {0} it too".format(
+                "without" if args.grayscale else "with"))
+    else:
+        mode, manifest = MODE_STRAIGHTEN, None
     
     imgsdir = args.imgsdir
     outdir = args.outdir
     imgsize = args.imgsize
     imgsize_rescale = args.imgsize_rescale
 
-    print "Counting images in {0}...".format(imgsdir)
-    num_imgs = count_images(imgsdir)
-    print "...Finished Counting images: there are {0} images.".format(num_imgs)
-
     if imgsize != None:
         imgsize = (int(imgsize[0]), int(imgsize[1]))
 
     print "Calling the start_straightening job..."
-    start_straightening(imgsdir, outdir, num_imgs, 
+    start_straightening(imgsdir, outdir,
                         args.resize, args.maxAngle, 
                         args.graph, args.debug, args.filter, imgsize=imgsize,
                         imgsize_rescale=imgsize_rescale,
-                        grayscale=args.grayscale)
+                        grayscale=args.grayscale, adaptive=args.adaptive,
+                        procs=args.procs, chunksize=args.chunksize,
+                        weighted=args.weighted, resume=args.resume,
+                        retry_failed=args.retry_failed, mode=mode,
+                        manifest=manifest,
+                        cachedir=None if args.no_cache else args.cache_dir,
+                        depth=args.depth,
+                        encoder=dict(format=args.format, pngLevel=args.png_level,
+                                     pngStrategy=args.png_strategy),
+                        outarchive=args.outarchive, shard=args.shard,
+                        statspath=args.statspath, backend=args.backend,
+                        stripRows=args.strip_rows)
 
 if __name__ == '__main__':
     do_main()
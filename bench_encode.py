@@ -0,0 +1,79 @@
+import sys, os, time, argparse, StringIO
+import numpy, cv2
+
+import straightener
+
+"""
+Compare the output encoders of batch_straightener.py (see its --format,
+--png-level and --png-strategy options): prints the encode time and
+size of each choice, averaged over the given images.
+"""
+
+# (name, extension, pngLevel, pngStrategy)
+ENCODERS = [('png (default)', '.png', None, None),
+            ('png level 0', '.png', 0, None),
+            ('png default, filtered', '.png', None, 'filtered'),
+            ('png default, huffman', '.png', None, 'huffman'),
+            ('png level 1', '.png', 1, None),
+            ('png level 1, rle', '.png', 1, 'rle'),
+            ('png level 6', '.png', 6, None),
+            ('png level 9', '.png', 9, None),
+            ('tiff (uncompressed)', '.tif', None, None),
+            ('npy', '.npy', None, None)]
+
+def encode(img, ext, pngLevel, pngStrategy):
+    """
+    Encode img as writeImage would write it to a file with extension
+    ext. Returns the encoded size in bytes. Raises IOError if cv2 can't
+    encode it.
+    """
+    if ext == '.npy':
+        buf = StringIO.StringIO()
+        numpy.save(buf, img)
+        return len(buf.getvalue())
+    params = straightener.encoderParams('x' + ext, pngLevel, pngStrategy)
+    ok, data = cv2.imencode(ext, img, params)
+    if not ok:
+        raise IOError("Could not encode image as {0}".format(ext))
+    return data.size
+
+def bench(imgs, repeat):
+    """
+    Returns a list of (name, mean seconds, mean bytes) per encoder.
+    """
+    rows = []
+    for name, ext, pngLevel, pngStrategy in ENCODERS:
+        elapsed = 0.0
+        size = 0
+        for img in imgs:
+            t = time.time()
+            for i in range(repeat):
+                size += encode(img, ext, pngLevel, pngStrategy)
+            elapsed += time.time() - t
+        n = float(len(imgs) * repeat)
+        rows.append((name, elapsed / n, size / n))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the output encoders.')
+    parser.add_argument("-n", "--repeat", dest="repeat", default=3, type=int,
+                        help="Number of times to encode each image")
+    parser.add_argument("--grayscale", action="store_true",
+                        help="Encode the images as grayscale (single-channel)")
+    parser.add_argument("images", nargs='+', help="Images to encode")
+    args = parser.parse_args()
+
+    flags = cv2.IMREAD_GRAYSCALE if args.grayscale else cv2.IMREAD_COLOR
+    imgs = [straightener.loadImage(path, flags) for path in args.images]
+    print "{0} image(s), {1}x{2}, {3} channel(s)".format(
+        len(imgs), imgs[0].shape[1], imgs[0].shape[0], 1 if args.grayscale else 3)
+
+    rows = bench(imgs, args.repeat)
+    baseline = rows[0][2]
+    print "{0:<26} {1:>10} {2:>10} {3:>8}".format("encoder", "ms/image", "KB/image", "size")
+    for name, elapsed, size in rows:
+        print "{0:<26} {1:>10.1f} {2:>10.0f} {3:>7.2f}x".format(
+            name, elapsed * 1000, size / 1024, size / baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+import sys, os, time, argparse, json, math, shutil, tempfile, platform, multiprocessing
+import numpy, cv2
+
+import straightener, batch_straightener
+
+"""
+Benchmark the rotation detection and straightening on synthetic
+ballot-like pages with known rotations, at the sizes of the counties'
+ballots. For each size, it measures the throughput and the angle error
+of the Hough kernel alone, of the single image path (straighten_array,
+with the time spent in each stage) and of the batch path
+(batch_straightener, on a temporary directory of PNGs), and writes them
+all to a JSON report. Given the report of an earlier run (--compare), it
+prints the changes, and exits with status 1 if anything got slower or
+less accurate by more than the tolerances.
+It also has checks, which exit with status 1 when they fail: grayscale
+checks the --grayscale output against the old conversion, see
+checkGrayscale, restrict the angles of the restricted second pass
+against the full one, see checkRestrict, and parity the lines found by
+the fixed-point voting kernel against the float one, see checkParity.
+"""
+
+# (WIDTH, HEIGHT) of the ballots of each county, from batch_straightener.py
+COUNTY_SIZES = {'madera': (652, 1480),
+                'napa': (1968, 3530),
+                'orange': (1715, 2847),
+                'marin': (1280, 2104),
+                'slo11': (1700, 2200),
+                'santacruz': (2400, 3840),
+                'yolo': (1744, 2878)}
+
+# A detected angle further than ANGLE_TOLERANCE degrees from the truth
+# counts as a miss.
+ANGLE_TOLERANCE = 0.1
+# --compare flags a throughput drop larger than SPEED_TOLERANCE (a
+# fraction), and a mean angle error larger by more than ERROR_TOLERANCE
+# degrees.
+SPEED_TOLERANCE = 0.10
+ERROR_TOLERANCE = 0.01
+# The paths of --paths that are checks rather than benchmarks.
+CHECKS = ('grayscale', 'restrict', 'parity')
+# The grayscale check fails if a --grayscale output pixel is more than
+# GRAY_TOLERANCE levels (the rounding of the warp) from the output of the
+# old CV_RGB2GRAY conversion, see checkGrayscale.
+GRAY_TOLERANCE = 1
+# Amplitude of the color noise added to the pages of the grayscale
+# check, as a color scanner gives on a gray page. More would lift the
+# black border above straightener.THRESHOLD in some channels, and move
+# the border.
+CHROMA_NOISE = 1
+# The restrict check fails if the angle found by the restricted second
+# pass is more than RESTRICT_TOLERANCE degrees (two steps of the pass)
+# from that of the full pass.
+RESTRICT_TOLERANCE = 0.02
+# The numbers of threads the parity check runs the kernels with.
+PARITY_THREADS = (1, 3)
+
+def synthBallot(width, height, angle, seed, noise=0.002, border=True):
+    """
+    Return a grayscale ballot-like page of the given size, rotated by
+    angle degrees (the angle detectRotation should find), as a scanner
+    would produce it: columns of contest boxes holding lines of text and
+    voting targets, speckle noise (a fraction noise of the pixels), and
+    if border is True, the black background of the scanner around the
+    rotated page and along some of its edges.
+    """
+    rs = numpy.random.RandomState(seed)
+    page = numpy.full((height, width), 255, numpy.uint8)
+    scale = width / 1700.0
+    margin = int(80 * scale)
+    thick = max(1, int(round(3 * scale)))
+    cv2.rectangle(page, (margin, margin), (width - margin, height - margin), 0, thick)
+
+    columns = 3
+    colWidth = (width - 2 * margin) // columns
+    rowHeight = max(12, int(36 * scale))
+    top = margin + int(160 * scale)
+    cv2.line(page, (margin, top), (width - margin, top), 0, thick)
+    for c in range(columns):
+        x0 = margin + c * colWidth
+        if c:
+            cv2.line(page, (x0, top), (x0, height - margin), 0, thick)
+        y = top
+        while True:
+            rows = rs.randint(3, 8)
+            bottom = y + (rows + 2) * rowHeight
+            if bottom > height - margin:
+                break
+            # Contest heading, then one candidate per row with its target
+            for r in range(rows + 1):
+                ty = y + (r + 1) * rowHeight - rowHeight // 4
+                tx = x0 + int((80 if r else 20) * scale)
+                words = rs.randint(1, 4)
+                for w in range(words):
+                    length = rs.randint(3, 10)
+                    cv2.putText(page, 'x' * length, (tx, ty), cv2.FONT_HERSHEY_SIMPLEX,
+                                0.5 * scale, 0, max(1, thick // 2))
+                    tx += int((length * 12 + 10) * scale)
+                if r:
+                    center = (x0 + int(40 * scale), ty - rowHeight // 4)
+                    axes = (int(14 * scale), int(7 * scale))
+                    cv2.ellipse(page, center, axes, 0, 0, 360, 0, max(1, thick // 2))
+            y = bottom
+            cv2.line(page, (x0, y), (x0 + colWidth, y), 0, thick)
+
+    M = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), angle, 1.0)
+    page = cv2.warpAffine(page, M, (width, height), flags=cv2.INTER_LINEAR,
+                          borderValue=0 if border else 255)
+    if border:
+        for edge in rs.permutation(4)[:rs.randint(1, 4)]:
+            size = rs.randint(5, max(6, int(40 * scale)))
+            if edge == 0:
+                page[:size] = 0
+            elif edge == 1:
+                page[-size:] = 0
+            elif edge == 2:
+                page[:, :size] = 0
+            else:
+                page[:, -size:] = 0
+    if noise:
+        speckles = rs.random_sample(page.shape) < noise
+        page[speckles] = 255 - page[speckles]
+    return page
+
+def makePages(width, height, count, maxAngle, seed, noise, border):
+    """
+    Returns a list of count (page, angle) pairs, with angles spread
+    uniformly within maxAngle - 1 degrees of 0.
+    """
+    rs = numpy.random.RandomState(seed)
+    spread = max(maxAngle - 1.0, 0.5)
+    pages = []
+    for i in range(count):
+        angle = float(rs.uniform(-spread, spread))
+        pages.append((synthBallot(width, height, angle, seed + i, noise, border), angle))
+    return pages
+
+def errorStats(errors):
+    """
+    Summarize a list of absolute angle errors (in degrees).
+    """
+    errors = sorted(errors)
+    return {'mean': sum(errors) / len(errors),
+            'p95': batch_straightener.percentile(errors, 95),
+            'max': errors[-1],
+            'misses': sum(1 for error in errors if error > ANGLE_TOLERANCE)}
+
+def benchKernel(pages, resize, maxAngle, repeat):
+    """
+    Time the first pass Hough transform alone (straightener.houghLines),
+    on binary thumbnails prepared beforehand.
+    """
+    binaries = []
+    for page, angle in pages:
+        image = straightener.cropForDetection(page, maxAngle)
+        binaries.append(straightener.makeBinary(straightener.makeThumbnail(image, resize)))
+    t = time.time()
+    for i in range(repeat):
+        for binary in binaries:
+            straightener.houghLines(binary, 1, straightener.PASS1_THETA, maxAngle, 0.0)
+    elapsed = time.time() - t
+    return {'images_per_sec': len(binaries) * repeat / elapsed}
+
+def benchSingle(pages, resize, maxAngle, imgsize):
+    """
+    Straighten each page with straighten_array, recording the time spent
+    in each stage (see straightener.startStats) and the angle error.
+    """
+    stagetimes = {}
+    errors = []
+    t = time.time()
+    for page, angle in pages:
+        stats = straightener.startStats()
+        img, (angle1, angle2, confidence) = straightener.straighten_array(
+            page, resize, maxAngle, imgsize)
+        straightener.stopStats()
+        errors.append(abs(angle2 - angle))
+        for stage, seconds in stats['times'].iteritems():
+            stagetimes.setdefault(stage, []).append(seconds)
+    elapsed = time.time() - t
+    stages = {}
+    for stage, times in stagetimes.iteritems():
+        times.sort()
+        stages[stage] = {'mean': sum(times) / len(times),
+                         'p95': batch_straightener.percentile(times, 95),
+                         'images_per_sec': len(times) / sum(times) if sum(times) else None}
+    return {'images_per_sec': len(pages) / elapsed,
+            'angle_error': errorStats(errors),
+            'stages': stages}
+
+def benchBatch(pages, resize, maxAngle, imgsize, procs):
+    """
+    Write the pages to a temporary directory as PNGs, and straighten them
+    with batch_straightener, reading the detected angles back from its
+    journal.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='straightener_bench')
+    try:
+        imgsdir = os.path.join(tmpdir, 'in')
+        outdir = os.path.join(tmpdir, 'out')
+        os.makedirs(imgsdir)
+        truth = {}
+        for i, (page, angle) in enumerate(pages):
+            name = 'page{0:04d}.png'.format(i)
+            cv2.imwrite(os.path.join(imgsdir, name), page)
+            truth[name] = angle
+        t = time.time()
+        # A single shard, so that the errors log also goes into outdir
+        batch_straightener.start_straightening(imgsdir, outdir, resize, maxAngle,
+                                               False, False, False, imgsize=imgsize,
+                                               procs=procs, shard=(0, 1))
+        elapsed = time.time() - t
+        records = batch_straightener.load_journal(outdir, (0, 1))
+    finally:
+        shutil.rmtree(tmpdir)
+    errors = [abs(record['angle2'] - truth[rel]) for rel, record in records.iteritems()
+              if record['status'] == 'ok']
+    return {'images_per_sec': len(pages) / elapsed,
+            'failed': len(pages) - len(errors),
+            'angle_error': errorStats(errors) if errors else None}
+
+def checkGrayscale(pages, resize, maxAngle, imgsize, seed):
+    """
+    Save each page as a color PNG, with CHROMA_NOISE, and straighten it
+    with straighten_image and grayscale, which decodes it as a single
+    channel. The check fails on a page whose output is further than
+    GRAY_TOLERANCE from the grayscale output as it was made before:
+    the rotation detected on the decoder's grayscale image, the border
+    found on the color image, and the straightened color image
+    converted with CV_RGB2GRAY.
+    """
+    rs = numpy.random.RandomState(seed)
+    tmpdir = tempfile.mkdtemp(prefix='straightener_bench')
+    diffs = []
+    try:
+        imgpath = os.path.join(tmpdir, 'page.png')
+        outpath = os.path.join(tmpdir, 'gray.png')
+        for page, angle in pages:
+            noise = rs.randint(-CHROMA_NOISE, CHROMA_NOISE + 1, page.shape + (3,))
+            color = numpy.clip(cv2.cvtColor(page, cv2.COLOR_GRAY2BGR) + noise, 0, 255)
+            cv2.imwrite(imgpath, color.astype(numpy.uint8))
+            straightener.straighten_image(imgpath, outpath, resize, maxAngle, imgsize,
+                                          grayscale=True)
+            color = cv2.imread(imgpath)
+            angle2 = straightener.detect_array(cv2.imread(imgpath, cv2.IMREAD_GRAYSCALE),
+                                               resize, maxAngle)[1]
+            box = straightener.findBorderRotated(color, angle2)
+            old = cv2.cvtColor(straightener.warpToOutput(color, angle2, box, imgsize),
+                               cv2.COLOR_RGB2GRAY)
+            new = cv2.imread(outpath, cv2.IMREAD_UNCHANGED)
+            diffs.append(int(numpy.abs(old.astype(int) - new).max()))
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'max_diff': max(diffs),
+            'failures': sum(1 for diff in diffs if diff > GRAY_TOLERANCE)}
+
+def checkRestrict(pages, resize, maxAngle):
+    """
+    Detect the rotation of each page with the second pass restricted to
+    the pixels near the first pass' lines, whatever the size of the page
+    (see straightener.RESTRICT_MIN_FOREGROUND), and with the full second
+    pass. The check fails on a page whose angles differ by more than
+    RESTRICT_TOLERANCE.
+    """
+    minForeground = straightener.RESTRICT_MIN_FOREGROUND
+    straightener.RESTRICT_MIN_FOREGROUND = 0
+    diffs = []
+    try:
+        for page, angle in pages:
+            restricted = straightener.detectRotationArray(page, resize, maxAngle,
+                                                          restrict=True)[1]
+            full = straightener.detectRotationArray(page, resize, maxAngle, restrict=False)[1]
+            diffs.append(abs(restricted - full))
+    finally:
+        straightener.RESTRICT_MIN_FOREGROUND = minForeground
+    return {'max_diff': max(diffs), 'differ': sum(1 for diff in diffs if diff),
+            'failures': sum(1 for diff in diffs if diff > RESTRICT_TOLERANCE)}
+
+def checkParity(pages, resize, maxAngle):
+    """
+    Run the first and the second pass Hough transforms
+    (straightener.houghLines) on the binary thumbnail of each page with
+    the float and the fixed voting kernel, with each of PARITY_THREADS.
+    The second pass is shifted by the first pass angle of the page. The
+    check fails on a transform whose lines (rhos, thetas and votes)
+    aren't identical with both kernels.
+    """
+    kernel = straightener.HOUGH_KERNEL
+    transforms = failures = 0
+    try:
+        for page, angle in pages:
+            angle1 = straightener.detectRotationArray(page, resize, maxAngle)[0]
+            image = straightener.cropForDetection(page, maxAngle)
+            binary = straightener.makeBinary(straightener.makeThumbnail(image, resize))
+            for theta, window, guess in ((straightener.PASS1_THETA, maxAngle, 0.0),
+                                         (straightener.PASS2_THETA, straightener.PASS2_WINDOW,
+                                          angle1)):
+                for threads in PARITY_THREADS:
+                    lines = []
+                    for name in ('float', 'fixed'):
+                        straightener.HOUGH_KERNEL = name
+                        lines.append(straightener.houghLines(binary, 1, theta, window, guess,
+                                                             threads))
+                    transforms += 1
+                    if not all(numpy.array_equal(a, b) for a, b in zip(*lines)):
+                        failures += 1
+    finally:
+        straightener.HOUGH_KERNEL = kernel
+    return {'transforms': transforms, 'failures': failures}
+
+def run(args):
+    """
+    Run the benchmarks selected by args. Returns the report.
+    """
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': numpy.__version__,
+                       'opencv': cv2.__version__,
+                       'machine': platform.machine(),
+                       'cpus': multiprocessing.cpu_count(),
+                       'hough_backend': straightener.houghBackend()},
+              'params': {'count': args.count, 'seed': args.seed, 'resize': args.resize,
+                         'maxAngle': args.maxAngle, 'noise': args.noise,
+                         'border': not args.no_border, 'procs': args.procs,
+                         'kernel': args.kernel},
+              'results': {}}
+    for county in args.sizes:
+        width, height = COUNTY_SIZES[county]
+        print "{0} ({1}x{2}): generating {3} pages...".format(county, width, height, args.count)
+        pages = makePages(width, height, args.count, args.maxAngle, args.seed, args.noise,
+                          not args.no_border)
+        result = {}
+        if 'kernel' in args.paths:
+            result['kernel'] = benchKernel(pages, args.resize, args.maxAngle, args.repeat)
+        if 'single' in args.paths:
+            result['single'] = benchSingle(pages, args.resize, args.maxAngle, (width, height))
+        if 'batch' in args.paths:
+            result['batch'] = benchBatch(pages, args.resize, args.maxAngle, (width, height),
+                                         args.procs)
+        if 'grayscale' in args.paths:
+            result['grayscale'] = checkGrayscale(pages, args.resize, args.maxAngle,
+                                                 (width, height), args.seed)
+        if 'restrict' in args.paths:
+            result['restrict'] = checkRestrict(pages, args.resize, args.maxAngle)
+        if 'parity' in args.paths:
+            result['parity'] = checkParity(pages, args.resize, args.maxAngle)
+        report['results'][county] = result
+        printResult(county, result)
+    return report
+
+def printResult(county, result):
+    for path in ('kernel', 'single', 'batch'):
+        if path not in result:
+            continue
+        line = "  {0:<7} {1:>8.2f} images/s".format(path, result[path]['images_per_sec'])
+        error = result[path].get('angle_error')
+        if error:
+            line += ", angle error mean {0:.4f} p95 {1:.4f} max {2:.4f}, {3} miss(es)".format(
+                error['mean'], error['p95'], error['max'], error['misses'])
+        print line
+    if 'single' in result:
+        stages = result['single']['stages']
+        print "  " + ", ".join("{0} {1:.1f} ms".format(stage, 1000 * stages[stage]['mean'])
+                               for stage in straightener.STAGES if stage in stages)
+    if 'grayscale' in result:
+        check = result['grayscale']
+        print "  grayscale: max {0} level(s) from the CV_RGB2GRAY output, {1} failure(s)".format(
+            check['max_diff'], check['failures'])
+    if 'restrict' in result:
+        check = result['restrict']
+        print "  restrict: {0} page(s) differ from the full second pass, by at most " \
+            "{1:.4f} degrees, {2} failure(s)".format(check['differ'], check['max_diff'],
+                                                     check['failures'])
+    if 'parity' in result:
+        check = result['parity']
+        print "  parity: {0} transform(s) with the float and fixed kernels, {1} failure(s)".format(
+            check['transforms'], check['failures'])
+
+def checkFailures(report):
+    """
+    The number of pages that failed a check in report.
+    """
+    return sum(result[check]['failures'] for result in report['results'].itervalues()
+               for check in CHECKS if check in result)
+
+def compare(old, new):
+    """
+    Print how each throughput and mean angle error in the report new
+    changed from the report old. Returns the number of regressions.
+    """
+    regressions = 0
+    for county in sorted(new['results']):
+        for path, result in sorted(new['results'][county].iteritems()):
+            before = old['results'].get(county, {}).get(path)
+            if before is None or path in CHECKS:
+                continue
+            speed = result['images_per_sec'] / before['images_per_sec'] - 1.0
+            flag = ''
+            if speed < -SPEED_TOLERANCE:
+                flag = '  SLOWER'
+                regressions += 1
+            print "{0:<10} {1:<7} {2:>8.2f} -> {3:>8.2f} images/s ({4:+.1%}){5}".format(
+                county, path, before['images_per_sec'], result['images_per_sec'], speed, flag)
+            if before.get('angle_error') and result.get('angle_error'):
+                was, now = before['angle_error']['mean'], result['angle_error']['mean']
+                flag = ''
+                if now - was > ERROR_TOLERANCE:
+                    flag = '  LESS ACCURATE'
+                    regressions += 1
+                print "{0:<10} {1:<7} {2:>8.4f} -> {3:>8.4f} mean angle error{4}".format(
+                    county, path, was, now, flag)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the straightening on synthetic ballots.')
+    parser.add_argument("--sizes", dest="sizes", default=','.join(sorted(COUNTY_SIZES)),
+                        help="Comma separated counties whose ballot sizes to use, from {0} \
+(default: all)".format(', '.join(sorted(COUNTY_SIZES))))
+    parser.add_argument("--paths", dest="paths", default="kernel,single,batch",
+                        help="Comma separated paths to benchmark: kernel, single, batch, \
+and checks to run: {0} (default: %(default)s)".format(', '.join(CHECKS)))
+    parser.add_argument("-n", "--count", dest="count", default=8, type=int,
+                        help="Number of pages per size (default: %(default)s)")
+    parser.add_argument("--repeat", dest="repeat", default=3, type=int,
+                        help="Number of times the kernel is run on each page (default: %(default)s)")
+    parser.add_argument("--seed", dest="seed", default=0, type=int,
+                        help="Seed of the pages and their rotations (default: %(default)s)")
+    parser.add_argument("-r", "--resize-factor", dest="resize", default=2.0, type=float,
+                        help="Shrinking factor (default: %(default)s)")
+    parser.add_argument("-m", "--max-angle", dest="maxAngle", default=4.0, type=float,
+                        help="Maximum angle searched for (default: %(default)s)")
+    parser.add_argument("--noise", dest="noise", default=0.002, type=float,
+                        help="Fraction of the pixels flipped (default: %(default)s)")
+    parser.add_argument("--no-border", action="store_true", dest="no_border", default=False,
+                        help="Leave out the black scanner border")
+    parser.add_argument("-j", "--procs", dest="procs", default=None, type=int,
+                        help="Number of worker processes of the batch path (default: one per CPU)")
+    parser.add_argument("--kernel", dest="kernel", default=None, choices=('float', 'fixed'),
+                        help="Hough voting kernel to use (default: straightener.HOUGH_KERNEL)")
+    parser.add_argument("--hough-backend", dest="backend", default=None,
+                        choices=list(straightener.HOUGH_BACKENDS),
+                        help="Hough transform backend (default: the first available of %(choices)s)")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="Write the report to this JSON file")
+    parser.add_argument("--compare", dest="compare", default=None, metavar="REPORT",
+                        help="Compare with the report of an earlier run, and exit with status 1 \
+on a regression")
+    args = parser.parse_args()
+    args.sizes = args.sizes.split(',')
+    args.paths = args.paths.split(',')
+    for county in args.sizes:
+        if county not in COUNTY_SIZES:
+            parser.error("unknown county: {0}".format(county))
+    # Set before the batch workers are forked, so they use them too
+    if args.kernel:
+        straightener.HOUGH_KERNEL = args.kernel
+    if args.backend:
+        straightener.setHoughBackend(args.backend)
+
+    report = run(args)
+    if args.output:
+        f = open(args.output, 'w')
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+    failures = checkFailures(report)
+    if failures:
+        print "{0} check failure(s)".format(failures)
+    regressions = 0
+    if args.compare:
+        f = open(args.compare)
+        old = json.load(f)
+        f.close()
+        regressions = compare(old, report)
+        if regressions:
+            print "{0} regression(s)".format(regressions)
+    if failures or regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
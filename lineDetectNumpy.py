@@ -0,0 +1,208 @@
+import math, threading
+import numpy
+
+"""
+A pure NumPy implementation of the lineDetect extension (see
+lineDetectmodule.c), for when it is not built: findLines and HoughPlan
+take the same arguments and return the same lines. The angle tables are
+computed and rounded as by planInit, and the votes are cast with exact
+integer arithmetic, so the votes, and thus the lines, are identical to
+those of either C kernel. The votes are added up with numpy.bincount,
+a block of foreground pixels by a group of angles at a time, sized so
+that the temporaries stay in the CPU caches.
+
+sparse, threads and kernel are accepted for compatibility: the votes are
+always cast from the foreground pixels only, on the calling thread.
+"""
+
+# The voting kernels of lineDetect. Both give the same votes here.
+KERNEL_FLOAT = 0
+KERNEL_FIXED = 1
+
+# Fractional bits of the fixed point sin/cos tables, as in lineDetect.
+FIX_BITS = 32
+# The votes are computed for VOTE_PIXELS foreground pixels by VOTE_ANGLES
+# angles at a time.
+VOTE_PIXELS = 2048
+VOTE_ANGLES = 32
+
+class error(Exception):
+    pass
+
+def findLines(binaryMap, rho, theta, threshold, window, adjustment, sparse=0, threads=1,
+              topK=0, kernel=KERNEL_FLOAT):
+    """
+    Find the lines within window (radians) of the vertical/horizontal,
+    shifted by adjustment, in the inverted binary map binaryMap. Returns
+    the arrays (rhos, thetas, votes) of the lines with more than
+    threshold votes, sorted by decreasing votes, and limited to the topK
+    best lines if topK is positive.
+    """
+    binaryMap = _checkMap(binaryMap, threads, kernel)
+    plan = HoughPlan(binaryMap.shape, rho, theta, window, adjustment)
+    return plan.run(binaryMap, threshold, sparse, threads, topK, kernel)
+
+def _checkMap(binaryMap, threads, kernel):
+    binaryMap = numpy.asarray(binaryMap)
+    if binaryMap.ndim != 2:
+        raise ValueError("binaryMap must be a 2d array.")
+    if threads < 1:
+        raise ValueError("threads must be at least 1.")
+    if kernel not in (KERNEL_FLOAT, KERNEL_FIXED):
+        raise ValueError("kernel must be KERNEL_FLOAT or KERNEL_FIXED.")
+    return binaryMap
+
+def _angles(theta, window, adjustment):
+    """
+    The angles searched, as float32, computed as by planInit (in single
+    precision where it is, so that they come out the same).
+    """
+    f = numpy.float32
+    theta, window, adjustment = f(theta), f(window), f(-adjustment)
+    if adjustment < 0:
+        topPoint = f(math.pi + adjustment)
+        topStart = topPoint - window
+        topEnd = f(min(math.pi, topPoint + window))
+        bottomStart = f(0)
+        bottomEnd = f(max(0.0, float(topPoint + window) - math.pi))
+    else:
+        bottomPoint = adjustment
+        bottomStart = max(f(0), bottomPoint - window)
+        bottomEnd = bottomPoint + window
+        topEnd = f(math.pi)
+        topStart = f(min(math.pi, math.pi + (bottomPoint - window)))
+    topWindow = topEnd - topStart
+    bottomWindow = bottomEnd - bottomStart
+    midPoint = f(math.pi / 2 + adjustment)
+
+    angles = []
+    for start, step, count in ((bottomStart, theta, bottomWindow / theta),
+                               (midPoint, -theta, window / theta),
+                               (midPoint, theta, window / theta),
+                               (topEnd, -theta, topWindow / theta)):
+        ang = start
+        for n in range(int(math.ceil(count))):
+            angles.append(ang)
+            ang = f(ang + step)
+    return numpy.array(angles, dtype=numpy.float32)
+
+class HoughPlan(object):
+    """
+    HoughPlan((rows, cols), rho, theta, window, adjustment)
+
+    The angle tables and accumulator for running findLines repeatedly on
+    binary maps of one shape, see lineDetect.HoughPlan. A map can also be
+    fed a strip of rows at a time, with reset, accumulate and peaks.
+    """
+    def __init__(self, shape, rho, theta, window, adjustment):
+        rows, cols = [int(n) for n in shape]
+        if rows <= 0 or cols <= 0:
+            raise ValueError("shape must be positive.")
+        if rho <= 0 or theta <= 0:
+            raise ValueError("rho and theta must be positive.")
+        f = numpy.float32
+        self.rows, self.cols = rows, cols
+        self.rho, self.theta = float(f(rho)), float(f(theta))
+        self.window, self.adjustment = float(f(window)), float(f(adjustment))
+        self.angles = _angles(theta, window, adjustment)
+        self.numangle = len(self.angles)
+        self.numrho = int(math.ceil(f((cols + rows) * 2 + 1) / f(rho)))
+        irho = float(f(1) / f(rho))
+        # with the C library's sin and cos, as planInit
+        sins = numpy.array([math.sin(ang) * irho for ang in self.angles.tolist()])
+        coss = numpy.array([math.cos(ang) * irho for ang in self.angles.tolist()])
+        self.fixSin = numpy.rint(numpy.ldexp(sins, FIX_BITS)).astype(numpy.int64)
+        self.fixCos = numpy.rint(numpy.ldexp(coss, FIX_BITS)).astype(numpy.int64)
+        # rho >> FIX_BITS of a vote is its column in the accumulator row of
+        # its angle, see fillAccumDenseFixed
+        self.origin = (((self.numrho - 1) // 2 + 1) << FIX_BITS) + (1 << (FIX_BITS - 1))
+        self.accum = numpy.zeros((self.numangle + 2) * (self.numrho + 2), dtype=numpy.int64)
+        self.lock = threading.Lock()
+
+    def run(self, binaryMap, threshold, sparse=0, threads=1, topK=0, kernel=KERNEL_FLOAT):
+        """
+        run(binaryMap, threshold, sparse=0, threads=1, topK=0, kernel=KERNEL_FLOAT)
+            -> (rhos, thetas, votes)
+        """
+        binaryMap = _checkMap(binaryMap, threads, kernel)
+        if binaryMap.shape != (self.rows, self.cols):
+            raise ValueError("binaryMap has shape ({0}, {1}), the plan expects ({2}, {3}).".format(
+                binaryMap.shape[0], binaryMap.shape[1], self.rows, self.cols))
+        with self.lock:
+            self.accum[:] = 0
+            self._vote(binaryMap, 0)
+            return self._peaks(threshold, topK)
+
+    def reset(self):
+        """
+        Clear the votes accumulated so far.
+        """
+        with self.lock:
+            self.accum[:] = 0
+
+    def accumulate(self, strip, row, sparse=0, threads=1, kernel=KERNEL_FLOAT):
+        """
+        Add the votes of strip, the rows of the binary map starting at row.
+        """
+        strip = _checkMap(strip, threads, kernel)
+        if strip.shape[1] != self.cols:
+            raise ValueError("strip has {0} columns, the plan expects {1}.".format(
+                strip.shape[1], self.cols))
+        if row < 0 or row + strip.shape[0] > self.rows:
+            raise ValueError("rows {0} to {1} of the strip are outside of the {2} rows of "
+                             "the plan.".format(row, row + strip.shape[0], self.rows))
+        with self.lock:
+            self._vote(strip, row)
+
+    def peaks(self, threshold, topK=0):
+        """
+        peaks(threshold, topK=0) -> (rhos, thetas, votes)
+
+        Find the lines in the votes accumulated since the last reset.
+        """
+        with self.lock:
+            return self._peaks(threshold, topK)
+
+    def _vote(self, img, rowOffset):
+        ys, xs = numpy.nonzero(img)
+        if not len(ys):
+            return
+        width = self.numrho + 2
+        accum = self.accum.reshape(self.numangle + 2, width)
+        rows = numpy.arange(rowOffset, rowOffset + img.shape[0], dtype=numpy.int64)
+        cols = numpy.arange(img.shape[1], dtype=numpy.int64)
+        for first in range(0, self.numangle, VOTE_ANGLES):
+            fixSin = self.fixSin[first:first + VOTE_ANGLES]
+            fixCos = self.fixCos[first:first + VOTE_ANGLES]
+            count = len(fixSin)
+            # the rho terms of each row and column, and the start of the
+            # accumulator row of each angle, relative to that of the first
+            rowTerms = numpy.multiply.outer(rows, fixSin) + self.origin
+            colTerms = numpy.multiply.outer(cols, fixCos)
+            base = numpy.arange(count, dtype=numpy.int64) * width
+            votes = numpy.zeros(count * width, dtype=numpy.int64)
+            for start in range(0, len(ys), VOTE_PIXELS):
+                rho = rowTerms[ys[start:start + VOTE_PIXELS]]
+                rho += colTerms[xs[start:start + VOTE_PIXELS]]
+                rho >>= FIX_BITS
+                rho += base
+                votes += numpy.bincount(rho.ravel(), minlength=count * width)
+            accum[first + 1:first + 1 + count] += votes.reshape(count, width)
+
+    def _peaks(self, threshold, topK):
+        numrho = self.numrho
+        accum = self.accum.reshape(self.numangle + 2, numrho + 2)
+        votes = accum[1:-1, 1:-1]
+        isPeak = ((votes > threshold) &
+                  (votes > accum[1:-1, :-2]) & (votes >= accum[1:-1, 2:]) &
+                  (votes > accum[:-2, 1:-1]) & (votes >= accum[2:, 1:-1]))
+        n, r = numpy.nonzero(isPeak)
+        votes = votes[n, r]
+        # most votes first, ties by accumulator position, as sortPeaks
+        order = numpy.lexsort(((n + 1) * (numrho + 2) + r + 1, -votes))
+        if topK > 0:
+            order = order[:topK]
+        n, r, votes = n[order], r[order], votes[order]
+        f = numpy.float32
+        rhos = (r.astype(numpy.float32) - f(numrho - 1) * f(0.5)) * f(self.rho)
+        return (rhos.astype(numpy.float32), self.angles[n], votes.astype(numpy.int32))
@@ -47,38 +47,138 @@
 //M*/
 
 #include <Python.h>
+#include <structmember.h>
+#include <pythread.h>
 #include <numpy/arrayobject.h>
 #include "lineDetectmodule.h"
 #include <math.h>
+#include <pthread.h>
 
 static PyObject *LineDetectError;
 
 static PyMethodDef LineDetectMethods[] = {
-    {"findLines", (PyCFunction)lineDetect_findLines,  METH_VARARGS,
-        PyDoc_STR("findLines(binaryMap, rho, theta, threshold, window, adjustment) -> [(rho, theta),...]")},
+    {"findLines", (PyCFunction)lineDetect_findLines,  METH_VARARGS | METH_KEYWORDS,
+        PyDoc_STR("findLines(binaryMap, rho, theta, threshold, window, adjustment, sparse=0, threads=1, topK=0, kernel=KERNEL_FLOAT) -> (rhos, thetas, votes)")},
     {NULL,              NULL}           /* sentinel */
 };
 
-static PyObject* lineDetect_findLines(PyObject *self, PyObject *args) {
+static PyMethodDef HoughPlanMethods[] = {
+    {"run", (PyCFunction)HoughPlan_run, METH_VARARGS | METH_KEYWORDS,
+        PyDoc_STR("run(binaryMap, threshold, sparse=0, threads=1, topK=0, kernel=KERNEL_FLOAT) -> (rhos, thetas, votes)")},
+    {"reset", (PyCFunction)HoughPlan_reset, METH_NOARGS,
+        PyDoc_STR("reset()\n\nClear the votes accumulated so far.")},
+    {"accumulate", (PyCFunction)HoughPlan_accumulate, METH_VARARGS | METH_KEYWORDS,
+        PyDoc_STR("accumulate(strip, row, sparse=0, threads=1, kernel=KERNEL_FLOAT)\n\n"
+                  "Add the votes of strip, the rows of the binary map starting at row.")},
+    {"peaks", (PyCFunction)HoughPlan_peaks, METH_VARARGS | METH_KEYWORDS,
+        PyDoc_STR("peaks(threshold, topK=0) -> (rhos, thetas, votes)\n\n"
+                  "Find the lines in the votes accumulated since the last reset.")},
+    {NULL,              NULL}           /* sentinel */
+};
+
+static PyMemberDef HoughPlanMembers[] = {
+    {"rows", T_INT, offsetof(HoughPlanObject, plan.rows), READONLY, NULL},
+    {"cols", T_INT, offsetof(HoughPlanObject, plan.cols), READONLY, NULL},
+    {"rho", T_FLOAT, offsetof(HoughPlanObject, plan.rho), READONLY, NULL},
+    {"theta", T_FLOAT, offsetof(HoughPlanObject, plan.theta), READONLY, NULL},
+    {"window", T_FLOAT, offsetof(HoughPlanObject, plan.window), READONLY, NULL},
+    {"adjustment", T_FLOAT, offsetof(HoughPlanObject, plan.adjustment), READONLY, NULL},
+    {"numangle", T_INT, offsetof(HoughPlanObject, plan.numangle), READONLY, NULL},
+    {"numrho", T_INT, offsetof(HoughPlanObject, plan.numrho), READONLY, NULL},
+    {NULL}                                  /* sentinel */
+};
+
+static PyTypeObject HoughPlanType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                                      /* ob_size */
+    "lineDetect.HoughPlan",                 /* tp_name */
+    sizeof(HoughPlanObject),                /* tp_basicsize */
+    0,                                      /* tp_itemsize */
+    (destructor)HoughPlan_dealloc,          /* tp_dealloc */
+    0,                                      /* tp_print */
+    0,                                      /* tp_getattr */
+    0,                                      /* tp_setattr */
+    0,                                      /* tp_compare */
+    0,                                      /* tp_repr */
+    0,                                      /* tp_as_number */
+    0,                                      /* tp_as_sequence */
+    0,                                      /* tp_as_mapping */
+    0,                                      /* tp_hash */
+    0,                                      /* tp_call */
+    0,                                      /* tp_str */
+    0,                                      /* tp_getattro */
+    0,                                      /* tp_setattro */
+    0,                                      /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                     /* tp_flags */
+    PyDoc_STR("HoughPlan((rows, cols), rho, theta, window, adjustment)\n\n"
+              "Precomputed angle tables and accumulator buffers for running\n"
+              "findLines repeatedly on binary maps of one shape. A map can\n"
+              "also be fed a strip of rows at a time, with reset, accumulate\n"
+              "and peaks, so that it never has to be in memory as a whole.\n\n"
+              "The votes are cast by one of two kernels, which give identical\n"
+              "votes: KERNEL_FLOAT computes the rho of every (pixel, angle)\n"
+              "pair, KERNEL_FIXED walks along each row updating the rhos of\n"
+              "all the angles in fixed point."), /* tp_doc */
+    0,                                      /* tp_traverse */
+    0,                                      /* tp_clear */
+    0,                                      /* tp_richcompare */
+    0,                                      /* tp_weaklistoffset */
+    0,                                      /* tp_iter */
+    0,                                      /* tp_iternext */
+    HoughPlanMethods,                       /* tp_methods */
+    HoughPlanMembers,                       /* tp_members */
+    0,                                      /* tp_getset */
+    0,                                      /* tp_base */
+    0,                                      /* tp_dict */
+    0,                                      /* tp_descr_get */
+    0,                                      /* tp_descr_set */
+    0,                                      /* tp_dictoffset */
+    (initproc)HoughPlan_init,               /* tp_init */
+    0,                                      /* tp_alloc */
+    PyType_GenericNew,                      /* tp_new */
+};
+
+static PyObject* lineDetect_findLines(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"binaryMap", "rho", "theta", "threshold", "window",
+                             "adjustment", "sparse", "threads", "topK", "kernel", NULL};
     float rho, theta, window, adjustment;
     int threshold;
+    int sparse = 0;
+    int threads = 1;
+    int topK = 0;
+    int kernel = KERNEL_FLOAT;
     PyArrayObject *imgArray;
     PyObject *result;
-    CvMat *imgMat;
+    CvMat imgMat;
+    HoughPlan plan;
 
-    if (!PyArg_ParseTuple(args, "O!ffiff", &PyArray_Type, &imgArray, &rho, &theta,
-                          &threshold, &window, &adjustment)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!ffiff|iiii", kwlist,
+                                     &PyArray_Type, &imgArray, &rho, &theta,
+                                     &threshold, &window, &adjustment,
+                                     &sparse, &threads, &topK, &kernel)) {
+        return NULL;
+    }
+
+    if (checkRunArgs(imgArray, threads, kernel) == -1)
+        return NULL;
+    if (rho <= 0 || theta <= 0) {
+        PyErr_SetString(PyExc_ValueError, "rho and theta must be positive.");
         return NULL;
     }
 
     imgArray = (PyArrayObject*) PyArray_Cast(imgArray, NPY_UBYTE);
-    imgMat = (CvMat*) malloc(sizeof(CvMat));
-    imgMat->rows = imgArray->dimensions[0];
-    imgMat->cols = imgMat->step = imgArray->dimensions[1];
-    imgMat->data = (unsigned char*) imgArray->data;
+    if (imgArray == NULL)
+        return NULL;
+    imgMat.rows = imgArray->dimensions[0];
+    imgMat.cols = imgMat.step = imgArray->dimensions[1];
+    imgMat.data = (unsigned char*) imgArray->data;
 
-    result = houghTransform(imgMat, rho, theta, threshold, window, adjustment);
-    free(imgMat);
+    if (planInit(&plan, imgMat.rows, imgMat.cols, rho, theta, window, adjustment) == -1) {
+        Py_DECREF(imgArray);
+        return PyErr_NoMemory();
+    }
+    result = houghTransform(&plan, &imgMat, threshold, sparse, threads, topK, kernel);
+    planFree(&plan);
     /* According to this link, PyArray_Cast creates a new object:
      *    http://docs.scipy.org/doc/numpy/reference/c-api.array.html 
      * So, remember to decrement the refcount for imgArray so that it
@@ -89,40 +189,252 @@ static PyObject* lineDetect_findLines(PyObject *self, PyObject *args) {
 }
 
 /*
+ * Validate the arguments shared by findLines and HoughPlan.run.
+ * Returns -1 with an exception set if they are unusable, 0 otherwise.
+ */
+
+static int checkRunArgs(PyArrayObject *imgArray, int threads, int kernel) {
+    if (imgArray->nd != 2) {
+        PyErr_SetString(PyExc_ValueError, "binaryMap must be a 2d array.");
+        return -1;
+    }
+    if (threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be at least 1.");
+        return -1;
+    }
+    if (kernel != KERNEL_FLOAT && kernel != KERNEL_FIXED) {
+        PyErr_SetString(PyExc_ValueError, "kernel must be KERNEL_FLOAT or KERNEL_FIXED.");
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * HoughPlan
+ */
+
+static int HoughPlan_init(HoughPlanObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"shape", "rho", "theta", "window", "adjustment", NULL};
+    int rows, cols;
+    float rho, theta, window, adjustment;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "(ii)ffff", kwlist, &rows, &cols,
+                                     &rho, &theta, &window, &adjustment)) {
+        return -1;
+    }
+    if (rows <= 0 || cols <= 0) {
+        PyErr_SetString(PyExc_ValueError, "shape must be positive.");
+        return -1;
+    }
+    if (rho <= 0 || theta <= 0) {
+        PyErr_SetString(PyExc_ValueError, "rho and theta must be positive.");
+        return -1;
+    }
+
+    if (self->lock == NULL) {
+        self->lock = PyThread_allocate_lock();
+        if (self->lock == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+
+    planFree(&self->plan);
+    if (planInit(&self->plan, rows, cols, rho, theta, window, adjustment) == -1) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    return 0;
+}
+
+static void HoughPlan_dealloc(HoughPlanObject *self) {
+    planFree(&self->plan);
+    if (self->lock != NULL)
+        PyThread_free_lock(self->lock);
+    Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+static PyObject* HoughPlan_run(HoughPlanObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"binaryMap", "threshold", "sparse", "threads", "topK", "kernel", NULL};
+    int threshold;
+    int sparse = 0;
+    int threads = 1;
+    int topK = 0;
+    int kernel = KERNEL_FLOAT;
+    PyArrayObject *imgArray;
+    PyObject *result;
+    CvMat imgMat;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!i|iiii", kwlist,
+                                     &PyArray_Type, &imgArray, &threshold,
+                                     &sparse, &threads, &topK, &kernel)) {
+        return NULL;
+    }
+
+    if (self->plan.angles == NULL) {
+        PyErr_SetString(LineDetectError, "HoughPlan is not initialized.");
+        return NULL;
+    }
+    if (checkRunArgs(imgArray, threads, kernel) == -1)
+        return NULL;
+    if (imgArray->dimensions[0] != self->plan.rows || imgArray->dimensions[1] != self->plan.cols) {
+        PyErr_Format(PyExc_ValueError, "binaryMap has shape (%d, %d), the plan expects (%d, %d).",
+                     (int) imgArray->dimensions[0], (int) imgArray->dimensions[1],
+                     self->plan.rows, self->plan.cols);
+        return NULL;
+    }
+
+    imgArray = (PyArrayObject*) PyArray_Cast(imgArray, NPY_UBYTE);
+    if (imgArray == NULL)
+        return NULL;
+    imgMat.rows = imgArray->dimensions[0];
+    imgMat.cols = imgMat.step = imgArray->dimensions[1];
+    imgMat.data = (unsigned char*) imgArray->data;
+
+    lockPlan(self);
+    result = houghTransform(&self->plan, &imgMat, threshold, sparse, threads, topK, kernel);
+    PyThread_release_lock(self->lock);
+
+    Py_DECREF(imgArray);
+
+    return result;
+}
+
+static PyObject* HoughPlan_reset(HoughPlanObject *self) {
+    if (self->plan.angles == NULL) {
+        PyErr_SetString(LineDetectError, "HoughPlan is not initialized.");
+        return NULL;
+    }
+    lockPlan(self);
+    clearAccum(&self->plan);
+    PyThread_release_lock(self->lock);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject* HoughPlan_accumulate(HoughPlanObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"strip", "row", "sparse", "threads", "kernel", NULL};
+    int row;
+    int sparse = 0;
+    int threads = 1;
+    int kernel = KERNEL_FLOAT;
+    int status;
+    PyArrayObject *imgArray;
+    CvMat imgMat;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!i|iii", kwlist,
+                                     &PyArray_Type, &imgArray, &row, &sparse, &threads, &kernel)) {
+        return NULL;
+    }
+
+    if (self->plan.angles == NULL) {
+        PyErr_SetString(LineDetectError, "HoughPlan is not initialized.");
+        return NULL;
+    }
+    if (checkRunArgs(imgArray, threads, kernel) == -1)
+        return NULL;
+    if (imgArray->dimensions[1] != self->plan.cols) {
+        PyErr_Format(PyExc_ValueError, "strip has %d columns, the plan expects %d.",
+                     (int) imgArray->dimensions[1], self->plan.cols);
+        return NULL;
+    }
+    if (row < 0 || row + imgArray->dimensions[0] > self->plan.rows) {
+        PyErr_Format(PyExc_ValueError, "rows %d to %d of the strip are outside of the %d rows of the plan.",
+                     row, row + (int) imgArray->dimensions[0], self->plan.rows);
+        return NULL;
+    }
+
+    imgArray = (PyArrayObject*) PyArray_Cast(imgArray, NPY_UBYTE);
+    if (imgArray == NULL)
+        return NULL;
+    imgMat.rows = imgArray->dimensions[0];
+    imgMat.cols = imgMat.step = imgArray->dimensions[1];
+    imgMat.data = (unsigned char*) imgArray->data;
+
+    lockPlan(self);
+    Py_BEGIN_ALLOW_THREADS
+    status = fillAccum(&self->plan, &imgMat, row, sparse, threads, kernel);
+    Py_END_ALLOW_THREADS
+    PyThread_release_lock(self->lock);
+
+    Py_DECREF(imgArray);
+
+    if (status == -1)
+        return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+static PyObject* HoughPlan_peaks(HoughPlanObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"threshold", "topK", NULL};
+    int threshold;
+    int topK = 0;
+    int total;
+    PyObject *result;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|i", kwlist, &threshold, &topK))
+        return NULL;
+
+    if (self->plan.angles == NULL) {
+        PyErr_SetString(LineDetectError, "HoughPlan is not initialized.");
+        return NULL;
+    }
+
+    lockPlan(self);
+    Py_BEGIN_ALLOW_THREADS
+    total = findPeaks(&self->plan, threshold, topK);
+    Py_END_ALLOW_THREADS
+    result = buildLines(&self->plan, total);
+    PyThread_release_lock(self->lock);
+
+    return result;
+}
+
+/*
+ * Take the lock of the plan of self: its buffers are owned by the plan, so
+ * only one call may use them at a time.
+ */
+
+static void lockPlan(HoughPlanObject *self) {
+    if (!PyThread_acquire_lock(self->lock, NOWAIT_LOCK)) {
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(self->lock, WAIT_LOCK);
+        Py_END_ALLOW_THREADS
+    }
+}
+
+/*
+ * Compute the angles to search and their sin/cos tables, and allocate the
+ * accumulator (cleared) and sort buffers for binary maps of rows x cols.
+ * The tables are rounded to multiples of 2^-FIX_BITS, and also stored as
+ * such fixed point integers for KERNEL_FIXED. On maps of up to 2^(52-FIX_BITS)
+ * pixels a side, j * tabCos[n] + i * tabSin[n] is then exact in double
+ * precision, and equal to the fixed point sum: both kernels give the same
+ * votes.
  * Parameters:
- *   - img: an inverted binary map
  *   - rho: Distance resolution in pixel-related units
  *   - theta: Angle resolution in radians
- *   - threshold: Minimum accumulator value
  *   - window: Maximum angle from the vertical/horizontal to search for
  *   - adjustment: Shift from the vertical/horizontal
+ * Returns -1 if memory could not be allocated, 0 otherwise.
  */
 
-static PyObject* houghTransform(const CvMat* img, float rho, float theta,
-                       int threshold, float window, float adjustment) {
-    int *accum, *sort_buf;
-    float *tabSin, *tabCos;
-
-    const unsigned char* image;
-    int step, width, height;
+int planInit(HoughPlan* plan, int rows, int cols, float rho, float theta,
+             float window, float adjustment) {
     int numangle, numrho;
-    int total = 0;
-    float ang, linerho, lineangle;
-    int r, n, idx, base;
-    int i, j;
+    float ang;
+    int n, i;
     float irho = 1 / rho;
-    double scale;
-    float *angles;
     float bottomPoint, topPoint, midPoint;
     float bottomStart, bottomEnd, topStart, topEnd;
     float bottomWindow, topWindow;
-    PyObject* tuple = NULL;
-    PyObject* lines = PyList_New(0);
 
-    if (lines == NULL) {
-      PyErr_SetString(LineDetectError, "Cannot create new list.");
-      return NULL;
-    }
+    memset(plan, 0, sizeof(HoughPlan));
+    plan->rows = rows;
+    plan->cols = cols;
+    plan->rho = rho;
+    plan->theta = theta;
+    plan->window = window;
+    plan->adjustment = adjustment;
 
     adjustment = -adjustment;
 
@@ -147,60 +459,156 @@ static PyObject* houghTransform(const CvMat* img, float rho, float theta,
 
     midPoint = PI/2 + adjustment;
 
-    image = img->data;
-    step = img->step;
-    width = img->cols;
-    height = img->rows;
-
     numangle = 2 * ceil(window / theta) + ceil(bottomWindow / theta) + ceil(topWindow / theta);
+    numrho = ceil(((cols + rows) * 2 + 1) / rho);
+    plan->numangle = numangle;
+    plan->numrho = numrho;
 
-    angles = (float*) malloc (sizeof(float) * numangle);
+    plan->angles = (float*) malloc(sizeof(float) * numangle);
+    plan->tabSin = (double*) malloc(sizeof(double) * numangle);
+    plan->tabCos = (double*) malloc(sizeof(double) * numangle);
+    plan->fixSin = (int64_t*) malloc(sizeof(int64_t) * numangle);
+    plan->fixCos = (int64_t*) malloc(sizeof(int64_t) * numangle);
+    plan->accum = (int*) calloc((numangle+2) * (numrho+2), sizeof(int));
+    plan->sort_buf = (Peak*) malloc(sizeof(Peak) * (numangle * numrho));
+    if (plan->angles == NULL || plan->tabSin == NULL || plan->tabCos == NULL ||
+        plan->fixSin == NULL || plan->fixCos == NULL ||
+        plan->accum == NULL || plan->sort_buf == NULL) {
+        planFree(plan);
+        return -1;
+    }
 
     i = 0;
     for (ang = bottomStart, n = 0; n < ceil(bottomWindow / theta); ang += theta, n++, i++) {
-        angles[i] = ang;
+        plan->angles[i] = ang;
     }
 
     for (ang = midPoint, n = 0; n < ceil(window / theta); ang -= theta, n++, i++) {
-        angles[i] = ang;
+        plan->angles[i] = ang;
     }
 
     for (ang = midPoint, n = 0; n < ceil(window / theta); ang += theta, n++, i++) {
-      angles[i] = ang;
+      plan->angles[i] = ang;
     }
 
     for (ang = topEnd, n = 0; n < ceil(topWindow / theta); ang -= theta, n++, i++) {
-        angles[i] = ang;
+        plan->angles[i] = ang;
     }
 
-    numrho = ceil(((width + height) * 2 + 1) / rho);
+    for(n = 0; n < numangle; n++) {
+        ang = plan->angles[n];
+        plan->fixSin[n] = (int64_t) rint(ldexp(sin(ang) * irho, FIX_BITS));
+        plan->fixCos[n] = (int64_t) rint(ldexp(cos(ang) * irho, FIX_BITS));
+        plan->tabSin[n] = ldexp((double) plan->fixSin[n], -FIX_BITS);
+        plan->tabCos[n] = ldexp((double) plan->fixCos[n], -FIX_BITS);
+    }
 
-    accum = (int*) malloc(sizeof(int) * ((numangle+2) * (numrho+2)));
-    sort_buf = (int*) malloc(sizeof(int) * (numangle * numrho));
-    tabSin = (float*) malloc(sizeof(float) * numangle);
-    tabCos = (float*) malloc(sizeof(float) * numangle);
+    return 0;
+}
 
-    memset(accum, 0, sizeof(accum[0]) * (numangle+2) * (numrho+2));
+void planFree(HoughPlan* plan) {
+    int t;
 
-    for(n = 0; n < numangle; n++) {
-        ang = angles[n];
-        tabSin[n] = (float) (sin(ang) * irho);
-        tabCos[n] = (float) (cos(ang) * irho);
+    free(plan->angles);
+    free(plan->tabSin);
+    free(plan->tabCos);
+    free(plan->fixSin);
+    free(plan->fixCos);
+    free(plan->accum);
+    free(plan->sort_buf);
+    for (t = 0; t < plan->numThreadAccum; t++)
+        free(plan->threadAccum[t]);
+    free(plan->threadAccum);
+    memset(plan, 0, sizeof(HoughPlan));
+}
+
+/*
+ * Make sure plan owns at least count private accumulators for the extra
+ * voting threads. Must not touch any Python object: it runs without the GIL.
+ * Returns -1 if memory could not be allocated, 0 otherwise.
+ */
+
+int planReserveThreads(HoughPlan* plan, int count) {
+    int **grown;
+    int accumSize = (plan->numangle+2) * (plan->numrho+2);
+
+    if (count <= plan->numThreadAccum)
+        return 0;
+
+    grown = (int**) realloc(plan->threadAccum, sizeof(int*) * count);
+    if (grown == NULL)
+        return -1;
+    plan->threadAccum = grown;
+    while (plan->numThreadAccum < count) {
+        plan->threadAccum[plan->numThreadAccum] = (int*) malloc(sizeof(int) * accumSize);
+        if (plan->threadAccum[plan->numThreadAccum] == NULL)
+            return -1;
+        plan->numThreadAccum++;
     }
+    return 0;
+}
+
+/*
+ * Parameters:
+ *   - plan: angle tables and buffers, for maps of the same shape as img
+ *   - img: an inverted binary map
+ *   - threshold: Minimum accumulator value
+ *   - sparse: If nonzero, first extract the runs of nonzero pixels in each
+ *             row and only vote from those, instead of visiting every pixel
+ *   - threads: Number of threads to split the voting across
+ *   - topK: If positive, only return the topK lines with the most votes
+ *   - kernel: KERNEL_FLOAT or KERNEL_FIXED, see fillAccum
+ *
+ * The GIL is released while the accumulator is filled and searched.
+ * Returns a tuple of three arrays (rhos, thetas, votes) describing the
+ * discovered lines, sorted by decreasing number of votes.
+ */
+
+static PyObject* houghTransform(HoughPlan* plan, const CvMat* img, int threshold,
+                                int sparse, int threads, int topK, int kernel) {
+    int total = 0;
+    int status;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    clearAccum(plan);
 
     // stage 1. fill accumulator
-    for (i = 0; i < height; i++) {
-        for (j = 0; j < width; j++) {
-            if (image[i * step + j] != 0)
-                for (n = 0; n < numangle; n++) {
-                    r = round(j * tabCos[n] + i * tabSin[n]);
-                    r += (numrho - 1) / 2;
-                    accum[(n+1) * (numrho+2) + r+1]++;
-                }
-        }
-    }
+    status = fillAccum(plan, img, 0, sparse, threads, kernel);
+
+    // stages 2 and 3. find and sort the local maximums
+    if (status != -1)
+        total = findPeaks(plan, threshold, topK);
+
+    Py_END_ALLOW_THREADS
+
+    if (status == -1)
+        return PyErr_NoMemory();
+
+    // stage 4. build arrays describing the discovered lines
+    return buildLines(plan, total);
+}
+
+void clearAccum(HoughPlan* plan) {
+    memset(plan->accum, 0, sizeof(int) * (plan->numangle+2) * (plan->numrho+2));
+}
+
+/*
+ * Find the local maximums of plan->accum above threshold, and sort them
+ * (or only the topK best, if topK is positive) into plan->sort_buf by
+ * decreasing accumulator value. Must not touch any Python object: it runs
+ * without the GIL.
+ * Returns the number of lines found.
+ */
+
+int findPeaks(HoughPlan* plan, int threshold, int topK) {
+    int *accum = plan->accum;
+    Peak *sort_buf = plan->sort_buf;
+    int numangle = plan->numangle;
+    int numrho = plan->numrho;
+    int total = 0;
+    int r, n, base;
 
-    // stage 2. find local maximums
     for (r = 0; r < numrho; r++) {
         for (n = 0; n < numangle; n++) {
             base = (n+1) * (numrho+2) + r+1;
@@ -208,47 +616,63 @@ static PyObject* houghTransform(const CvMat* img, float rho, float theta,
             if (accum[base] > threshold &&
                 accum[base] > accum[base - 1] && accum[base] >= accum[base + 1] &&
                 accum[base] > accum[base - numrho - 2] && accum[base] >= accum[base + numrho + 2]) {
-              sort_buf[total++] = base;
+              sort_buf[total].votes = accum[base];
+              sort_buf[total].idx = base;
+              total++;
             }
         }
     }
 
-    // stage 3. sort the detected lines by accumulator value
-    quickSort(sort_buf, accum, 0, total-1);
+    return sortPeaks(sort_buf, total, topK);
+}
+
+/*
+ * Returns a tuple of three arrays (rhos, thetas, votes) describing the first
+ * total lines of plan->sort_buf, see findPeaks.
+ */
 
-    // stage 4. build a python data structure containing the discovered lines
-    scale = 1./(numrho+2);
+static PyObject* buildLines(HoughPlan* plan, int total) {
+    Peak *sort_buf = plan->sort_buf;
+    int numrho = plan->numrho;
+    int r, n, idx;
+    int i;
+    npy_intp dims[1];
+    float *lineRhos, *lineThetas;
+    int *lineVotes;
+    PyArrayObject *rhos, *thetas, *votes;
+
+    dims[0] = total;
+    rhos = (PyArrayObject*) PyArray_SimpleNew(1, dims, NPY_FLOAT32);
+    thetas = (PyArrayObject*) PyArray_SimpleNew(1, dims, NPY_FLOAT32);
+    votes = (PyArrayObject*) PyArray_SimpleNew(1, dims, NPY_INT32);
+    if (rhos == NULL || thetas == NULL || votes == NULL) {
+        Py_XDECREF(rhos);
+        Py_XDECREF(thetas);
+        Py_XDECREF(votes);
+        return NULL;
+    }
+
+    lineRhos = (float*) PyArray_DATA(rhos);
+    lineThetas = (float*) PyArray_DATA(thetas);
+    lineVotes = (int*) PyArray_DATA(votes);
     for (i = 0; i < total; i++) {
-        idx = sort_buf[i];
-        n = floor(idx * scale) - 1;
+        idx = sort_buf[i].idx;
+        n = idx / (numrho+2) - 1;
         r = idx - (n+1) * (numrho+2) - 1;
-        linerho = (r - (numrho - 1)*0.5f) * rho;
-        lineangle = angles[n];
-        tuple = Py_BuildValue("(ff)", linerho, lineangle);
-        if (PyList_Append(lines, tuple) == -1) {
-          Py_DECREF(tuple);
-          free(accum);
-          free(sort_buf);
-          free(tabSin);
-          free(tabCos);
-          free(angles);          
-          return NULL;
-        }
-        Py_DECREF(tuple);
+        lineRhos[i] = (r - (numrho - 1)*0.5f) * plan->rho;
+        lineThetas[i] = plan->angles[n];
+        lineVotes[i] = sort_buf[i].votes;
     }
 
-    free(accum);
-    free(sort_buf);
-    free(tabSin);
-    free(tabCos);
-    free(angles);
-
-    return lines;
+    return Py_BuildValue("(NNN)", rhos, thetas, votes);
 }
 
 PyMODINIT_FUNC initlineDetect(void) {
     PyObject *m;
 
+    if (PyType_Ready(&HoughPlanType) < 0)
+        return;
+
     m = Py_InitModule("lineDetect", LineDetectMethods);
     if (m == NULL)
         return;
@@ -257,59 +681,439 @@ PyMODINIT_FUNC initlineDetect(void) {
     LineDetectError = PyErr_NewException("lineDetect.error", NULL, NULL);
     //Py_INCREF(LineDetectError);
     PyModule_AddObject(m, "error", LineDetectError);
+
+    Py_INCREF(&HoughPlanType);
+    PyModule_AddObject(m, "HoughPlan", (PyObject*) &HoughPlanType);
+
+    PyModule_AddIntConstant(m, "KERNEL_FLOAT", KERNEL_FLOAT);
+    PyModule_AddIntConstant(m, "KERNEL_FIXED", KERNEL_FIXED);
 }
 
 /*
- * Utils
+ * Accumulator voting
+ */
+
+/*
+ * Add the votes of the nonzero pixels of img to plan->accum, splitting the
+ * rows across threads. img holds the rows of the binary map starting at
+ * rowOffset. Every thread but the first votes into one of the plan's private
+ * accumulators, and those are summed into plan->accum once all threads have
+ * finished. The votes are cast by kernel: KERNEL_FLOAT computes the rho of
+ * each (pixel, angle) pair from scratch, KERNEL_FIXED updates the rhos of
+ * all the angles incrementally along each row, see fillAccumDenseFixed.
+ * Must not touch any Python object: it runs without the GIL.
+ * Returns -1 if memory could not be allocated, 0 otherwise.
+ */
+
+int fillAccum(HoughPlan* plan, const CvMat* img, int rowOffset, int sparse, int threads,
+              int kernel) {
+    RunList runs;
+    VoteTask *tasks;
+    pthread_t *handles;
+    uint64_t *rhoBuf = NULL;
+    int *idxBuf = NULL;
+    int *accum = plan->accum;
+    int accumSize = (plan->numangle+2) * (plan->numrho+2);
+    int status = 0;
+    int started, t, k, row;
+    long pixels, share, seen;
+
+    if (sparse && extractRuns(img, &runs) == -1)
+        return -1;
+
+    threads = MAX(1, MIN(threads, img->rows));
+    tasks = (VoteTask*) calloc(threads, sizeof(VoteTask));
+    handles = (pthread_t*) malloc(sizeof(pthread_t) * threads);
+    if (tasks == NULL || handles == NULL || planReserveThreads(plan, threads - 1) == -1) {
+        status = -1;
+        goto cleanup;
+    }
+    if (kernel == KERNEL_FIXED) {
+        rhoBuf = (uint64_t*) malloc(sizeof(uint64_t) * plan->numangle * threads);
+        idxBuf = (int*) malloc(sizeof(int) * plan->numangle * threads);
+        if (rhoBuf == NULL || idxBuf == NULL) {
+            status = -1;
+            goto cleanup;
+        }
+    }
+
+    for (t = 0; t < threads; t++) {
+        tasks[t].img = img;
+        tasks[t].runs = sparse ? &runs : NULL;
+        tasks[t].rowOffset = rowOffset;
+        tasks[t].kernel = kernel;
+        tasks[t].tabSin = plan->tabSin;
+        tasks[t].tabCos = plan->tabCos;
+        tasks[t].fixSin = plan->fixSin;
+        tasks[t].fixCos = plan->fixCos;
+        if (kernel == KERNEL_FIXED) {
+            tasks[t].rhoBuf = rhoBuf + (size_t) plan->numangle * t;
+            tasks[t].idxBuf = idxBuf + (size_t) plan->numangle * t;
+        }
+        tasks[t].numangle = plan->numangle;
+        tasks[t].numrho = plan->numrho;
+        if (t == 0) {
+            tasks[t].accum = accum;
+        } else {
+            tasks[t].accum = plan->threadAccum[t-1];
+            memset(tasks[t].accum, 0, sizeof(int) * accumSize);
+        }
+    }
+
+    // split the rows so that each thread gets about the same amount of work
+    if (sparse) {
+        pixels = 0;
+        for (k = 0; k < runs.count; k++)
+            pixels += runs.runs[2*k + 1] - runs.runs[2*k];
+        share = pixels / threads + 1;
+        seen = 0;
+        t = 0;
+        for (row = 0; row < img->rows; row++) {
+            if (seen >= share * (t+1) && t < threads - 1) {
+                tasks[t].rowEnd = row;
+                tasks[++t].rowBegin = row;
+            }
+            for (k = runs.rowStart[row]; k < runs.rowStart[row+1]; k++)
+                seen += runs.runs[2*k + 1] - runs.runs[2*k];
+        }
+        tasks[t].rowEnd = img->rows;
+        for (t++; t < threads; t++)
+            tasks[t].rowBegin = tasks[t].rowEnd = img->rows;
+    } else {
+        for (t = 0; t < threads; t++) {
+            tasks[t].rowBegin = (int) ((long) img->rows * t / threads);
+            tasks[t].rowEnd = (int) ((long) img->rows * (t+1) / threads);
+        }
+    }
+
+    for (started = 1; started < threads; started++) {
+        if (pthread_create(&handles[started], NULL, voteWorker, &tasks[started]) != 0)
+            break;
+    }
+    voteWorker(&tasks[0]);
+    // any thread that could not be started has its rows done here instead
+    for (t = started; t < threads; t++)
+        voteWorker(&tasks[t]);
+    for (t = 1; t < started; t++)
+        pthread_join(handles[t], NULL);
+
+    for (t = 1; t < threads; t++) {
+        for (k = 0; k < accumSize; k++)
+            accum[k] += tasks[t].accum[k];
+    }
+
+cleanup:
+    free(tasks);
+    free(handles);
+    free(rhoBuf);
+    free(idxBuf);
+    if (sparse)
+        freeRuns(&runs);
+
+    return status;
+}
+
+void* voteWorker(void* arg) {
+    VoteTask* task = (VoteTask*) arg;
+
+    if (task->kernel == KERNEL_FIXED) {
+        if (task->runs != NULL)
+            fillAccumSparseFixed(task->runs, task->rowBegin, task->rowEnd, task->rowOffset,
+                                 task->accum, task->fixSin, task->fixCos, task->numangle,
+                                 task->numrho, task->rhoBuf, task->idxBuf);
+        else
+            fillAccumDenseFixed(task->img, task->rowBegin, task->rowEnd, task->rowOffset,
+                                task->accum, task->fixSin, task->fixCos, task->numangle,
+                                task->numrho, task->rhoBuf, task->idxBuf);
+    } else if (task->runs != NULL)
+        fillAccumSparse(task->runs, task->rowBegin, task->rowEnd, task->rowOffset, task->accum,
+                        task->tabSin, task->tabCos, task->numangle, task->numrho);
+    else
+        fillAccumDense(task->img, task->rowBegin, task->rowEnd, task->rowOffset, task->accum,
+                       task->tabSin, task->tabCos, task->numangle, task->numrho);
+    return NULL;
+}
+
+/*
+ * Vote from every nonzero pixel in rows [rowBegin, rowEnd) of img, visiting
+ * the whole map. Row i of img is row i + rowOffset of the binary map.
+ */
+
+void fillAccumDense(const CvMat* img, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                    const double* tabSin, const double* tabCos, int numangle, int numrho) {
+    const unsigned char* image = img->data;
+    int step = img->step;
+    int i, j, n, r;
+
+    for (i = rowBegin; i < rowEnd; i++) {
+        for (j = 0; j < img->cols; j++) {
+            if (image[i * step + j] != 0)
+                for (n = 0; n < numangle; n++) {
+                    r = (int) floor(j * tabCos[n] + (i + rowOffset) * tabSin[n] + 0.5);
+                    r += (numrho - 1) / 2;
+                    accum[(n+1) * (numrho+2) + r+1]++;
+                }
+        }
+    }
+}
+
+/*
+ * Run-length encode the nonzero pixels of img, row by row. Runs of row i are
+ * stored as (start, end) column pairs, end exclusive, in
+ * runs->runs[2*runs->rowStart[i]] up to runs->runs[2*runs->rowStart[i+1]].
+ * Zero bytes are skipped a machine word at a time, which is where the savings
+ * over the dense scan come from on mostly empty maps.
+ * Returns -1 if memory could not be allocated, 0 otherwise.
+ */
+
+int extractRuns(const CvMat* img, RunList* runs) {
+    const unsigned char* row;
+    int capacity = 1024;
+    int i, j, start;
+    int width = img->cols;
+    size_t word;
+    int *grown;
+
+    runs->count = 0;
+    runs->rowStart = (int*) malloc(sizeof(int) * (img->rows + 1));
+    runs->runs = (int*) malloc(sizeof(int) * 2 * capacity);
+    if (runs->rowStart == NULL || runs->runs == NULL) {
+        freeRuns(runs);
+        return -1;
+    }
+
+    for (i = 0; i < img->rows; i++) {
+        row = img->data + i * img->step;
+        runs->rowStart[i] = runs->count;
+        j = 0;
+        while (j < width) {
+            // skip over empty words
+            while (j + (int) sizeof(word) <= width) {
+                memcpy(&word, row + j, sizeof(word));
+                if (word != 0)
+                    break;
+                j += sizeof(word);
+            }
+            while (j < width && row[j] == 0)
+                j++;
+            if (j >= width)
+                break;
+
+            start = j;
+            while (j < width && row[j] != 0)
+                j++;
+
+            if (runs->count == capacity) {
+                capacity *= 2;
+                grown = (int*) realloc(runs->runs, sizeof(int) * 2 * capacity);
+                if (grown == NULL) {
+                    freeRuns(runs);
+                    return -1;
+                }
+                runs->runs = grown;
+            }
+            runs->runs[2 * runs->count] = start;
+            runs->runs[2 * runs->count + 1] = j;
+            runs->count++;
+        }
+    }
+    runs->rowStart[img->rows] = runs->count;
+    runs->rows = img->rows;
+
+    return 0;
+}
+
+void freeRuns(RunList* runs) {
+    free(runs->rowStart);
+    free(runs->runs);
+    runs->rowStart = NULL;
+    runs->runs = NULL;
+}
+
+/*
+ * Vote only from the pixels covered by runs, in rows [rowBegin, rowEnd).
+ * Row i of the runs is row i + rowOffset of the binary map.
  */
 
+void fillAccumSparse(const RunList* runs, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                     const double* tabSin, const double* tabCos, int numangle, int numrho) {
+    int i, j, k, n, r;
+
+    for (i = rowBegin; i < rowEnd; i++) {
+        for (k = runs->rowStart[i]; k < runs->rowStart[i+1]; k++) {
+            for (j = runs->runs[2*k]; j < runs->runs[2*k + 1]; j++) {
+                for (n = 0; n < numangle; n++) {
+                    r = (int) floor(j * tabCos[n] + (i + rowOffset) * tabSin[n] + 0.5);
+                    r += (numrho - 1) / 2;
+                    accum[(n+1) * (numrho+2) + r+1]++;
+                }
+            }
+        }
+    }
+}
+
+/*
+ * KERNEL_FIXED: rho is kept for every angle as a fixed point number with
+ * FIX_BITS fractional bits, offset by FIX_HALF and by the accumulator
+ * position of rho 0, so that it is never negative and rho >> FIX_BITS is
+ * the accumulator column of the vote. Moving along a row only adds to it,
+ * and the angle loops are split into an arithmetic one, which the compiler
+ * can vectorize, and the scattered increments.
+ */
+
+/*
+ * Set rho[n] to the rho of pixel (row, col) of the binary map for every angle.
+ */
+
+static void fixedStart(uint64_t* rho, const int64_t* fixSin, const int64_t* fixCos,
+                       int numangle, int numrho, int row, int col) {
+    uint64_t origin = ((uint64_t) ((numrho - 1) / 2 + 1) << FIX_BITS) + FIX_HALF;
+    int n;
+
+    for (n = 0; n < numangle; n++)
+        rho[n] = origin + (uint64_t) (row * fixSin[n] + col * fixCos[n]);
+}
+
 /*
- * An in-place quicksort implementation that sorts toSort using the corresponding
- * values in values in decreasing order:
- *    => values[toSort[n]] >= values[toSort[n+1]])
- * Taken straight from http://en.wikipedia.org/wiki/Quicksort
+ * Move rho[n] step columns to the right, and vote for the pixel reached.
  */
 
-int quickSortPartition(int* toSort, int* values, int left, int right, int pivotIndex) {
-    int pivotValue, storeIndex;
-    int i, tmp;
-
-    pivotValue = values[toSort[pivotIndex]];
-    // move pivot to the end
-    tmp = toSort[pivotIndex];
-    toSort[pivotIndex] = toSort[right];
-    toSort[right] = tmp;
-
-    storeIndex = left;
-    for (i = left; i < right; i++) {
-        if (values[toSort[i]] > pivotValue) {
-            tmp = toSort[i];
-            toSort[i] = toSort[storeIndex];
-            toSort[storeIndex] = tmp;
-            storeIndex++;
+static void fixedVote(int* accum, uint64_t* rho, int* idx, const int64_t* fixCos,
+                      int numangle, int numrho, int step) {
+    int n;
+
+    if (step == 1) {
+        for (n = 0; n < numangle; n++) {
+            rho[n] += (uint64_t) fixCos[n];
+            idx[n] = (n+1) * (numrho+2) + (int) (rho[n] >> FIX_BITS);
+        }
+    } else {
+        for (n = 0; n < numangle; n++) {
+            rho[n] += (uint64_t) (step * fixCos[n]);
+            idx[n] = (n+1) * (numrho+2) + (int) (rho[n] >> FIX_BITS);
         }
     }
-    // Move pivot to its final place
-    tmp = toSort[storeIndex];
-    toSort[storeIndex] = toSort[right];
-    toSort[right] = tmp;
+    for (n = 0; n < numangle; n++)
+        accum[idx[n]]++;
+}
 
-    return storeIndex;
+/*
+ * fillAccumDense with KERNEL_FIXED. rho and idx are scratch buffers of
+ * numangle entries.
+ */
+
+void fillAccumDenseFixed(const CvMat* img, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                         const int64_t* fixSin, const int64_t* fixCos, int numangle, int numrho,
+                         uint64_t* rho, int* idx) {
+    const unsigned char* row;
+    int i, j, last;
+
+    for (i = rowBegin; i < rowEnd; i++) {
+        row = img->data + i * img->step;
+        // start one column to the left of the row, the first vote moves onto it
+        fixedStart(rho, fixSin, fixCos, numangle, numrho, i + rowOffset, -1);
+        last = -1;
+        for (j = 0; j < img->cols; j++) {
+            if (row[j] != 0) {
+                fixedVote(accum, rho, idx, fixCos, numangle, numrho, j - last);
+                last = j;
+            }
+        }
+    }
+}
+
+/*
+ * fillAccumSparse with KERNEL_FIXED. rho and idx are scratch buffers of
+ * numangle entries.
+ */
+
+void fillAccumSparseFixed(const RunList* runs, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                          const int64_t* fixSin, const int64_t* fixCos, int numangle, int numrho,
+                          uint64_t* rho, int* idx) {
+    int i, j, k, last;
+
+    for (i = rowBegin; i < rowEnd; i++) {
+        fixedStart(rho, fixSin, fixCos, numangle, numrho, i + rowOffset, -1);
+        last = -1;
+        for (k = runs->rowStart[i]; k < runs->rowStart[i+1]; k++) {
+            j = runs->runs[2*k];
+            fixedVote(accum, rho, idx, fixCos, numangle, numrho, j - last);
+            for (j++; j < runs->runs[2*k + 1]; j++)
+                fixedVote(accum, rho, idx, fixCos, numangle, numrho, 1);
+            last = j - 1;
+        }
+    }
+}
+
+/*
+ * Utils
+ */
+
+/*
+ * Whether peak a ranks before peak b: more votes first, ties broken by
+ * accumulator position so that the order is deterministic.
+ */
+
+static int peakBefore(const Peak* a, const Peak* b) {
+    return a->votes > b->votes || (a->votes == b->votes && a->idx < b->idx);
 }
 
-void quickSort(int* toSort, int* values, int left, int right) {
-    int pivotIndex;
+static int comparePeaks(const void* a, const void* b) {
+    if (peakBefore((const Peak*) a, (const Peak*) b))
+        return -1;
+    if (peakBefore((const Peak*) b, (const Peak*) a))
+        return 1;
+    return 0;
+}
+
+/*
+ * Restore the heap property of the min-heap (by rank) heap[0..size) below
+ * position i, so that the worst ranked peak ends up at the root.
+ */
+
+static void siftDown(Peak* heap, int size, int i) {
+    int child, worst;
+    Peak tmp;
 
-    if (left < right) {
-        pivotIndex = left + (right-left)/2;
-        pivotIndex = quickSortPartition(toSort, values, left, right, pivotIndex);
-        quickSort(toSort, values, left, pivotIndex - 1);
-        quickSort(toSort, values, pivotIndex + 1, right);
+    while (1) {
+        worst = i;
+        child = 2*i + 1;
+        if (child < size && peakBefore(&heap[worst], &heap[child]))
+            worst = child;
+        child++;
+        if (child < size && peakBefore(&heap[worst], &heap[child]))
+            worst = child;
+        if (worst == i)
+            return;
+        tmp = heap[i];
+        heap[i] = heap[worst];
+        heap[worst] = tmp;
+        i = worst;
     }
 }
 
-double round(double num) {
-    double c = ceil(num);
-    double f = floor(num);
-    return c ? ((c - num) < (num - f)) : f;
+/*
+ * Sort the total peaks in decreasing order of votes. If topK is positive
+ * and smaller than total, only the topK best peaks are kept, selected
+ * with a bounded heap rather than sorting all of them.
+ * Returns the number of peaks kept.
+ */
+
+int sortPeaks(Peak* peaks, int total, int topK) {
+    int i;
+
+    if (topK > 0 && topK < total) {
+        for (i = topK/2 - 1; i >= 0; i--)
+            siftDown(peaks, topK, i);
+        for (i = topK; i < total; i++) {
+            if (peakBefore(&peaks[i], &peaks[0])) {
+                peaks[0] = peaks[i];
+                siftDown(peaks, topK, 0);
+            }
+        }
+        total = topK;
+    }
+    qsort(peaks, total, sizeof(Peak), comparePeaks);
+
+    return total;
 }
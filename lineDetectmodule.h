@@ -49,10 +49,20 @@
 #ifndef LINEDETECTMODULE_H_
 #define LINEDETECTMODULE_H_
 
+#include <stdint.h>
+
 #define PI 3.1415926535897932384626433832795
 #define MAX(x, y) (((x) > (y)) ? (x) : (y))
 #define MIN(x, y) (((x) < (y)) ? (x) : (y))
 
+/* the voting kernels, see fillAccum */
+#define KERNEL_FLOAT 0
+#define KERNEL_FIXED 1
+
+/* fractional bits of the fixed point rhos of KERNEL_FIXED */
+#define FIX_BITS 32
+#define FIX_HALF ((uint64_t) 1 << (FIX_BITS - 1))
+
 typedef struct CvMat
 {
     int type;
@@ -64,12 +74,126 @@ typedef struct CvMat
     int cols;
 } CvMat;
 
-static PyObject* lineDetect_findLines(PyObject *self, PyObject *args);
-static PyObject* houghTransform(const CvMat* img, float rho, float theta,
-                       int threshold, float window, float adjustment);
+/*
+ * Run-length encoding of the nonzero pixels of a CvMat, see extractRuns.
+ */
+typedef struct RunList
+{
+    int rows;
+    int count;
+
+    int *rowStart;
+    int *runs;
+} RunList;
+
+/*
+ * The share of the voting done by one thread, see fillAccum.
+ */
+typedef struct VoteTask
+{
+    const CvMat *img;
+    const RunList *runs;
+
+    int rowBegin;
+    int rowEnd;
+    int rowOffset;
+    int kernel;
+
+    int *accum;
+    const double *tabSin;
+    const double *tabCos;
+    const int64_t *fixSin;
+    const int64_t *fixCos;
+    /* scratch buffers of KERNEL_FIXED, numangle entries each */
+    uint64_t *rhoBuf;
+    int *idxBuf;
+    int numangle;
+    int numrho;
+} VoteTask;
+
+/*
+ * A local maximum of the accumulator, at accumulator position idx.
+ */
+typedef struct Peak
+{
+    int votes;
+    int idx;
+} Peak;
+
+/*
+ * The angles searched by a Hough transform along with the buffers it needs,
+ * for binary maps of a given shape. See planInit.
+ */
+typedef struct HoughPlan
+{
+    int rows;
+    int cols;
+
+    float rho;
+    float theta;
+    float window;
+    float adjustment;
+
+    int numangle;
+    int numrho;
+
+    float *angles;
+    double *tabSin;
+    double *tabCos;
+    /* tabSin and tabCos in fixed point, with FIX_BITS fractional bits */
+    int64_t *fixSin;
+    int64_t *fixCos;
+
+    int *accum;
+    Peak *sort_buf;
+
+    /* private accumulators of the extra voting threads */
+    int **threadAccum;
+    int numThreadAccum;
+} HoughPlan;
+
+typedef struct HoughPlanObject
+{
+    PyObject_HEAD
+    HoughPlan plan;
+    PyThread_type_lock lock;
+} HoughPlanObject;
+
+static PyObject* lineDetect_findLines(PyObject *self, PyObject *args, PyObject *kwds);
+static int checkRunArgs(PyArrayObject *imgArray, int threads, int kernel);
+static int HoughPlan_init(HoughPlanObject *self, PyObject *args, PyObject *kwds);
+static void HoughPlan_dealloc(HoughPlanObject *self);
+static PyObject* HoughPlan_run(HoughPlanObject *self, PyObject *args, PyObject *kwds);
+static PyObject* HoughPlan_reset(HoughPlanObject *self);
+static PyObject* HoughPlan_accumulate(HoughPlanObject *self, PyObject *args, PyObject *kwds);
+static PyObject* HoughPlan_peaks(HoughPlanObject *self, PyObject *args, PyObject *kwds);
+static void lockPlan(HoughPlanObject *self);
+static PyObject* houghTransform(HoughPlan* plan, const CvMat* img, int threshold,
+                                int sparse, int threads, int topK, int kernel);
+static PyObject* buildLines(HoughPlan* plan, int total);
+
+int planInit(HoughPlan* plan, int rows, int cols, float rho, float theta,
+             float window, float adjustment);
+void planFree(HoughPlan* plan);
+int planReserveThreads(HoughPlan* plan, int count);
+void clearAccum(HoughPlan* plan);
+int findPeaks(HoughPlan* plan, int threshold, int topK);
+int fillAccum(HoughPlan* plan, const CvMat* img, int rowOffset, int sparse, int threads,
+              int kernel);
+void* voteWorker(void* arg);
+int extractRuns(const CvMat* img, RunList* runs);
+void freeRuns(RunList* runs);
+void fillAccumDense(const CvMat* img, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                    const double* tabSin, const double* tabCos, int numangle, int numrho);
+void fillAccumSparse(const RunList* runs, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                     const double* tabSin, const double* tabCos, int numangle, int numrho);
+void fillAccumDenseFixed(const CvMat* img, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                         const int64_t* fixSin, const int64_t* fixCos, int numangle, int numrho,
+                         uint64_t* rho, int* idx);
+void fillAccumSparseFixed(const RunList* runs, int rowBegin, int rowEnd, int rowOffset, int* accum,
+                          const int64_t* fixSin, const int64_t* fixCos, int numangle, int numrho,
+                          uint64_t* rho, int* idx);
 
-int quickSortPartition(int* toSort, int* values, int left, int right, int pivotIndex);
-void quickSort(int* toSort, int* values, int left, int right);
-double round(double num);
+int sortPeaks(Peak* peaks, int total, int topK);
 
 #endif /* LINEDETECTMODULE_H_ */
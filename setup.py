@@ -3,6 +3,8 @@ import numpy as np
 
 setup(name='lineDetect',
       version='1.0',
-      ext_modules=[Extension('lineDetect', ['lineDetectmodule.c'])],
+      ext_modules=[Extension('lineDetect', ['lineDetectmodule.c'],
+                             extra_compile_args=['-pthread'],
+                             extra_link_args=['-pthread'])],
       include_dirs = [np.get_include()]
      )
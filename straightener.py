@@ -1,11 +1,85 @@
-import string, cv, math, os, time, numpy, lineDetect, pdb, cv2
-import argparse, traceback
+import string, cv, math, os, time, numpy, pdb, cv2
+import argparse, traceback, collections, threading, hashlib, sqlite3, json, StringIO, sys
 
 ROT_WINDOW = 2
 MIN_CROP = 20
 BIN_THRESHOLD = 200
 BIN_COLOR = 255
 ACCUMULATOR = 2.0/3.0
+# Below this fraction of foreground pixels, let findLines vote from a
+# run-length encoded edge list instead of scanning the whole map.
+SPARSE_DENSITY = 0.2
+# The Hough transform backends: the modules providing findLines and
+# HoughPlan (see lineDetectmodule.c), fastest first. lineDetect is the C
+# extension, lineDetectNumpy a pure NumPy version of it that finds the
+# same lines, for when it is not built. The first that can be imported is
+# used, unless another is chosen with setHoughBackend.
+HOUGH_BACKENDS = collections.OrderedDict([('c', 'lineDetect'), ('numpy', 'lineDetectNumpy')])
+# Voting kernel of findLines, 'float' or 'fixed'. Both kernels give the
+# same votes; the fixed point one, which updates rho incrementally along
+# each row, is faster.
+HOUGH_KERNEL = 'fixed'
+# Number of HoughPlan objects kept around per thread.
+PLAN_CACHE_SIZE = 8
+# Restrict the second Hough pass to the pixels near the lines found by
+# the first one, keeping at most PASS2_MAX_LINES of the strongest lines.
+# Drawing that mask takes longer than the votes it saves on small binary
+# maps, so only maps with at least RESTRICT_MIN_FOREGROUND foreground
+# pixels are restricted (a 1280x2104 page has about 30000 at -r 2, a
+# 652x1480 one about 15000).
+RESTRICT_PASS2 = True
+PASS2_MAX_LINES = 256
+RESTRICT_MIN_FOREGROUND = 20000
+# Angle resolution and window (in degrees) of the two Hough passes.
+PASS1_THETA = 0.1
+PASS2_THETA = 0.01
+PASS2_WINDOW = 0.1
+# Number of thumbnail rows voted at a time by detectRotationStrips.
+STRIP_ROWS = 256
+# Largest output downscale done within the straightening warp itself.
+MAX_WARP_DOWNSCALE = 2.0
+# Adaptive detection first tries these (larger) shrinking factors, and
+# accepts a single first pass once its confidence reaches
+# CONFIDENCE_THRESHOLD.
+ADAPTIVE_FACTORS = (8.0, 4.0)
+CONFIDENCE_THRESHOLD = 0.75
+# Spread (in degrees) of the line angles at which agreement drops to 1/2,
+# and the number of agreeing lines needed for full support.
+CONFIDENCE_SPREAD = 1.0
+CONFIDENCE_LINES = 8
+# Detection results are cached in CACHE_NAME in the cache directory, keyed
+# by the hash of the image file, DETECTION_VERSION, the detection
+# parameters and how the grayscale image was made. Once the cache holds
+# more than CACHE_MAX_ENTRIES, the least recently used entries are
+# dropped, checking every CACHE_EVICT_INTERVAL insertions.
+# Bump DETECTION_VERSION whenever a change can change the detected angles,
+# confidence or box of an image, so that the results cached before it
+# aren't reused.
+DETECTION_VERSION = 4
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'straightener')
+CACHE_NAME = 'detections.sqlite'
+CACHE_MAX_ENTRIES = 1000000
+CACHE_EVICT_INTERVAL = 1000
+# The last use of the entries hit is written every CACHE_TOUCH_INTERVAL
+# hits (and on close), in one transaction, rather than on every hit; the
+# uses not yet written when a worker exits only make the eviction order
+# less exact.
+CACHE_TOUCH_INTERVAL = 100
+# The cv2.imwrite parameters of encoderParams, and the zlib strategies for
+# PNG output. The values stand in for the cv2 names that an older cv2
+# lacks; libtiff's COMPRESSION_NONE has no cv2 name.
+IMWRITE_PNG_COMPRESSION = getattr(cv2, 'IMWRITE_PNG_COMPRESSION', 16)
+IMWRITE_PNG_STRATEGY = getattr(cv2, 'IMWRITE_PNG_STRATEGY', 17)
+IMWRITE_TIFF_COMPRESSION = getattr(cv2, 'IMWRITE_TIFF_COMPRESSION', 259)
+TIFF_COMPRESSION_NONE = 1
+PNG_STRATEGIES = {'default': getattr(cv2, 'IMWRITE_PNG_STRATEGY_DEFAULT', 0),
+                  'filtered': getattr(cv2, 'IMWRITE_PNG_STRATEGY_FILTERED', 1),
+                  'huffman': getattr(cv2, 'IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY', 2),
+                  'rle': getattr(cv2, 'IMWRITE_PNG_STRATEGY_RLE', 3),
+                  'fixed': getattr(cv2, 'IMWRITE_PNG_STRATEGY_FIXED', 4)}
+# The stages timed by startStats, in pipeline order.
+STAGES = ('read', 'decode', 'crop', 'thumbnail', 'threshold', 'hough1', 'hough2',
+          'border', 'warp', 'resize', 'save')
 GRAPH = False
 DEBUG = False
 FILTER = False
@@ -13,152 +87,323 @@ FILTER = False
 METHOD_MEAN = 0
 METHOD_MEDIAN = 1
 METHOD_TMEAN = 2
+METHOD_WMEAN = 3
 
-TOP = 0
-BOTTOM = 1
-LEFT = 2
-RIGHT = 3
 THRESHOLD = 1
+# Number of rows and of columns, spread over the middle half of the page,
+# that are scanned for the border. The median over them is taken, so a
+# mark or a gap in the border on a few of them does not throw it off.
+BORDER_SCANLINES = 32
+
+def borderScanlines(height, width):
+    """
+    Return the indices (rows, cols) of the rows and columns of a
+    height x width image that are scanned for the border.
+    """
+    rows = numpy.linspace(height / 4, 3 * height / 4, BORDER_SCANLINES).astype(int)
+    cols = numpy.linspace(width / 4, 3 * width / 4, BORDER_SCANLINES).astype(int)
+    return rows, cols
+
+def firstAbove(lines, default):
+    """
+    Return, for each row of the 2d array lines, the index of its first
+    value above THRESHOLD, or default if there is none.
+    """
+    mask = lines > THRESHOLD
+    return numpy.where(mask.any(axis=1), mask.argmax(axis=1), default)
+
+def borderBox(rows, cols):
+    """
+    Given the pixels of the scanned rows (BORDER_SCANLINES x width) and
+    columns (BORDER_SCANLINES x height), find the first pixel that is not
+    black from each side of each scanline and return the median border
+    box (rOff, tOff, lOff, bOff).
+    """
+    height, width = cols.shape[1], rows.shape[1]
+    tOff = numpy.median(firstAbove(cols, height-1))
+    lOff = numpy.median(firstAbove(rows, width-1))
+    bOff = numpy.median(height-1 - firstAbove(cols[:, ::-1], height-1))
+    rOff = numpy.median(width-1 - firstAbove(rows[:, ::-1], width-1))
+    return (int(rOff), int(tOff), int(lOff), int(bOff))
 
-VECTOR = ((0,-1), (0,1), (-1,0), (1,0))
-
-def scan(img, pos, dir):
-    diff = 0
-    height, width = img.shape
-    newPos = pos
-    """
-    while (diff < THRESHOLD):
-        pos = newPos
-        dx, dy = VECTOR[dir]
-        x, y = pos
-        newPos = (x+dx, y+dy)
-        newX, newY = newPos
-        if (newX < 0) or (newX >= width) or (newY < 0) or (newY >= height):
-            # Something's wrong with the image
-            break
-        diff = img[newY,newX] - img[y,x]
-    """
-    
-    while True:
-        pos = newPos
-        dx, dy = VECTOR[dir]
-        x, y = pos
-        
-        if (x < 0) or (x >= width) or (y < 0) or (y >= height):
-            return (0,height-1,0,width-1)[dir]
-        
-        if (img[y,x] > THRESHOLD):
-            break
-        newPos = (x+dx, y+dy)
-    
-    return (y,y,x,x)[dir]
-    
 def findBorder(img):
-    height, width = img.shape
-    tOff = scan(img, (int(width/2), 0), BOTTOM)
-    lOff = scan(img, (0, int(height/2)), RIGHT)
-    bOff = scan(img, (int(width/2), height-1), TOP)
-    rOff = scan(img, (width-1, int(height/2)), LEFT)
-    
-    return (rOff, tOff, lOff, bOff)
+    rows, cols = borderScanlines(*img.shape[:2])
+    return borderBox(toGray(img[rows]), toGray(img[:, cols]).T)
 
 def trimmedMean(arr):
-    mean = numpy.mean(arr)
-    if (math.isnan(mean)):
+    arr = numpy.asarray(arr, dtype=numpy.float64)
+    if arr.size == 0:
         return 0.0
+    mean = numpy.mean(arr)
     std = numpy.std(arr)
     bottomCutoff = mean - std
     topCutoff = mean + std
-    if (math.isnan(mean)):
-        return 0.0
-    weights = [(1 if (x >= bottomCutoff and x <= topCutoff) else 0) for x in arr]
+    weights = (arr >= bottomCutoff) & (arr <= topCutoff)
     
     return numpy.average(arr, None, weights)
 
 '''
-Crop the image by offset pixels on all sides
+Crop the image array by offset pixels on all sides. Returns a view into
+image, not a copy.
 '''
 def crop(image, hCrop, vCrop):
     hCrop += MIN_CROP
     vCrop += MIN_CROP
     hCrop = int(hCrop)
     vCrop = int(vCrop)
-    cv.SetImageROI(image, (hCrop, vCrop, image.width - 2*hCrop, image.height - 2*vCrop))
-    image2 = cv.CreateImage(cv.GetSize(image), image.depth, image.nChannels)
-    cv.Copy(image, image2)
-    
-    imageMat = cv.GetMat(image2)
-    return imageMat
+    height, width = image.shape[:2]
+    return image[vCrop:height-vCrop, hCrop:width-hCrop]
 
 '''
-Downsize the imageMat by a factor of resizeFactor
+Downsize the 8bit 1channel image array by a factor of resizeFactor
 '''
 def makeThumbnail(imageMat, resizeFactor=1):
-    thumbnail = cv.CreateMat(int(imageMat.rows / resizeFactor), int(imageMat.cols / resizeFactor), cv.CV_8UC1)    
-    cv.Resize(imageMat, thumbnail, cv.CV_INTER_AREA)
-    return thumbnail
+    rows, cols = imageMat.shape[:2]
+    size = (int(cols / resizeFactor), int(rows / resizeFactor))
+    return cv2.resize(imageMat, size, interpolation=cv.CV_INTER_AREA)
     
 '''
-Convert the 8bit 1channel imageMat into an inverted binary matrix
+Convert the 8bit 1channel image array into an inverted binary matrix
 '''
 def makeBinary(imageMat):
-    binThumb = cv.CreateMat(imageMat.rows, imageMat.cols, cv.CV_8UC1)
-    cv.Threshold(imageMat, binThumb, BIN_THRESHOLD, BIN_COLOR, cv.CV_THRESH_BINARY_INV)
+    retval, binThumb = cv2.threshold(imageMat, BIN_THRESHOLD, BIN_COLOR, cv.CV_THRESH_BINARY_INV)
     return binThumb
 
 def takeDeriv(image):
-    dst = cv.CreateMat(image.rows-1, image.cols-1, cv.CV_8UC1)
+    return cv2.bitwise_xor(image[1:,1:], image[:-1,:-1])
+
+'''
+Return a single channel version of the 8bit image array, converting
+it from BGR if necessary.
+'''
+def toGray(image):
+    if len(image.shape) == 3:
+        return cv2.cvtColor(image, cv.CV_BGR2GRAY)
+    return image
+
+_stats = threading.local()
+
+def startStats(stats=None):
+    """
+    Start recording, on this thread, the stats of the image processed
+    next into the dict stats (a new one by default), and return it:
+    stats['times'] maps each of STAGES to the seconds spent in it, and
+    stats['counts'] holds the number of lines found and of foreground
+    pixels voting in each Hough pass (pass1_lines, pass1_foreground,
+    pass2_lines, pass2_foreground), cache_hits and cache_errors. A stage
+    that runs several times, e.g. hough1 with adaptive detection, adds
+    up. Passing the same dict on another thread adds to it.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('times', {})
+    stats.setdefault('counts', {})
+    _stats.current = stats
+    return stats
+
+def stopStats():
+    """
+    Stop recording stats on this thread. Returns the dict they went to.
+    """
+    stats = getattr(_stats, 'current', None)
+    _stats.current = None
+    return stats
+
+def addStat(kind, name, value):
+    stats = getattr(_stats, 'current', None)
+    if stats is not None:
+        stats[kind][name] = stats[kind].get(name, 0) + value
+
+class timed(object):
+    """
+    Time the enclosed block (with timed(stage): ...) as stage, if stats
+    are being recorded on this thread, see startStats.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.time()
+    
+    def __exit__(self, *exc):
+        addStat('times', self.stage, time.time() - self.start)
+
+_hough = {}
+
+def setHoughBackend(name=None):
+    """
+    Run the Hough transforms with the backend name, one of HOUGH_BACKENDS,
+    or with the first of them that can be imported if name is None.
+    Raises ImportError if it cannot be imported. Returns the name of the
+    backend now in use.
+    """
+    if name is not None and name not in HOUGH_BACKENDS:
+        raise ValueError("Unknown Hough backend: {0}".format(name))
+    names = [name] if name else list(HOUGH_BACKENDS)
+    for candidate in names:
+        try:
+            module = __import__(HOUGH_BACKENDS[candidate])
+        except ImportError:
+            if name:
+                raise
+            continue
+        _hough['name'] = candidate
+        _hough['module'] = module
+        return candidate
+    raise ImportError("None of the Hough backends ({0}) can be imported".format(
+        ', '.join(HOUGH_BACKENDS.values())))
+
+def houghBackend():
+    """
+    Return the name of the Hough transform backend in use.
+    """
+    return _hough['name']
 
-    cv.Xor(image[1:,1:], image[:-1,:-1], dst)
+setHoughBackend()
 
-    return dst
+def houghKernel():
+    """
+    The value of HOUGH_KERNEL to pass to the backend in use.
+    """
+    return getattr(_hough['module'], 'KERNEL_' + HOUGH_KERNEL.upper())
 
-def houghTransform(binaryImg, rho, theta, maxAngle, guess, method = METHOD_MEAN, graphImg = None):
-    minAccumulator = int(binaryImg.width * ACCUMULATOR)
+_planCache = threading.local()
+
+def getHoughPlan(shape, rho, theta, maxAngle, guess):
+    """
+    Return a HoughPlan of the Hough backend in use for binary maps of the
+    given shape, reusing a recently built one when the parameters match.
+    The plans are kept in a small LRU per thread, since a plan can only
+    run one transform at a time.
+    """
+    cache = getattr(_planCache, 'plans', None)
+    if cache is None:
+        cache = _planCache.plans = collections.OrderedDict()
+    key = (_hough['name'], tuple(shape), rho, theta, maxAngle, guess)
+    plan = cache.pop(key, None)
+    if plan is None:
+        plan = _hough['module'].HoughPlan(key[1], rho, math.radians(theta),
+                                          math.radians(maxAngle), math.radians(guess))
+        if len(cache) >= PLAN_CACHE_SIZE:
+            cache.popitem(last=False)
+    cache[key] = plan
+    return plan
 
+def houghLines(binaryImg, rho, theta, maxAngle, guess, threads = 1, topK = 0, name = None):
+    """
+    Find the lines within maxAngle of the vertical/horizontal (shifted
+    by guess) in binaryImg. Returns the arrays (rhos, thetas, votes),
+    sorted by decreasing votes, and limited to the topK best lines if
+    topK is positive. If name is given, the number of lines and of
+    foreground pixels are counted in the stats as name_lines and
+    name_foreground, see startStats.
+    """
     binaryArray = numpy.asarray(binaryImg)
+    minAccumulator = int(binaryArray.shape[1] * ACCUMULATOR)
+
+    foreground = numpy.count_nonzero(binaryArray)
+    density = foreground / float(max(binaryArray.size, 1))
+    sparse = int(density < SPARSE_DENSITY)
     
-    lines = lineDetect.findLines(binaryArray, rho, math.radians(theta), minAccumulator, math.radians(maxAngle), math.radians(guess))
+    plan = getHoughPlan(binaryArray.shape, rho, theta, maxAngle, guess)
+    lines = plan.run(binaryArray, minAccumulator, sparse=sparse, threads=threads, topK=topK,
+                     kernel=houghKernel())
+    if name is not None:
+        addStat('counts', name + '_lines', len(lines[0]))
+        addStat('counts', name + '_foreground', foreground)
+    return lines
 
-    angles = []
+def lineAngles(thetas, maxAngle, guess):
+    """
+    Classify the lines with normal angles thetas (in radians) as
+    vertical or horizontal. Returns (keep, angles): a boolean mask of the
+    lines that fall in one of the searched bands, and the angle (in
+    degrees) of each kept line from the vertical/horizontal.
+    """
+    angle = numpy.degrees(numpy.asarray(thetas, dtype=numpy.float64))
     
-    for (rho, theta) in lines:
-        if GRAPH and graphImg:
-            height = graphImg.height
-            
-            a = math.cos(theta)
-            b = math.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            pt1 = (cv.Round(x0 + height*(-b)), cv.Round(y0 + height*(a)))
-            pt2 = (cv.Round(x0 - height*(-b)), cv.Round(y0 - height*(a)))
-        
-        angle = math.degrees(theta)
-        
-        bottomStart = min(0-guess-maxAngle, 0-guess+maxAngle)
-        bottomEnd = max(0-guess-maxAngle, 0-guess+maxAngle)
-        midStart = min(90-guess+maxAngle, 90-guess-maxAngle)
-        midEnd = max(90-guess+maxAngle, 90-guess-maxAngle)
-        topStart = min(180-guess-maxAngle, 180-guess+maxAngle)
-        topEnd = max(180-guess-maxAngle, 180-guess+maxAngle)
-        
-        if (angle <= midEnd and angle >= midStart):
-            # Probably a vertical line
-            angles.append(90-angle)
-        elif (angle <= bottomEnd and angle >= bottomStart):
-            # Probably a horizontal line
-            angles.append(-angle)
-        elif (angle <= topEnd and angle >= topStart):
-            # Probably a horizontal line
-            angles.append(180-angle)
-            
-        if GRAPH and graphImg:
-            cv.Line(graphImg, pt1, pt2, cv.RGB(0, 255, 0))
+    bottomStart = min(0-guess-maxAngle, 0-guess+maxAngle)
+    bottomEnd = max(0-guess-maxAngle, 0-guess+maxAngle)
+    midStart = min(90-guess+maxAngle, 90-guess-maxAngle)
+    midEnd = max(90-guess+maxAngle, 90-guess-maxAngle)
+    topStart = min(180-guess-maxAngle, 180-guess+maxAngle)
+    topEnd = max(180-guess-maxAngle, 180-guess+maxAngle)
+    
+    # Probably a vertical line
+    mid = (angle <= midEnd) & (angle >= midStart)
+    # Probably a horizontal line
+    bottom = ~mid & (angle <= bottomEnd) & (angle >= bottomStart)
+    top = ~mid & ~bottom & (angle <= topEnd) & (angle >= topStart)
+    
+    keep = mid | bottom | top
+    angles = numpy.select([mid, bottom, top], [90-angle, -angle, 180-angle])
+    return keep, angles[keep]
+
+def graphLines(graphImg, rhos, thetas):
+    height = graphImg.shape[0]
+    for rho, theta in zip(rhos, thetas):
+        a = math.cos(theta)
+        b = math.sin(theta)
+        x0 = a * rho
+        y0 = b * rho
+        pt1 = (cv.Round(x0 + height*(-b)), cv.Round(y0 + height*(a)))
+        pt2 = (cv.Round(x0 - height*(-b)), cv.Round(y0 - height*(a)))
+        cv2.line(graphImg, pt1, pt2, (0, 255, 0))
+
+def lineMask(shape, rhos, thetas, halfWidth, length=None):
+    """
+    Return an 8bit mask of the given shape that is set within halfWidth
+    pixels of each of the lines (rhos, thetas). The lines are drawn length
+    pixels (by default, the size of the mask) each way from the closest
+    point to the origin.
+    """
+    mask = numpy.zeros(shape, dtype=numpy.uint8)
+    length = length or max(shape)
+    for rho, theta in zip(rhos, thetas):
+        a = math.cos(theta)
+        b = math.sin(theta)
+        x0 = a * rho
+        y0 = b * rho
+        pt1 = (int(round(x0 + length*(-b))), int(round(y0 + length*(a))))
+        pt2 = (int(round(x0 - length*(-b))), int(round(y0 - length*(a))))
+        cv2.line(mask, pt1, pt2, 255, 2*halfWidth + 1)
+    return mask
+
+def restrictToLines(binaryImg, rhos, thetas, window):
+    """
+    Clear every pixel of binaryImg that is not near one of the lines
+    (rhos, thetas), so that a second transform searching within window
+    degrees of those lines only votes from the pixels that can contribute
+    to them, see restrictMask.
+    """
+    binaryArray = numpy.asarray(binaryImg)
+    return cv2.bitwise_and(binaryArray, restrictMask(binaryArray.shape, rhos, thetas, window))
+
+def restrictMask(shape, rhos, thetas, window):
+    """
+    The mask of restrictToLines for a binary map of the given shape. The
+    band around each line is wide enough to contain the line at any angle
+    of the window, plus the first pass' rho quantization.
+    """
+    halfWidth = 2 + int(math.ceil(max(shape) * math.tan(math.radians(2 * window))))
+    return lineMask(shape, rhos, thetas, halfWidth)
+
+def estimateAngle(thetas, votes, maxAngle, guess, method = METHOD_MEAN):
+    """
+    Estimate the angle of rotation (in degrees) from the lines with normal
+    angles thetas and the given votes, found within maxAngle of guess.
+    """
+    keep, angles = lineAngles(thetas, maxAngle, guess)
+    
+    if angles.size == 0:
+        return 0.0
     
     if method == METHOD_MEAN:
         estAngle = float(numpy.mean(angles))
     elif method == METHOD_MEDIAN:
         estAngle = float(numpy.median(angles))
+    elif method == METHOD_WMEAN:
+        estAngle = float(numpy.average(angles, None, votes[keep]))
     else:
         estAngle = float(trimmedMean(angles))
         
@@ -166,95 +411,645 @@ def houghTransform(binaryImg, rho, theta, maxAngle, guess, method = METHOD_MEAN,
         estAngle = 0.0
         
     return estAngle
+
+def lineConfidence(thetas, votes, maxAngle, guess):
+    """
+    Score in [0, 1] how much to trust an angle estimated from the lines
+    (thetas, votes): the product of how well the lines agree on an angle
+    (their vote-weighted spread) and how many lines there are.
+    """
+    keep, angles = lineAngles(thetas, maxAngle, guess)
+    if angles.size < 2:
+        return 0.0
+    weights = votes[keep].astype(numpy.float64)
+    mean = numpy.average(angles, None, weights)
+    spread = math.sqrt(numpy.average((angles - mean)**2, None, weights))
+    agreement = 1.0 / (1.0 + spread / CONFIDENCE_SPREAD)
+    support = min(1.0, angles.size / float(CONFIDENCE_LINES))
+    return agreement * support
+
+def houghTransform(binaryImg, rho, theta, maxAngle, guess, method = METHOD_MEAN, graphImg = None, threads = 1,
+                   name = None):
+    rhos, thetas, votes = houghLines(binaryImg, rho, theta, maxAngle, guess, threads, name=name)
+    
+    if GRAPH and graphImg is not None:
+        graphLines(graphImg, rhos, thetas)
+    
+    return estimateAngle(thetas, votes, maxAngle, guess, method)
         
 '''
-Open the image @ filename, downsize it by a factor of resizeFactor
-and attempt to determine the angle of rotation by finding 
-near-vertical and near-horizontal lines and averaging their angle
-to the vertical or the horizontal, respectively. If GRAPH_LINES is
-true, graph the detected lines on the image and save the resulting
-graph in outputDir.
+Crop the margins of the grayscale image array that may fall outside of
+the page when it is rotated by up to maxAngle degrees.
 '''
-def detectRotation(path, resizeFactor=1, maxAngle=ROT_WINDOW, outputPath=''):    
-    image = cv.LoadImage(path, cv.CV_LOAD_IMAGE_GRAYSCALE)
-    
+def cropForDetection(image, maxAngle=ROT_WINDOW):
+    top, bottom, left, right = detectionBounds(image.shape, maxAngle)
+    return image[top:bottom, left:right]
+
+'''
+Return the part (top, bottom, left, right) of an image of the given
+shape that cropForDetection keeps.
+'''
+def detectionBounds(shape, maxAngle=ROT_WINDOW):
+    height, width = shape[:2]
     maxAngleRad = math.radians(maxAngle)
-    hCrop = math.ceil(math.sin(maxAngleRad) * image.height)
-    vCrop = math.ceil(math.sin(maxAngleRad) * image.width)
-    imageMat = crop(image, hCrop, vCrop)
-    
-    thumbnail = makeThumbnail(imageMat, resizeFactor)
+    hCrop = int(math.ceil(math.sin(maxAngleRad) * height)) + MIN_CROP
+    vCrop = int(math.ceil(math.sin(maxAngleRad) * width)) + MIN_CROP
+    return vCrop, height - vCrop, hCrop, width - hCrop
 
-    binThumb = makeBinary(thumbnail)
+'''
+Downsize the cropped imageMat by a factor of resizeFactor and attempt
+to determine the angle of rotation by finding near-vertical and
+near-horizontal lines and averaging their angle to the vertical or the
+horizontal, respectively. Returns (angle1, angle2, confidence), where
+confidence scores the first pass lines. If secondPass is false, only the
+first pass runs and angle2 is angle1. name is used to name the GRAPH
+output.
+'''
+def detectRotationMat(imageMat, resizeFactor=1, maxAngle=ROT_WINDOW, name='', threads=1,
+                      restrict=RESTRICT_PASS2, secondPass=True):
+    with timed('thumbnail'):
+        thumbnail = makeThumbnail(imageMat, resizeFactor)
 
-    if FILTER:
-        binThumb = takeDeriv(binThumb)
+    with timed('threshold'):
+        binThumb = makeBinary(thumbnail)
+        if FILTER:
+            binThumb = takeDeriv(binThumb)
     
-    filename = os.path.split(path)[1]
-    filename, ext = os.path.splitext(filename)
+    filename, ext = os.path.splitext(name)
      
     # First pass
     
     graphImg = None
     
     if GRAPH:
-        graphImg = cv.CreateMat(thumbnail.rows, thumbnail.cols, cv.CV_8UC3)
-        cv.CvtColor(thumbnail, graphImg, cv.CV_GRAY2BGR)
-        if DEBUG:
-            print graphImg;
+        graphImg = cv2.cvtColor(thumbnail, cv.CV_GRAY2BGR)
     
-    angle1 = houghTransform(binThumb, 1, 0.1, maxAngle, 0.0, METHOD_TMEAN, graphImg)
+    with timed('hough1'):
+        rhos, thetas, votes = houghLines(binThumb, 1, PASS1_THETA, maxAngle, 0.0, threads,
+                                         name='pass1')
+        angle1 = estimateAngle(thetas, votes, maxAngle, 0.0, METHOD_TMEAN)
+        confidence = lineConfidence(thetas, votes, maxAngle, 0.0)
 
     if GRAPH:
+        graphLines(graphImg, rhos, thetas)
         # TODO: Maybe make separate directories for GRAPH imgs?
-        cv.SaveImage(os.path.join('.', 'binary_{0}{1}'.format(filename, ext)), binThumb)
-        cv.SaveImage(os.path.join('.', 'lines_{0}{1}'.format(filename, ext)), graphImg)
+        cv2.imwrite(os.path.join('.', 'binary_{0}{1}'.format(filename, ext)), binThumb)
+        cv2.imwrite(os.path.join('.', 'lines_{0}{1}'.format(filename, ext)), graphImg)
+    
+    if not secondPass:
+        return (angle1, angle1, confidence)
         
     # Second pass
     
     if GRAPH:
-        graphImg = cv.CreateMat(thumbnail.rows, thumbnail.cols, cv.CV_8UC3)
-        cv.CvtColor(thumbnail, graphImg, cv.CV_GRAY2BGR)
+        graphImg = cv2.cvtColor(thumbnail, cv.CV_GRAY2BGR)
     
-    angle2 = houghTransform(binThumb, 1, 0.01, 0.1, angle1, METHOD_MEDIAN, graphImg)
+    with timed('hough2'):
+        pass2Img = binThumb
+        if restrict and numpy.count_nonzero(binThumb) >= RESTRICT_MIN_FOREGROUND:
+            keep, angles = lineAngles(thetas, maxAngle, 0.0)
+            pass2Img = restrictToLines(binThumb, rhos[keep][:PASS2_MAX_LINES],
+                                       thetas[keep][:PASS2_MAX_LINES], PASS2_WINDOW)
+        
+        angle2 = houghTransform(pass2Img, 1, PASS2_THETA, PASS2_WINDOW, angle1, METHOD_MEDIAN,
+                                graphImg, threads, name='pass2')
     
     if GRAPH:
-        cv.SaveImage(os.path.join('.', 'lines_pass2_{0}{1}'.format(filename, ext)), graphImg)
+        cv2.imwrite(os.path.join('.', 'lines_pass2_{0}{1}'.format(filename, ext)), graphImg)
 
-    return (angle1, angle2)
+    return (angle1, angle2, confidence)
 
-def rotateImage(image, angle):
-    image_center = tuple(numpy.array(cv.GetSize(image))/2)
-    rot_mat = cv.CreateMat(2, 3, cv.CV_32F)
-    cv.GetRotationMatrix2D(image_center, angle, 1.0, rot_mat)
-    result = cv.CreateImage(cv.GetSize(image), image.depth, image.nChannels) 
-    cv.WarpAffine(image, result, rot_mat)
+'''
+Yield (row, strip): the thumbnail that makeThumbnail would make of the
+part bounds (top, bottom, left, right) of the image source, stripRows
+rows at a time, along with the index of the first row of each strip.
+Only the rows of source that a strip is made from are read at a time
+(and converted to grayscale), so source may be anything that returns
+an array for a slice of its rows, like a numpy memmap or NpyRows. With a
+resizeFactor that does not divide the size of the part, the pixels on
+the edges of the strips are averaged slightly differently.
+'''
+def thumbnailStrips(source, bounds, resizeFactor, stripRows=STRIP_ROWS):
+    top, bottom, left, right = bounds
+    size = (int((right - left) / resizeFactor), int((bottom - top) / resizeFactor))
+    scale = (bottom - top) / float(size[1])
+    for row in range(0, size[1], stripRows):
+        end = min(row + stripRows, size[1])
+        rows = source[top + int(round(row * scale)):top + int(round(end * scale))]
+        with timed('thumbnail'):
+            rows = toGray(numpy.ascontiguousarray(rows[:, left:right]))
+            thumb = cv2.resize(rows, (size[0], end - row), interpolation=cv.CV_INTER_AREA)
+        yield row, thumb
 
-    return result
+'''
+Yield (row, strip): the binary map that detectRotationMat would make of
+the part bounds of the image source, a strip at a time, see
+thumbnailStrips. The strips follow each other without overlap, and
+together make a map of binaryShape(bounds, resizeFactor).
+'''
+def binaryStrips(source, bounds, resizeFactor, stripRows=STRIP_ROWS):
+    last = None
+    for row, thumb in thumbnailStrips(source, bounds, resizeFactor, stripRows):
+        with timed('threshold'):
+            binStrip = makeBinary(thumb)
+            if FILTER:
+                # takeDeriv pairs each row with the one above it
+                if last is not None:
+                    last, binStrip = binStrip[-1:], takeDeriv(numpy.vstack([last, binStrip]))
+                    row -= 1
+                else:
+                    last, binStrip = binStrip[-1:], takeDeriv(binStrip)
+        yield row, binStrip
 
-def fixRotation(fname, angle):
+def binaryShape(bounds, resizeFactor):
+    """
+    The shape of the binary map that binaryStrips yields.
+    """
+    top, bottom, left, right = bounds
+    shape = (int((bottom - top) / resizeFactor), int((right - left) / resizeFactor))
+    if FILTER:
+        shape = (shape[0] - 1, shape[1] - 1)
+    return shape
+
+def stripLines(source, bounds, resizeFactor, stripRows, theta, maxAngle, guess, threads=1,
+               lines=None, stage=None, name=None):
+    """
+    Find the lines as houghLines does, in the binary map of the part
+    bounds of the image source, voting from one strip of the map at a
+    time (see binaryStrips) into a HoughPlan for the whole map. If lines
+    (rhos, thetas) are given, each strip is first restricted to the
+    pixels near them, as restrictToLines does. The voting is timed as
+    stage, and the lines and foreground pixels are counted as name, see
+    houghLines. Returns ((rhos, thetas, votes), foreground): the lines,
+    and the number of foreground pixels voted from.
+    """
+    shape = binaryShape(bounds, resizeFactor)
+    minAccumulator = int(shape[1] * ACCUMULATOR)
+    plan = getHoughPlan(shape, 1, theta, maxAngle, guess)
+    plan.reset()
+    foreground = 0
+    mask = None
+    if lines is not None:
+        # Drawn for the whole map, as the lines drawn on a strip would be
+        # clipped, and so rasterized, differently, and kept a bit per pixel
+        with timed(stage):
+            mask = numpy.packbits(restrictMask(shape, lines[0], lines[1], maxAngle), axis=1)
+    for row, binStrip in binaryStrips(source, bounds, resizeFactor, stripRows):
+        with timed(stage):
+            if mask is not None:
+                stripMask = numpy.unpackbits(mask[row:row + len(binStrip)], axis=1)
+                binStrip = binStrip * stripMask[:, :shape[1]]
+            count = numpy.count_nonzero(binStrip)
+            foreground += count
+            sparse = int(count < SPARSE_DENSITY * max(binStrip.size, 1))
+            plan.accumulate(binStrip, row, sparse=sparse, threads=threads, kernel=houghKernel())
+    with timed(stage):
+        found = plan.peaks(minAccumulator)
+    if name is not None:
+        addStat('counts', name + '_lines', len(found[0]))
+        addStat('counts', name + '_foreground', foreground)
+    return found, foreground
+
+'''
+Detect the angle of rotation as detectRotationMat does, on the part bounds
+(top, bottom, left, right) of the image source, without ever holding the
+whole thumbnail or binary map: they are made and voted from stripRows
+rows at a time, see stripLines. The second pass reads the strips of
+source again. Memory use is then bounded by the Hough accumulator, a
+strip and, for the second pass, the mask of the first pass' lines (a
+bit per pixel of the binary map, once drawn), however large the page.
+GRAPH output is not supported.
+Returns (angle1, angle2, confidence).
+'''
+def detectRotationStrips(source, bounds, resizeFactor=1, maxAngle=ROT_WINDOW, threads=1,
+                         restrict=RESTRICT_PASS2, secondPass=True, stripRows=STRIP_ROWS):
+    (rhos, thetas, votes), foreground = stripLines(source, bounds, resizeFactor, stripRows,
+                                                   PASS1_THETA, maxAngle, 0.0, threads,
+                                                   stage='hough1', name='pass1')
+    with timed('hough1'):
+        angle1 = estimateAngle(thetas, votes, maxAngle, 0.0, METHOD_TMEAN)
+        confidence = lineConfidence(thetas, votes, maxAngle, 0.0)
+    
+    if not secondPass:
+        return (angle1, angle1, confidence)
+    
+    lines = None
+    if restrict and foreground >= RESTRICT_MIN_FOREGROUND:
+        keep, angles = lineAngles(thetas, maxAngle, 0.0)
+        lines = (rhos[keep][:PASS2_MAX_LINES], thetas[keep][:PASS2_MAX_LINES])
+    (rhos, thetas, votes), foreground = stripLines(source, bounds, resizeFactor, stripRows,
+                                                   PASS2_THETA, PASS2_WINDOW, angle1, threads,
+                                                   lines, stage='hough2', name='pass2')
+    with timed('hough2'):
+        angle2 = estimateAngle(thetas, votes, PASS2_WINDOW, angle1, METHOD_MEDIAN)
+    
+    return (angle1, angle2, confidence)
+
+class NpyRows(object):
+    """
+    The image array saved (by numpy.save) in the .npy file at path, read
+    from the file a slice of rows at a time, for detectRotationStrips:
+    source[a:b] reads rows a to b. Unlike a memmap, the rows read do not
+    stay mapped in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = numpy.lib.format.read_array_header_2_0(f)
+            self.offset = f.tell()
+        finally:
+            f.close()
+        if fortran or dtype != numpy.uint8 or len(shape) not in (2, 3):
+            raise ValueError("Not an 8bit image array in C order: {0}".format(path))
+        self.shape = shape
+        self.dtype = dtype
+        self.rowSize = int(numpy.prod(shape[1:]))
+    
+    def __getitem__(self, rows):
+        start, stop, step = rows.indices(self.shape[0])
+        with timed('read'):
+            f = open(self.path, 'rb')
+            try:
+                f.seek(self.offset + start * self.rowSize)
+                data = numpy.fromfile(f, self.dtype, max(stop - start, 0) * self.rowSize)
+            finally:
+                f.close()
+        return data.reshape((-1,) + tuple(self.shape[1:]))[::step]
+
+'''
+Detect the angle of rotation of the grayscale image array with
+detectRotationMat, downsizing it by a factor of resizeFactor. If GRAPH
+is true, graph the detected lines on the image and save the resulting
+graphs, named after name. The line detection is split across threads
+threads, and releases the GIL while it runs. If restrict is true, the
+second, finer pass only votes from the pixels near the lines found by
+the first, on binary maps with at least RESTRICT_MIN_FOREGROUND
+foreground pixels. If stripRows is given, the detection is done a strip of
+stripRows thumbnail rows at a time with detectRotationStrips, and gray
+may be any source of rows that it accepts.
+If adaptive is true, first try the cheaper ADAPTIVE_FACTORS (those
+larger than resizeFactor) with a single pass, and only fall back to the
+full two passes at resizeFactor if none of them is confident enough.
+Returns (angle1, angle2, confidence).
+'''
+def detectRotationArray(gray, resizeFactor=1, maxAngle=ROT_WINDOW, name='', threads=1,
+                        restrict=RESTRICT_PASS2, adaptive=False, stripRows=None):
+    if stripRows:
+        bounds = detectionBounds(gray.shape, maxAngle)
+        def detect(factor, secondPass=True):
+            return detectRotationStrips(gray, bounds, factor, maxAngle, threads, restrict,
+                                        secondPass, stripRows)
+    else:
+        with timed('crop'):
+            imageMat = cropForDetection(gray, maxAngle)
+        def detect(factor, secondPass=True):
+            return detectRotationMat(imageMat, factor, maxAngle, name, threads, restrict,
+                                     secondPass)
+    
+    if adaptive:
+        for factor in ADAPTIVE_FACTORS:
+            if factor <= resizeFactor:
+                continue
+            result = detect(factor, secondPass=False)
+            if DEBUG:
+                print "Factor {0}: angle {1}, confidence {2}".format(factor, result[0], result[2])
+            if result[2] >= CONFIDENCE_THRESHOLD:
+                return result
+    
+    return detect(resizeFactor)
+
+'''
+Open the image @ path in grayscale and detect its angle of rotation with
+detectRotationArray. Returns (angle1, angle2, confidence).
+If stripRows is given, the detection is done a strip at a time, and an
+image array saved as .npy is read from the file a strip at a time too
+(see NpyRows), so that it is never in memory as a whole. Other formats
+are decoded whole first.
+'''
+def detectRotation(path, resizeFactor=1, maxAngle=ROT_WINDOW, outputPath='', threads=1,
+                   restrict=RESTRICT_PASS2, adaptive=False, stripRows=None):    
+    if os.path.splitext(path)[1].lower() == '.npy':
+        gray = NpyRows(path) if stripRows else toGray(numpy.load(path))
+    else:
+        gray = loadImage(path, cv.CV_LOAD_IMAGE_GRAYSCALE)
+    return detectRotationArray(gray, resizeFactor, maxAngle, os.path.split(path)[1],
+                               threads, restrict, adaptive, stripRows)
+
+def rotateImage(image, angle):
+    height, width = image.shape[:2]
+    image_center = (width / 2, height / 2)
+    rot_mat = cv2.getRotationMatrix2D(image_center, angle, 1.0)
+    return cv2.warpAffine(image, rot_mat, (width, height))
+
+def fixRotationArray(img, angle):
     """
-    Given the path to the image, the estimated angle of rotation and an output
-    directory, rotate the image by -angle and save the resulting image in
-    outDir. Returns the unrotated image.
+    Given the image array and the estimated angle of rotation, rotate the
+    image by -angle and crop away the black border around the page.
+    Returns the unrotated image.
     """
-    img = cv.LoadImage(fname, cv.CV_LOAD_IMAGE_COLOR)
+    rOff, tOff, lOff, bOff = findBorderRotated(img, angle)
     img = rotateImage(img, -angle)
+    return img[tOff:bOff, lOff:rOff]
+
+def findBorderRotated(img, angle):
+    """
+    Return the border box (rOff, tOff, lOff, bOff) that findBorder would
+    find on the image array once rotated by -angle, without rotating the
+    whole image: only the scanlines that findBorder looks at are sampled
+    from img, and only they are converted to grayscale.
+    """
+    height, width = img.shape[:2]
+    rot_mat = cv2.getRotationMatrix2D((width / 2, height / 2), -angle, 1.0)
+    inv = cv2.invertAffineTransform(rot_mat)
+    rows, cols = borderScanlines(height, width)
+    
+    def sample(xs, ys):
+        mapX = (inv[0, 0]*xs + inv[0, 1]*ys + inv[0, 2]).astype(numpy.float32)
+        mapY = (inv[1, 0]*xs + inv[1, 1]*ys + inv[1, 2]).astype(numpy.float32)
+        return toGray(cv2.remap(img, mapX, mapY, cv.CV_INTER_LINEAR))
+    
+    xs, ys = numpy.meshgrid(numpy.arange(width, dtype=numpy.float32), rows)
+    rowPixels = sample(xs, ys)
+    ys, xs = numpy.meshgrid(numpy.arange(height, dtype=numpy.float32), cols)
+    colPixels = sample(xs, ys)
+    return borderBox(rowPixels, colPixels)
+
+def outputTransform(shape, angle, box, imgsize=None, imgsize_rescale=None):
+    """
+    Compose, into a single affine transform, what straightening does to an
+    image of the given shape after detection: rotate it by -angle, crop
+    it to the border box (rOff, tOff, lOff, bOff), pad/crop the result to
+    imgsize and rescale it to a width of imgsize_rescale.
+    Returns (M, (width, height), (validWidth, validHeight)): the 2x3
+    transform, the output size and the size of the top left part of the
+    output that comes from inside the border box (the rest is padding).
+    """
+    height, width = shape[:2]
+    rOff, tOff, lOff, bOff = box
+    rot_mat = cv2.getRotationMatrix2D((width / 2, height / 2), -angle, 1.0)
+    M = numpy.vstack([rot_mat, (0, 0, 1)])
+    M = numpy.dot(numpy.array([[1, 0, -lOff], [0, 1, -tOff], [0, 0, 1]], dtype=numpy.float64), M)
     
-    grayImg = cv.CreateMat(img.height, img.width, cv.CV_8UC1)
-    cv.CvtColor(img, grayImg, cv.CV_BGR2GRAY)
-    rOff, tOff, lOff, bOff = findBorder(numpy.asarray(grayImg))
-    cv.SetImageROI(img, (lOff, tOff, rOff-lOff, bOff-tOff))
+    outW, outH = rOff - lOff, bOff - tOff
+    validW, validH = outW, outH
+    if imgsize:
+        outW, outH = imgsize
+        validW, validH = min(validW, outW), min(validH, outH)
+    if imgsize_rescale:
+        W_OUT = imgsize_rescale
+        H_OUT = int(round(outH / (float(outW) / W_OUT)))
+        sx, sy = W_OUT / float(outW), H_OUT / float(outH)
+        # scale about pixel centers, like cv2.resize
+        M = numpy.dot(numpy.array([[sx, 0, 0.5*sx - 0.5], [0, sy, 0.5*sy - 0.5], [0, 0, 1]],
+                                  dtype=numpy.float64), M)
+        outW, outH = W_OUT, H_OUT
+        validW, validH = int(round(validW * sx)), int(round(validH * sy))
+    return M[:2], (outW, outH), (validW, validH)
+
+def warpToOutput(img, angle, box, imgsize=None, imgsize_rescale=None):
+    """
+    Straighten img in a single warp, straight into an output buffer of
+    the final size: see outputTransform. Padding is black, as with
+    size_image_noresize. Large downscales (by more than
+    MAX_WARP_DOWNSCALE) are done with a separate area resize after the
+    warp instead, to avoid aliasing.
+    """
+    M, size, valid = outputTransform(img.shape, angle, box, imgsize, imgsize_rescale)
+    scale = math.sqrt(abs(numpy.linalg.det(M[:, :2])))
+    if scale < 1.0 / MAX_WARP_DOWNSCALE:
+        M, full, valid = outputTransform(img.shape, angle, box, imgsize)
+        with timed('warp'):
+            out = cv2.warpAffine(img, M, full, flags=cv.CV_INTER_LINEAR)
+        with timed('resize'):
+            out[valid[1]:] = 0
+            out[:, valid[0]:] = 0
+            return cv2.resize(out, size, interpolation=cv.CV_INTER_AREA)
+    
+    flags = cv.CV_INTER_CUBIC if scale > 1.0 else cv.CV_INTER_LINEAR
+    with timed('warp'):
+        out = cv2.warpAffine(img, M, size, flags=flags)
+    # The resize and padding are part of the warp; only the padding is
+    # cleared here.
+    with timed('resize'):
+        out[valid[1]:] = 0
+        out[:, valid[0]:] = 0
+    return out
+
+def fixRotation(fname, angle):
+    """
+    Given the path to the image and the estimated angle of rotation,
+    rotate the image by -angle. Returns the unrotated image.
+    """
+    return fixRotationArray(loadImage(fname), angle)
 
-    #cv.SaveImage(outName, img)
+def loadImage(path, flags=cv.CV_LOAD_IMAGE_COLOR):
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise IOError("Could not read image: {0}".format(path))
     return img
 
+def readImageFile(path):
+    with timed('read'):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+def decodeImage(data, flags=cv.CV_LOAD_IMAGE_COLOR, name=''):
+    """
+    Decode the encoded image data (the contents of an image file), as
+    loadImage does for a path.
+    """
+    with timed('decode'):
+        img = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), flags)
+    if img is None:
+        raise IOError("Could not decode image: {0}".format(name))
+    return img
+
+class DetectionCache(object):
+    """
+    A persistent cache of detection results (angle1, angle2, confidence,
+    box), as returned by detect_array, in an SQLite database in cachedir.
+    Entries are keyed by the hash of the image file, the detection
+    parameters, the decode and DETECTION_VERSION, see key, so changing
+    the output size or format still hits the cache. Several processes
+    can share one cache. An entry that can't be read, for instance while
+    the database is locked by another process for longer than its
+    timeout, is a miss, and one that can't be stored is dropped.
+    """
+    def __init__(self, cachedir=CACHE_DIR, maxEntries=CACHE_MAX_ENTRIES):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.maxEntries = maxEntries
+        self.inserts = 0
+        self.touched = {}
+        self.db = sqlite3.connect(os.path.join(cachedir, CACHE_NAME), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS detections "
+                        "(key TEXT PRIMARY KEY, value TEXT, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS detections_used ON detections (used)")
+        self.db.commit()
+    
+    @staticmethod
+    def key(data, resize, maxAngle, filter, adaptive, stripRows=None, decodedGray=False):
+        """
+        Return the cache key of the image file contents data detected with
+        the given parameters, by this DETECTION_VERSION. decodedGray
+        tells if the image was decoded as a single channel: the decoder's
+        grayscale image can differ by a level from toGray of its color
+        image, which can move the angle.
+        """
+        params = (DETECTION_VERSION, float(resize), float(maxAngle), bool(filter),
+                  bool(adaptive), bool(decodedGray))
+        if stripRows:
+            # The strips can average the thumbnail's pixels slightly
+            # differently, see thumbnailStrips
+            params += (int(stripRows),)
+        params = repr(params)
+        return hashlib.sha1(data).hexdigest() + ':' + params
+    
+    def get(self, key):
+        try:
+            row = self.db.execute("SELECT value FROM detections WHERE key = ?",
+                                  (key,)).fetchone()
+        except sqlite3.Error:
+            addStat('counts', 'cache_errors', 1)
+            return None
+        if row is None:
+            return None
+        self.touched[key] = time.time()
+        if len(self.touched) >= CACHE_TOUCH_INTERVAL:
+            self.touch()
+        angle1, angle2, confidence, box = json.loads(row[0])
+        return angle1, angle2, confidence, tuple(box)
+    
+    def put(self, key, detected):
+        angle1, angle2, confidence, box = detected
+        value = json.dumps([angle1, angle2, confidence, list(box)])
+        try:
+            self.db.execute("INSERT OR REPLACE INTO detections VALUES (?, ?, ?)",
+                            (key, value, time.time()))
+            self.db.commit()
+        except sqlite3.Error:
+            addStat('counts', 'cache_errors', 1)
+            self.rollback()
+            return
+        self.inserts += 1
+        if self.inserts % CACHE_EVICT_INTERVAL == 0:
+            self.evict()
+    
+    def touch(self):
+        """
+        Write the last use of the entries hit since the last touch.
+        """
+        touched, self.touched = self.touched, {}
+        try:
+            self.db.executemany("UPDATE detections SET used = ? WHERE key = ?",
+                                [(used, key) for key, used in touched.iteritems()])
+            self.db.commit()
+        except sqlite3.Error:
+            addStat('counts', 'cache_errors', 1)
+            self.rollback()
+    
+    def rollback(self):
+        try:
+            self.db.rollback()
+        except sqlite3.Error:
+            pass
+    
+    def evict(self):
+        """
+        Drop the least recently used entries beyond maxEntries.
+        """
+        self.touch()
+        try:
+            count = self.db.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+            if count > self.maxEntries:
+                self.db.execute("DELETE FROM detections WHERE key IN (SELECT key FROM "
+                                "detections ORDER BY used LIMIT ?)", (count - self.maxEntries,))
+                self.db.commit()
+        except sqlite3.Error:
+            addStat('counts', 'cache_errors', 1)
+            self.rollback()
+    
+    def close(self):
+        if self.touched:
+            self.touch()
+        self.db.close()
+
+def openCache(cachedir):
+    """
+    Return the DetectionCache in cachedir, or None, after a warning on
+    stderr, if it can't be opened (the directory can't be created, the
+    database is locked or corrupt...): detecting without the cache is
+    slower, but gives the same results.
+    """
+    try:
+        return DetectionCache(cachedir)
+    except (sqlite3.Error, OSError, IOError) as e:
+        # in one write, as the workers of a pool may all warn at once
+        sys.stderr.write("Warning: running without the detection cache in {0}: {1}\n".format(
+            cachedir, e))
+        return None
+
+def straighten_array(img, resize=2.0, maxAngle=4.0, imgsize=None,
+                     imgsize_rescale=None, grayscale=False, threads=1,
+                     adaptive=False, name=''):
+    """
+    Given an image array (BGR or single channel), straighten the image
+    (by detecting the rotation offset). The grayscale image that the
+    rotation is detected on is derived from img, so the image only has
+    to be decoded once. The rotation, border crop, padding to imgsize
+    and rescaling are all done by one warp, see warpToOutput. If
+    grayscale is True, only that grayscale image is warped.
+    Input:
+        nparray img: the image.
+        str name: name of the image, used to name the GRAPH output.
+        Other arguments are as in straighten_image.
+    Output:
+        (nparray straightened, (angle1, angle2, confidence))
+    """
+    gray = toGray(img)
+    angle1, angle2, confidence, box = detect_array(gray, resize, maxAngle, threads,
+                                                   adaptive, name)
+    if grayscale:
+        img = gray
+    img = warpToOutput(img, angle2, box, imgsize, imgsize_rescale)
+    return img, (angle1, angle2, confidence)
+
+def detect_array(gray, resize=2.0, maxAngle=4.0, threads=1, adaptive=False, name='',
+                 stripRows=None):
+    """
+    Detect the rotation of the grayscale image array gray, and the border
+    box of the page once it is rotated back, without straightening it.
+    If stripRows is given, the rotation is detected a strip of that many
+    thumbnail rows at a time, see detectRotationStrips. Other arguments
+    are as in straighten_array.
+    Output:
+        (angle1, angle2, confidence, (rOff, tOff, lOff, bOff))
+    """
+    angle1, angle2, confidence = detectRotationArray(gray, resize, maxAngle, name, threads,
+                                                     adaptive=adaptive, stripRows=stripRows)
+    if DEBUG:
+        print "Angle1: {0}, angle2: {1}, confidence: {2}".format(angle1, angle2, confidence)
+    with timed('border'):
+        box = findBorderRotated(gray, angle2)
+    return angle1, angle2, confidence, box
+
 def straighten_image(imgpath, outputpath, resize=2.0, maxAngle=4.0, imgsize=None,
                      debug=None, graph=None, filter=None, imgsize_rescale=None,
-                     grayscale=False):
+                     grayscale=False, threads=1, adaptive=False, cache=None,
+                     stripRows=None):
     """
     Given an image, straighten the image (by detecting the rotation
     offset), and save the straightened image to outpath.
+    The image file is read once: it is hashed to look the detection up in
+    cache, if given, and then decoded.
     If imgsize is given, then pad/crop the output image such that it
     is of size imgsize.
     Input:
@@ -264,30 +1059,200 @@ def straighten_image(imgpath, outputpath, resize=2.0, maxAngle=4.0, imgsize=None
         str output: output filepath
         tuple imgsize: (WIDTH, HEIGHT) in pixels
         int imgsize_rescale: Final WIDTH, in pixels. Maintain aspect ratio.
-        bool grayscale: If True, then output images as grayscale.
+        bool grayscale: If True, then output images as grayscale. The
+                        image is then decoded, detected, warped and
+                        encoded as a single channel. On scanned (neutral
+                        gray) pages the output matches the CV_RGB2GRAY
+                        conversion of the color output to within
+                        rounding, see benchmark.py --paths grayscale.
+        int threads: Number of threads to use for the line detection.
+        bool adaptive: If True, try detecting the rotation on smaller
+                       thumbnails first, see detectRotation.
+        DetectionCache cache: If given, reuse the detection from the
+                              cache if there is one, and store it if not.
+        int stripRows: If given, detect the rotation a strip of that many
+                       thumbnail rows at a time, see detect_array. An
+                       image array saved as .npy is then detected from
+                       the file, see detect_npy, without the cache.
+    Output:
+        (angle1, angle2, confidence) as returned by detectRotation.
+    """
+    setOptions(debug, graph, filter)
+    if stripRows and isNpy(imgpath):
+        angle1, angle2, confidence, box = detect_npy(imgpath, resize, maxAngle, threads,
+                                                     adaptive, stripRows)
+        img = loadNpy(imgpath)
+        if grayscale:
+            img = toGray(img)
+    else:
+        data, img = readImage(imgpath, grayscale)
+        angle1, angle2, confidence, box = cachedDetect(data, img, resize, maxAngle, threads,
+                                                       adaptive, cache, imgpath, stripRows)
+    img = warpToOutput(img, angle2, box, imgsize, imgsize_rescale)
+    writeImage(outputpath, img)
+    return angle1, angle2, confidence
+
+def setOptions(debug=None, graph=None, filter=None, backend=None):
+    """
+    Set DEBUG, GRAPH and FILTER, and the Hough backend (see
+    setHoughBackend), leaving those that are None as they are.
     """
     global DEBUG, GRAPH, FILTER
     if debug != None: DEBUG = debug
     if graph != None: GRAPH = graph
     if filter != None: FILTER = filter
-    angle1, angle2 = detectRotation(imgpath, resize, maxAngle, outputpath)
-    if DEBUG:
-        print "Angle1: {0}, angle2: {1}".format(angle1, angle2)
-    img = fixRotation(imgpath, angle2)
-    img_np = numpy.asarray(img[:,:])
+    if backend != None: setHoughBackend(backend)
 
-    if grayscale and img.nChannels == 3:
-        img_gray = cv2.cvtColor(img_np, cv.CV_RGB2GRAY)
-        img = img_gray
+def isNpy(path):
+    return os.path.splitext(path)[1].lower() == '.npy'
+
+def loadNpy(path):
+    """
+    Load the image array saved (by numpy.save) in the .npy file at path.
+    """
+    with timed('read'):
+        return numpy.load(path)
+
+def readImage(imgpath, grayscale=False):
+    """
+    Read the image file at imgpath, and decode it (as a single channel
+    if grayscale), or load it if it is an image array saved as .npy.
+    Returns (data, img): the file contents and the image.
+    """
+    data = readImageFile(imgpath)
+    if isNpy(imgpath):
+        with timed('decode'):
+            img = numpy.load(StringIO.StringIO(data))
+        return data, toGray(img) if grayscale else img
+    if grayscale:
+        return data, decodeImage(data, cv.CV_LOAD_IMAGE_GRAYSCALE, imgpath)
+    return data, decodeImage(data, cv.CV_LOAD_IMAGE_COLOR, imgpath)
+
+def encoderParams(outputpath, pngLevel=None, pngStrategy=None):
+    """
+    Return the cv2.imwrite parameters for outputpath: for a PNG, the
+    zlib compression level pngLevel (0-9) and strategy pngStrategy (a
+    key of PNG_STRATEGIES), if given. OpenCV's default is tuned for
+    speed (level 1, the 'sub' row filter and the 'rle' strategy); giving
+    a level also switches libpng to adaptive row filtering, which
+    compresses better but is slower. TIFFs are written uncompressed.
+    """
+    ext = os.path.splitext(outputpath)[1].lower()
+    params = []
+    if ext == '.png':
+        if pngLevel is not None:
+            params += [IMWRITE_PNG_COMPRESSION, int(pngLevel)]
+        if pngStrategy is not None:
+            params += [IMWRITE_PNG_STRATEGY, PNG_STRATEGIES[pngStrategy]]
+    elif ext in ('.tif', '.tiff'):
+        params += [IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION_NONE]
+    return params
+
+def encodeImage(outputpath, img, params=()):
+    """
+    Return the contents of the image file that writeImage would write to
+    outputpath.
+    """
+    if os.path.splitext(outputpath)[1].lower() == '.npy':
+        buf = StringIO.StringIO()
+        with timed('save'):
+            numpy.save(buf, img)
+        return buf.getvalue()
+    with timed('save'):
+        ok, data = cv2.imencode(os.path.splitext(outputpath)[1], img, list(params))
+    if not ok:
+        raise IOError("Could not encode image: {0}".format(outputpath))
+    return data.tostring()
+
+def writeImage(outputpath, img, params=()):
+    """
+    Encode and save the image array to outputpath, in the format given
+    by its extension, with the cv2.imwrite parameters params (see
+    encoderParams). A .npy path gets the raw array, with numpy.save.
+    """
+    with timed('save'):
+        if os.path.splitext(outputpath)[1].lower() == '.npy':
+            numpy.save(outputpath, img)
+            return
+        ok = cv2.imwrite(outputpath, img, list(params))
+    if not ok:
+        raise IOError("Could not write image: {0}".format(outputpath))
+
+def cachedDetect(data, img, resize, maxAngle, threads, adaptive, cache, imgpath,
+                 stripRows=None):
+    """
+    Run detect_array on the decoded image img (whose file contents are
+    data), or take its result from cache if it is there. The result is
+    cached apart for a color and a single channel img, see
+    DetectionCache.key.
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(data, resize, maxAngle, FILTER, adaptive, stripRows,
+                        len(img.shape) == 2)
+        detected = cache.get(key)
+        if detected is not None:
+            addStat('counts', 'cache_hits', 1)
+            if DEBUG:
+                print "Detection cache hit: {0}".format(imgpath)
+            return detected
+    detected = detect_array(toGray(img), resize, maxAngle, threads, adaptive,
+                            os.path.split(imgpath)[1], stripRows)
+    if cache is not None:
+        cache.put(key, detected)
+    return detected
+
+def detect_image(imgpath, resize=2.0, maxAngle=4.0, debug=None, graph=None,
+                 filter=None, threads=1, adaptive=False, cache=None, stripRows=None,
+                 grayscale=False):
+    """
+    Given an image, only detect its rotation and border box, see
+    detect_array, and write nothing. The image is decoded as
+    straighten_image would with the same grayscale, so that apply_image
+    gives the same output. Arguments are as in straighten_image.
+    Output:
+        (angle1, angle2, confidence, (rOff, tOff, lOff, bOff))
+    """
+    setOptions(debug, graph, filter)
+    if stripRows and isNpy(imgpath):
+        return detect_npy(imgpath, resize, maxAngle, threads, adaptive, stripRows)
+    data, img = readImage(imgpath, grayscale)
+    return cachedDetect(data, img, resize, maxAngle, threads, adaptive, cache, imgpath,
+                        stripRows)
+
+def detect_npy(path, resize=2.0, maxAngle=4.0, threads=1, adaptive=False,
+               stripRows=STRIP_ROWS):
+    """
+    detect_array for the image array saved as .npy at path, without ever
+    loading it whole: the rotation is detected from strips of its rows
+    read from the file (see NpyRows), and the border box from a memmap
+    of it, which only reads the scanlines that findBorderRotated samples.
+    """
+    angle1, angle2, confidence = detectRotationArray(NpyRows(path), resize, maxAngle,
+                                                     os.path.split(path)[1], threads,
+                                                     adaptive=adaptive, stripRows=stripRows)
+    with timed('border'):
+        box = findBorderRotated(numpy.load(path, mmap_mode='r'), angle2)
+    return angle1, angle2, confidence, box
+
+def apply_image(imgpath, outputpath, angle, box=None, imgsize=None,
+                imgsize_rescale=None, grayscale=False):
+    """
+    Given an image and its rotation (and border box) as found by
+    detect_image, straighten it and save the result to outputpath,
+    without detecting anything. If box is None, the border is found
+    again, e.g. after the angle was corrected by hand. Other arguments
+    are as in straighten_image.
+    """
+    if grayscale:
+        img = loadImage(imgpath, cv.CV_LOAD_IMAGE_GRAYSCALE)
     else:
-        img = img_np
-    if imgsize:
-        img = size_image_noresize(img, imgsize)
-    if imgsize_rescale:
-        W_OUT = imgsize_rescale
-        H_OUT = int(round(img.shape[0] / (float(img.shape[1]) / W_OUT)))
-        img = size_image_resize(img, (W_OUT, H_OUT))
-    cv.SaveImage(outputpath, cv.fromarray(img))
+        img = loadImage(imgpath)
+    if box is None:
+        with timed('border'):
+            box = findBorderRotated(img, angle)
+    img = warpToOutput(img, angle, box, imgsize, imgsize_rescale)
+    writeImage(outputpath, img)
 
 def fastResize(I,w,h):
     Icv = cv.fromarray(I)
@@ -330,7 +1295,7 @@ def size_image_noresize(img, imgsize):
 def main():
     global GRAPH, DEBUG, FILTER
     usage="python straightener.py [-o OUTPATH] [-r RESIZE] [--size WIDTH HEIGHT] \
-[-m MAXANGLE] [-g] [-d] [-f] IMGPATH"
+[-m MAXANGLE] [-t THREADS] [-a] [-g] [-d] [-f] IMGPATH"
     parser = argparse.ArgumentParser(usage=usage,
                                      description='Straighten a rotated image.')
 
@@ -347,6 +1312,11 @@ by padding/cropping the output image appropriately.")
     parser.add_argument("-m", "--max-angle",
                         dest="maxAngle", default=4.0, type=float,
                         help="Maximum expected angle from the vertical/horizontal (in degrees)")
+    parser.add_argument("-t", "--threads",
+                        dest="threads", default=1, type=int,
+                        help="Number of threads to use for line detection")
+    parser.add_argument("-a", "--adaptive", action="store_true", dest="adaptive",
+                        default=False, help="Try detecting the rotation on smaller thumbnails first")
     parser.add_argument("-f", "--filter", action="store_true", dest="filter",
                         default=False, help="Filter the image and remove large black rectangles")
     parser.add_argument("-g", "--graph", action="store_true", dest="graph",
@@ -354,7 +1324,22 @@ by padding/cropping the output image appropriately.")
     parser.add_argument("-d", "--debug", action="store_true", dest="debug",
                       default=False, help="Print debugging info")
     parser.add_argument("--grayscale", action="store_true",
-                        help="Save output images as grayscale (single-channel).")
+                        help="Save output images as grayscale (single-channel). The image is "
+                        "then decoded and straightened as a single channel, which is faster.")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=CACHE_DIR,
+                        help="Directory of the detection cache (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        default=False, help="Neither use nor update the detection cache")
+    parser.add_argument("--stats", dest="stats", default=None, metavar="FILE",
+                        help="Append the time spent in each stage, and the line and \
+foreground pixel counts, to FILE as a line of JSON")
+    parser.add_argument("--hough-backend", dest="backend", default=None,
+                        choices=list(HOUGH_BACKENDS),
+                        help="Hough transform backend (default: the first available of %(choices)s)")
+    parser.add_argument("--strip-rows", dest="strip_rows", default=None, type=int,
+                        metavar="ROWS", help="Detect the rotation a strip of ROWS thumbnail rows \
+at a time (e.g. {0}), to bound its memory use. An image array saved as .npy is then read \
+from the file a strip at a time".format(STRIP_ROWS))
     parser.add_argument("input", help="Input filename")
 
     args = parser.parse_args()
@@ -367,6 +1352,8 @@ by padding/cropping the output image appropriately.")
     GRAPH = args.graph
     DEBUG = args.debug
     FILTER = args.filter
+    if args.backend:
+        setHoughBackend(args.backend)
 
     startTime = time.time()
     
@@ -379,12 +1366,23 @@ by padding/cropping the output image appropriately.")
         imgsize[1] = int(imgsize[1])
 
     try:
-        straighten_image(input, output, resize=resize, maxAngle=maxAngle, imgsize=imgsize, grayscale=args.grayscale)
+        cache = None if args.no_cache else openCache(args.cache_dir)
+        stats = startStats()
+        straighten_image(input, output, resize=resize, maxAngle=maxAngle, imgsize=imgsize, grayscale=args.grayscale,
+                         threads=args.threads, adaptive=args.adaptive, cache=cache,
+                         stripRows=args.strip_rows)
     except Exception as e:
         print "Fatal error occured while straightening:", input
         traceback.print_exc()
         print "Time Elapsed: {0}".format(time.time() - startTime)
         exit(1)
+    
+    if args.stats:
+        stopStats()
+        stats.update(input=input, elapsed=time.time() - startTime)
+        f = open(args.stats, 'a')
+        print >>f, json.dumps(stats, sort_keys=True)
+        f.close()
      
     if DEBUG:   
         print "Time Elapsed: {0}".format(time.time() - startTime)
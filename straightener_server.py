@@ -0,0 +1,465 @@
+import sys, os, time, argparse, json, threading, multiprocessing, traceback, signal
+import socket, urlparse, urllib, httplib, BaseHTTPServer, SocketServer
+import numpy
+
+import straightener
+from batch_straightener import OUTPUT_EXTENSIONS, create_dirs
+
+"""
+A long running straightening service, for straightening the ballots one
+at a time as they are scanned, without paying for the interpreter start,
+the imports and cold Hough plans on every ballot. It serves HTTP on a
+local Unix socket (--socket) or on localhost (--port), and hands the
+requests to a pool of worker processes that stay warm between them.
+
+    POST /straighten  straighten an image, see Handler.do_POST
+    POST /detect      only detect its rotation and border box
+    GET /status       the number of workers, pending and served requests
+
+The image is given either by its path (?path=...), or as the request
+body. /straighten writes the result to ?output=..., if given, or returns
+it as the response body, in the format given by ?format= (png, tiff or
+npy). Paths are only served under --root, and outputs only written under
+--output-root; without them, ?path= and ?output= are refused with 403,
+as are the paths that resolve (following the links) outside of them.
+The angles are returned as JSON, or in the X-Angle1, X-Angle2,
+X-Confidence and X-Box headers along with an image body.
+At most --max-pending requests are queued or running at a time; the
+others are turned away at once with 503 and a Retry-After header, so
+that a client backs off instead of piling up requests. A request whose
+result doesn't come within --timeout seconds gets 504, but counts as
+pending until its worker is done with it.
+"""
+
+# Requests queued or running per worker, by default, before turning the
+# next ones away.
+PENDING_PER_PROC = 4
+# Seconds a client is told to wait after being turned away.
+RETRY_AFTER = 1
+# Seconds to wait for the result of a worker, by default, before giving
+# up on the request with 504: a worker that dies loses its request, whose
+# result would never come.
+REQUEST_TIMEOUT = 60
+
+_worker = {}
+
+class OutputError(Exception):
+    """
+    The straightened image of a request couldn't be encoded or written:
+    a fault of the server, unlike an IOError reading the image.
+    """
+
+def init_worker(options, cachedir=None, encoder=None, warmsizes=()):
+    """
+    Pool initializer: set the straightening options (as for
+    batch_straightener.init_worker) and the encoder, open the detection
+    cache, and warm up by detecting on a blank page of each of warmsizes
+    (WIDTH, HEIGHT), so that the Hough plans for those sizes are built
+    before the first request.
+    """
+    _worker['options'] = options
+    _worker['encoder'] = encoder or {}
+    _worker['cache'] = straightener.openCache(cachedir) if cachedir else None
+    straightener.setOptions(options['debug'], options['graph'], options['filter'],
+                            options.get('backend'))
+    # Don't let a ^C meant for the server kill the workers mid-request
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for width, height in warmsizes:
+        blank = numpy.full((height, width), 255, numpy.uint8)
+        straightener.detect_array(blank, options['resize'], options['maxAngle'],
+                                  adaptive=options['adaptive'],
+                                  stripRows=options.get('stripRows'))
+
+def process_request(job):
+    """
+    Run in a worker: straighten or only detect the image of job, a dict:
+        str mode: 'straighten' or 'detect'
+        str path: the image file, or
+        str data: the contents of the image file
+        str output: if given, write the straightened image there
+        str format: otherwise, return it encoded in this format (see
+                    batch_straightener.OUTPUT_EXTENSIONS)
+    Returns a dict of angle1, angle2, confidence, box and elapsed (the
+    seconds spent in the worker), and for /straighten, either output or
+    data, the encoded image. Raises OutputError if that fails.
+    """
+    t = time.time()
+    options = _worker['options']
+    encoder = _worker['encoder']
+    detect = job['mode'] == 'detect'
+    name = job.get('path') or 'request body'
+    data = job.get('data')
+    if data is None:
+        data = straightener.readImageFile(job['path'])
+    if options['grayscale']:
+        img = straightener.decodeImage(data, straightener.cv.CV_LOAD_IMAGE_GRAYSCALE, name)
+    else:
+        img = straightener.decodeImage(data, straightener.cv.CV_LOAD_IMAGE_COLOR, name)
+    angle1, angle2, confidence, box = straightener.cachedDetect(
+        data, img, options['resize'], options['maxAngle'], 1, options['adaptive'],
+        _worker['cache'], name, options.get('stripRows'))
+    result = dict(angle1=angle1, angle2=angle2, confidence=confidence, box=list(box))
+    if not detect:
+        out = straightener.warpToOutput(img, angle2, box, options['imgsize'],
+                                        options['imgsize_rescale'])
+        outpath = job.get('output') or 'output' + OUTPUT_EXTENSIONS[job.get('format') or 'png']
+        params = straightener.encoderParams(outpath, encoder.get('pngLevel'),
+                                            encoder.get('pngStrategy'))
+        try:
+            if job.get('output'):
+                create_dirs(os.path.dirname(outpath))
+                straightener.writeImage(outpath, out, params)
+                result['output'] = outpath
+            else:
+                result['data'] = straightener.encodeImage(outpath, out, params)
+        except (IOError, OSError) as e:
+            raise OutputError(str(e))
+    result['elapsed'] = time.time() - t
+    return result
+
+def confine(path, root):
+    """
+    The real path of path, relative to root unless absolute, or None if
+    root is None or it resolves outside of root.
+    """
+    if root is None:
+        return None
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, path))
+    if path != root and path.startswith(os.path.join(root, '')):
+        return path
+    return None
+
+class Service(object):
+    """
+    The pool of warm workers, and the count of pending requests that
+    gives the backpressure.
+    """
+    def __init__(self, procs, options, cachedir=None, encoder=None, warmsizes=(),
+                 maxPending=None, timeout=REQUEST_TIMEOUT):
+        self.procs = procs or multiprocessing.cpu_count()
+        self.maxPending = maxPending or self.procs * PENDING_PER_PROC
+        self.timeout = timeout
+        self.pool = multiprocessing.Pool(self.procs, init_worker,
+                                         (options, cachedir, encoder, warmsizes))
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.served = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timedOut = 0
+
+    def submit(self, job):
+        """
+        Run job on a worker, see process_request, and wait for its result.
+        Returns None at once, without running it, if maxPending requests
+        are already pending. Exceptions raised by the worker are re-raised,
+        and multiprocessing.TimeoutError if the result doesn't come within
+        self.timeout seconds; the job then stays pending until the worker
+        is done with it, see release.
+        """
+        with self.lock:
+            if self.pending >= self.maxPending:
+                self.rejected += 1
+                return None
+            self.pending += 1
+        asyncResult = self.pool.apply_async(process_request, (job,))
+        try:
+            result = asyncResult.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            with self.lock:
+                self.timedOut += 1
+            waiter = threading.Thread(target=self.release, args=(asyncResult,))
+            waiter.daemon = True
+            waiter.start()
+            raise
+        except:
+            self.release()
+            with self.lock:
+                self.failed += 1
+            raise
+        self.release()
+        with self.lock:
+            self.served += 1
+        return result
+
+    def release(self, asyncResult=None):
+        """
+        Stop counting a job as pending, once its asyncResult is ready if
+        given, i.e. once the worker is done with it. The job of a worker
+        that died is never done, and stays pending: its slot is lost until
+        the server is restarted.
+        """
+        if asyncResult is not None:
+            asyncResult.wait()
+        with self.lock:
+            self.pending -= 1
+
+    def status(self):
+        with self.lock:
+            return dict(procs=self.procs, pending=self.pending, max_pending=self.maxPending,
+                        served=self.served, failed=self.failed, rejected=self.rejected,
+                        timed_out=self.timedOut)
+
+    def close(self):
+        # The workers of timed out requests may never finish them
+        if self.timedOut:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the requests described in the module docstring, on behalf of
+    self.server.service.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/status':
+            return self.reply(404, {'error': 'not found: {0}'.format(url.path)})
+        self.reply(200, self.server.service.status())
+
+    def do_POST(self):
+        """
+        POST /straighten or /detect. The query gives the path of the
+        image, unless it is the body, and for /straighten optionally the
+        output path or format. Replies with JSON, or with the image (when
+        /straighten has no output), with 400 if the image can't be read or
+        decoded, 403 if a path is outside of --root or --output-root (see
+        confine), 500 if the output can't be written, or on any other
+        error, 503 when busy and 504 when the worker times out.
+        """
+        t = time.time()
+        # Read the whole request first, to keep the connection usable
+        length = int(self.headers.getheader('Content-Length') or 0)
+        data = self.rfile.read(length) if length else None
+        url = urlparse.urlparse(self.path)
+        mode = url.path.strip('/')
+        if mode not in ('straighten', 'detect'):
+            return self.reply(404, {'error': 'not found: {0}'.format(url.path)})
+        query = dict(urlparse.parse_qsl(url.query))
+        job = {'mode': mode, 'path': query.get('path'), 'output': query.get('output'),
+               'format': query.get('format')}
+        if data:
+            job['data'] = data
+        if job['path'] is None and 'data' not in job:
+            return self.reply(400, {'error': 'no image: give ?path= or a request body'})
+        if job['format'] not in (None, 'png', 'tiff', 'npy'):
+            return self.reply(400, {'error': 'unknown format: {0}'.format(job['format'])})
+        for key, root, option in (('path', self.server.root, '--root'),
+                                  ('output', self.server.outputRoot, '--output-root')):
+            if job[key] is None:
+                continue
+            if root is None:
+                return self.reply(403, {'error': '?{0}= needs {1}'.format(key, option)})
+            job[key] = confine(job[key], root)
+            if job[key] is None:
+                return self.reply(403, {'error': '{0} outside of {1}: {2}'.format(
+                    key, option, query[key])})
+        if job['output'] is not None and \
+           os.path.splitext(job['output'])[1].lower() not in ('.png', '.tif', '.tiff', '.npy'):
+            return self.reply(400, {'error': 'unknown output format: {0}'.format(query['output'])})
+        try:
+            result = self.server.service.submit(job)
+        except OutputError as e:
+            return self.reply(500, {'error': str(e)})
+        except IOError as e:
+            return self.reply(400, {'error': str(e)})
+        except multiprocessing.TimeoutError:
+            return self.reply(504, {'error': 'no result within {0} seconds'.format(
+                self.server.service.timeout)})
+        except Exception as e:
+            return self.reply(500, {'error': repr(e)})
+        if result is None:
+            return self.reply(503, {'error': 'busy, retry later'},
+                              {'Retry-After': str(RETRY_AFTER)})
+        result['latency'] = time.time() - t
+        data = result.pop('data', None)
+        if data is None:
+            return self.reply(200, result)
+        headers = {'X-Angle1': repr(result['angle1']), 'X-Angle2': repr(result['angle2']),
+                   'X-Confidence': repr(result['confidence']),
+                   'X-Box': ','.join(str(int(x)) for x in result['box']),
+                   'X-Elapsed': '{0:.4f}'.format(result['elapsed']),
+                   'X-Latency': '{0:.4f}'.format(result['latency'])}
+        self.reply(200, data, headers, 'application/octet-stream')
+
+    def reply(self, code, body, headers={}, contentType='application/json'):
+        if contentType == 'application/json':
+            body = json.dumps(body, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # A Unix socket has no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    An httplib connection to the service on the Unix socket at path.
+    """
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socketpath = path
+        self.sockettimeout = timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.sockettimeout is not None:
+            self.sock.settimeout(self.sockettimeout)
+        self.sock.connect(self.socketpath)
+
+def request(address, mode, path=None, data=None, **query):
+    """
+    Send a request to the service at address (the path of its Unix
+    socket, or (host, port)), for the image at path or with the contents
+    data. mode is 'straighten' or 'detect', and query gives the other
+    parameters (output, format). Returns (int status, dict headers, str
+    body); a JSON body is decoded.
+    """
+    if isinstance(address, tuple):
+        conn = httplib.HTTPConnection(*address)
+    else:
+        conn = UnixHTTPConnection(address)
+    if path is not None:
+        query['path'] = os.path.abspath(path)
+    url = '/{0}?{1}'.format(mode, urllib.urlencode(query))
+    try:
+        conn.request('POST', url, data or '', {'Content-Length': str(len(data or ''))})
+        response = conn.getresponse()
+        body = response.read()
+        headers = dict(response.getheaders())
+    finally:
+        conn.close()
+    if headers.get('content-type') == 'application/json':
+        body = json.loads(body)
+    return response.status, headers, body
+
+def serve(service, address, verbose=False, root=None, outputRoot=None):
+    """
+    Serve requests for service on address (the path of a Unix socket,
+    or (host, port)) until interrupted or terminated. The images are
+    read by path only under root, and written only under outputRoot.
+    """
+    if isinstance(address, tuple):
+        server = HTTPServer(address, Handler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixHTTPServer(address, Handler)
+    server.service = service
+    server.verbose = verbose
+    server.root = root
+    server.outputRoot = outputRoot
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+    print "Serving on {0} with {1} workers (at most {2} pending requests)".format(
+        address, service.procs, service.maxPending)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.unlink(address)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve straightening requests with warm workers.')
+    parser.add_argument("--socket", dest="socket", default=None,
+                        help="Serve on this Unix socket")
+    parser.add_argument("--port", dest="port", default=None, type=int,
+                        help="Serve on this port of --host instead")
+    parser.add_argument("--host", dest="host", default="127.0.0.1",
+                        help="Host to serve --port on (default: %(default)s)")
+    parser.add_argument("--root", dest="root", default=None,
+                        help="Serve ?path= requests for the images under this directory only \
+(default: refuse them, the image must be the request body)")
+    parser.add_argument("--output-root", dest="output_root", default=None,
+                        help="Write ?output= images under this directory only (default: \
+refuse them, the image is returned as the response body)")
+    parser.add_argument("-j", "--procs", dest="procs", default=None, type=int,
+                        help="Number of worker processes (default: one per CPU)")
+    parser.add_argument("--max-pending", dest="max_pending", default=None, type=int,
+                        help="Requests queued or running before turning the next ones away \
+with 503 (default: {0} per worker)".format(PENDING_PER_PROC))
+    parser.add_argument("--timeout", dest="timeout", default=REQUEST_TIMEOUT, type=float,
+                        help="Seconds to wait for a worker before replying 504 (default: \
+%(default)s)")
+    parser.add_argument("--warm", dest="warm", default=[], nargs=2, type=int,
+                        action="append", metavar=("WIDTH", "HEIGHT"),
+                        help="Build the Hough plans for pages of this size at startup; can \
+be given several times")
+    parser.add_argument("-r", "--resize-factor", dest="resize", default=2.0, type=float,
+                        help="Shrinking factor")
+    parser.add_argument("--size", dest="imgsize", default=None, nargs=2, type=int,
+                        help="Make output images be of a given size by padding/cropping the \
+output images appropriately. (WIDTH, HEIGHT)")
+    parser.add_argument("--size_rescale", dest="imgsize_rescale", default=None,
+                        metavar="OUTWIDTH", type=int,
+                        help="Rescale the output images to width OUTWIDTH")
+    parser.add_argument("-m", "--max-angle", dest="maxAngle", default=4.0, type=float,
+                        help="Maximum expected angle from the vertical/horizontal (in degrees)")
+    parser.add_argument("-a", "--adaptive", action="store_true", dest="adaptive",
+                        default=False, help="Try detecting the rotation on smaller thumbnails first")
+    parser.add_argument("-f", "--filter", action="store_true", dest="filter",
+                        default=False, help="Filter the image and remove large black rectangles")
+    parser.add_argument("--hough-backend", dest="backend", default=None,
+                        choices=list(straightener.HOUGH_BACKENDS),
+                        help="Hough transform backend (default: the first available of %(choices)s)")
+    parser.add_argument("--strip-rows", dest="strip_rows", default=None, type=int,
+                        metavar="ROWS", help="Detect the rotation a strip of ROWS thumbnail rows \
+at a time (e.g. {0}), to bound its memory use".format(straightener.STRIP_ROWS))
+    parser.add_argument("--grayscale", action="store_true",
+                        help="Decode, straighten and return the images as grayscale")
+    parser.add_argument("--png-level", dest="png_level", default=None, type=int,
+                        choices=range(10), metavar="0-9", help="PNG compression level")
+    parser.add_argument("--png-strategy", dest="png_strategy", default=None,
+                        choices=sorted(straightener.PNG_STRATEGIES),
+                        help="PNG (zlib) compression strategy")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=straightener.CACHE_DIR,
+                        help="Directory of the detection cache (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        default=False, help="Neither use nor update the detection cache")
+    parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
+                        default=False, help="Log every request")
+    args = parser.parse_args()
+    if (args.socket is None) == (args.port is None):
+        parser.error("give either --socket or --port")
+
+    options = dict(resize=args.resize, maxAngle=args.maxAngle,
+                   imgsize=tuple(args.imgsize) if args.imgsize else None,
+                   imgsize_rescale=args.imgsize_rescale, debug=False, graph=False,
+                   filter=args.filter, grayscale=args.grayscale, adaptive=args.adaptive,
+                   backend=args.backend, stripRows=args.strip_rows)
+    service = Service(args.procs, options, None if args.no_cache else args.cache_dir,
+                      dict(pngLevel=args.png_level, pngStrategy=args.png_strategy),
+                      [tuple(size) for size in args.warm], args.max_pending, args.timeout)
+    serve(service, args.socket or (args.host, args.port), args.verbose, args.root,
+          args.output_root)
+
+if __name__ == '__main__':
+    main()